@@ -7,8 +7,9 @@ import sys
 
 from dotenv import load_dotenv
 
-from easybk import TaskManager, UploadManager
+from easybk import BackupScheduler, TaskManager, UploadManager
 from easybk.run_lock import RunLock
+from easybk.state_store import DEFAULT_STATE_BACKEND, STATE_BACKENDS
 from config_parser import init_from_yaml
 
 
@@ -28,10 +29,16 @@ def parse_args(argv=None):
                         type=_absolute_path, help="环境变量文件路径")
     parser.add_argument("--state-file", default=os.path.join(INVOCATION_DIR, "md5_list.txt"),
                         type=_absolute_path, help="文件变化摘要状态路径")
+    parser.add_argument("--state-backend", choices=STATE_BACKENDS, default=DEFAULT_STATE_BACKEND,
+                        help="摘要状态存储后端，sqlite 首次使用时自动导入文本状态文件")
     parser.add_argument("--lock-file", default=os.path.join(INVOCATION_DIR, ".backup.lock"),
                         type=_absolute_path, help="单实例运行锁路径")
     parser.add_argument("--log-config", default=os.path.join(BASE_DIR, "logger.conf"),
                         type=_absolute_path, help="logging 配置文件路径")
+    parser.add_argument("--task-workers", type=int, default=None,
+                        help="同时执行的备份任务数，覆盖配置中的 scheduler.task_workers")
+    parser.add_argument("--upload-workers", type=int, default=None,
+                        help="同时执行的上传任务数，覆盖配置中的 scheduler.upload_workers")
     parser.add_argument("--validate-config", action="store_true",
                         help="仅加载并校验配置，不执行备份")
     return parser.parse_args(argv)
@@ -76,21 +83,26 @@ def _run_backup(logger, args):
 
     task_manager = TaskManager()
     upload_manager = UploadManager()
-    task_manager.set_encipher_file(args.state_file)
-    
+    task_manager.set_encipher_file(args.state_file, args.state_backend)
+    scheduler = BackupScheduler(task_manager, upload_manager)
+
     if not os.path.exists(args.config):
         logger.error("未找到配置文件: %s", args.config)
         return 2
-    if not init_from_yaml(task_manager, upload_manager, args.config):
+    if not init_from_yaml(task_manager, upload_manager, args.config, scheduler=scheduler):
+        return 2
+    try:
+        scheduler.configure(task_workers=args.task_workers, upload_workers=args.upload_workers)
+    except ValueError as exc:
+        logger.error("并发参数错误: %s", exc)
         return 2
 
     if args.validate_config:
         logger.info("配置校验通过: %s", args.config)
         return 0
     
-    backup_ok = task_manager.run_all_task()
-    upload_ok = upload_manager.run_all_upload()
-    if not backup_ok or not upload_ok:
+    # 每个备份任务完成后立即开始上传它的产物，任务及其上传全部成功后立即提交该任务的状态
+    if not scheduler.run():
         logger.error("备份执行失败")
         return 1
     task_manager.save_state()
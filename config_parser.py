@@ -13,9 +13,68 @@ try:
 except ImportError:
     yaml = None
 
-from easybk import TaskManager, UploadManager, UploadTask
-from easybk import PackTask, MysqlTask, SingleFileTask
+from easybk import BackupScheduler, TaskManager, UploadManager, UploadTask
+from easybk import PackTask, MysqlTask, SingleFileTask, MultiFileTask
 from easybk import OSSUploader, FTPUploader
+from easybk.compression import COMPRESS_LEVELS, COMPRESSION_POLICIES, COMPRESSIONS
+from easybk.direct_upload import DirectUpload
+from easybk.hashing import ALGORITHMS, DEFAULT_ALGORITHM
+from easybk.uploaders.dedup_index import DEDUP_MODES
+from easybk.uploaders.oss_uploader import MULTIPART_THRESHOLD, PART_SIZE, STALE_UPLOAD_AGE
+
+
+def _is_positive_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _validate_compression(task: dict, prefix: str, errors: list):
+    """校验 pack/mysql 任务的压缩选项。"""
+    compression = task.get("compression", "gzip")
+    if compression not in COMPRESSIONS:
+        errors.append("{}.compression 不受支持: {}（可选: {}）".format(
+            prefix, compression, ", ".join(COMPRESSIONS)))
+    level = task.get("compress_level")
+    if level is not None and (not isinstance(level, int) or isinstance(level, bool)):
+        errors.append("{}.compress_level 必须是整数".format(prefix))
+    elif level is not None and compression in COMPRESS_LEVELS:
+        low, high = COMPRESS_LEVELS[compression]
+        if not low <= level <= high:
+            errors.append("{}.compress_level 必须在 {}～{} 之间（{}）".format(
+                prefix, low, high, compression))
+    workers = task.get("compress_workers")
+    if workers is not None and not _is_positive_int(workers):
+        errors.append("{}.compress_workers 必须是正整数".format(prefix))
+
+
+def _compression_options(task_config: dict) -> dict:
+    """提取任务配置中的压缩选项，作为 PackTask/MysqlTask 的关键字参数。"""
+    return {
+        "compression": task_config.get("compression", "gzip"),
+        "compress_level": task_config.get("compress_level"),
+        "compress_workers": task_config.get("compress_workers"),
+    }
+
+
+def _validate_scheduler(scheduler, errors: list) -> set:
+    """校验 scheduler 节点，返回声明过的资源池名称。"""
+    if scheduler is None:
+        return set()
+    if not isinstance(scheduler, dict):
+        errors.append("scheduler 必须是对象")
+        return set()
+    for field in ("task_workers", "upload_workers"):
+        if field in scheduler and not _is_positive_int(scheduler[field]):
+            errors.append("scheduler.{} 必须是正整数".format(field))
+    if not isinstance(scheduler.get("fanout_uploads", False), bool):
+        errors.append("scheduler.fanout_uploads 必须是布尔值")
+    pools = scheduler.get("pools", {})
+    if not isinstance(pools, dict):
+        errors.append("scheduler.pools 必须是对象")
+        return set()
+    for name, limit in pools.items():
+        if not _is_positive_int(limit):
+            errors.append("scheduler.pools.{} 必须是正整数".format(name))
+    return set(pools)
 
 
 def _validate_config(config: dict) -> list:
@@ -34,6 +93,7 @@ def _validate_config(config: dict) -> list:
         uploaders = []
     if "upload_tasks" in config:
         errors.append("upload_tasks 已废弃，请将上传配置放入对应 task 的 uploaders 中")
+    declared_pools = _validate_scheduler(config.get("scheduler"), errors)
 
     uploader_names = []
     for index, uploader in enumerate(uploaders):
@@ -56,8 +116,38 @@ def _validate_config(config: dict) -> list:
         for field in required:
             if not uploader.get(field):
                 errors.append("{} 缺少 {}".format(prefix, field))
-        if uploader_type == "oss" and not isinstance(uploader.get("use_temp_object", True), bool):
-            errors.append("{}.use_temp_object 必须是布尔值".format(prefix))
+        if uploader_type == "oss":
+            for field, default in (("use_temp_object", True), ("atomic_commit", False)):
+                if not isinstance(uploader.get(field, default), bool):
+                    errors.append("{}.{} 必须是布尔值".format(prefix, field))
+        if uploader_type == "oss":
+            for field in ("multipart_threshold", "part_size", "part_workers", "retries"):
+                if field in uploader and not _is_positive_int(uploader[field]):
+                    errors.append("{}.{} 必须是正整数".format(prefix, field))
+            stale_upload_age = uploader.get("stale_upload_age", 0)
+            if not isinstance(stale_upload_age, int) or isinstance(stale_upload_age, bool) \
+                    or stale_upload_age < 0:
+                errors.append("{}.stale_upload_age 必须是非负整数".format(prefix))
+            stale_upload_prefix = uploader.get("stale_upload_prefix", "")
+            if not isinstance(stale_upload_prefix, str):
+                errors.append("{}.stale_upload_prefix 必须是字符串".format(prefix))
+            elif stale_upload_age and not stale_upload_prefix:
+                errors.append("{}.stale_upload_age 需要设置非空的 stale_upload_prefix".format(prefix))
+            part_size = uploader.get("part_size")
+            if _is_positive_int(part_size) and part_size < 100 * 1024:
+                errors.append("{}.part_size 不能小于 102400（OSS 分片下限）".format(prefix))
+        dedup = uploader.get("dedup", "off")
+        dedup_modes = DEDUP_MODES if uploader_type == "oss" else ("off", "skip")
+        if dedup not in dedup_modes:
+            errors.append("{}.dedup 必须是 {} 之一".format(prefix, "/".join(dedup_modes)))
+        if "dedup_index" in uploader and not isinstance(uploader["dedup_index"], str):
+            errors.append("{}.dedup_index 必须是字符串".format(prefix))
+        if not _is_positive_int(uploader.get("max_connections", 1)):
+            errors.append("{}.max_connections 必须是正整数".format(prefix))
+        idle_timeout = uploader.get("idle_timeout", 60)
+        if uploader_type == "ftp" and (not isinstance(idle_timeout, (int, float))
+                                       or isinstance(idle_timeout, bool) or idle_timeout < 0):
+            errors.append("{}.idle_timeout 必须是非负数".format(prefix))
 
     duplicate_uploaders = {name for name in uploader_names if uploader_names.count(name) > 1}
     for name in sorted(duplicate_uploaders):
@@ -76,7 +166,7 @@ def _validate_config(config: dict) -> list:
             errors.append("{} 缺少 task_name".format(prefix))
         else:
             task_names.append(task_name)
-        if task_type not in ("pack", "mysql", "single_file"):
+        if task_type not in ("pack", "mysql", "single_file", "multi_file"):
             errors.append("{} 的 type 不受支持: {}".format(prefix, task_type))
         if not task.get("output_dir"):
             errors.append("{} 缺少 output_dir".format(prefix))
@@ -84,15 +174,100 @@ def _validate_config(config: dict) -> list:
             "pack": ("tar_run_dir", "backup_list"),
             "mysql": ("dump_option",),
             "single_file": ("source_file",),
+            "multi_file": ("sources",),
         }.get(task_type, ())
         for field in required:
             if not task.get(field):
                 errors.append("{} 缺少 {}".format(prefix, field))
+        if task_type == "pack":
+            for field in ("streaming", "incremental"):
+                if not isinstance(task.get(field, False), bool):
+                    errors.append("{}.{} 必须是布尔值".format(prefix, field))
+            policy = task.get("compression_policy", "always")
+            if policy not in COMPRESSION_POLICIES:
+                errors.append("{}.compression_policy 不受支持: {}（可选: {}）".format(
+                    prefix, policy, ", ".join(COMPRESSION_POLICIES)))
+            elif policy == "adaptive" and task.get("compression", "gzip") != "parallel_gzip":
+                errors.append("{}.compression_policy adaptive 需要 compression: parallel_gzip"
+                              .format(prefix))
+            chunk_store = task.get("chunk_store")
+            if chunk_store is not None:
+                if not isinstance(chunk_store, str) or not chunk_store:
+                    errors.append("{}.chunk_store 必须是目录路径".format(prefix))
+                if task.get("incremental") is True:
+                    errors.append("{}.chunk_store 不能与 incremental 同时使用".format(prefix))
+            if not _is_positive_int(task.get("chunk_store_keep", 7)):
+                errors.append("{}.chunk_store_keep 必须是正整数".format(prefix))
+        if task_type in ("pack", "mysql"):
+            _validate_compression(task, prefix, errors)
+            interval = task.get("full_backup_interval", 7)
+            if not isinstance(interval, int) or isinstance(interval, bool) or interval < 0:
+                errors.append("{}.full_backup_interval 必须是非负整数".format(prefix))
+        if task_type == "mysql":
+            for field in ("streaming", "delta"):
+                if not isinstance(task.get(field, False), bool):
+                    errors.append("{}.{} 必须是布尔值".format(prefix, field))
+            split_by = task.get("split_by")
+            if task.get("delta") is True and split_by is not None:
+                errors.append("{}.delta 不能与 split_by 同时使用".format(prefix))
+            if split_by is not None:
+                if split_by not in ("database", "table"):
+                    errors.append("{}.split_by 不受支持: {}".format(prefix, split_by))
+                databases = task.get("databases")
+                if not isinstance(databases, list) or not databases:
+                    errors.append("{}.databases 必须是非空列表".format(prefix))
+            if not _is_positive_int(task.get("dump_workers", 4)):
+                errors.append("{}.dump_workers 必须是正整数".format(prefix))
+        if task_type == "single_file":
+            for field in ("backup_on_change", "paranoid"):
+                if not isinstance(task.get(field, False), bool):
+                    errors.append("{}.{} 必须是布尔值".format(prefix, field))
+        if task_type == "multi_file":
+            sources = task.get("sources")
+            if sources and (not isinstance(sources, list) or
+                            not all(isinstance(source, str) and source for source in sources)):
+                errors.append("{}.sources 必须是文件、目录或 glob 的列表".format(prefix))
+            for field in ("bundle", "paranoid"):
+                if not isinstance(task.get(field, False), bool):
+                    errors.append("{}.{} 必须是布尔值".format(prefix, field))
+            if not _is_positive_int(task.get("hash_workers", 4)):
+                errors.append("{}.hash_workers 必须是正整数".format(prefix))
+        if task_type in ("pack", "single_file", "multi_file"):
+            hash_algorithm = task.get("hash_algorithm", DEFAULT_ALGORITHM)
+            if hash_algorithm not in ALGORITHMS:
+                errors.append("{}.hash_algorithm 不受支持: {}（可选: {}）".format(
+                    prefix, hash_algorithm, ", ".join(ALGORITHMS)))
+
+        task_pools = task.get("pools")
+        if task_pools is not None:
+            if not isinstance(task_pools, list):
+                errors.append("{}.pools 必须是列表".format(prefix))
+            else:
+                for pool in task_pools:
+                    if not isinstance(pool, str) or not (
+                            pool in ("cpu", "disk") or pool in declared_pools
+                            or pool.startswith(("disk:", "net:"))):
+                        errors.append("{}.pools 引用了未声明的资源池: {}".format(prefix, pool))
 
         task_uploaders = task.get("uploaders", [])
         if not isinstance(task_uploaders, list):
             errors.append("{}.uploaders 必须是列表".format(prefix))
             continue
+        direct_upload = task.get("direct_upload", False)
+        if direct_upload is not False and task_type not in ("pack", "mysql"):
+            errors.append("{}.direct_upload 只支持 pack 和 mysql 任务".format(prefix))
+        elif not isinstance(direct_upload, bool):
+            errors.append("{}.direct_upload 必须是布尔值".format(prefix))
+        elif direct_upload:
+            if task_type == "mysql" and not any(task.get(field) for field in
+                                                ("streaming", "split_by", "delta")):
+                errors.append("{}.direct_upload 需要 streaming、split_by 或 delta".format(prefix))
+            names = [upload.get("uploader_name") for upload in task_uploaders
+                     if isinstance(upload, dict)]
+            if not names:
+                errors.append("{}.direct_upload 需要至少一个上传器".format(prefix))
+            if len(set(names)) != len(names):
+                errors.append("{}.direct_upload 时同一上传器只能引用一次".format(prefix))
         for upload_index, upload in enumerate(task_uploaders):
             upload_prefix = "{}.uploaders[{}]".format(prefix, upload_index)
             if not isinstance(upload, dict):
@@ -206,7 +381,8 @@ def _resolve_value(value, variables: dict):
     return value
 
 
-def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, config_path: str = "config.yaml"):
+def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager,
+                   config_path: str = "config.yaml", scheduler: BackupScheduler = None):
     """
     从 YAML 配置文件初始化任务和上传管理器
     
@@ -214,6 +390,7 @@ def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, con
         task_manager: 任务管理器
         upload_manager: 上传管理器
         config_path: YAML 配置文件路径，默认为 config.yaml
+        scheduler: 调度器，不为 None 时应用配置中的 scheduler 节点
     """
     logger = logging.getLogger("config_parser")
     
@@ -299,6 +476,7 @@ def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, con
         try:
             task = _create_task_from_config(task_config, variables)
             if task:
+                task.set_pools(task_config.get("pools"))
                 created_tasks.append(task)
                 task_dict[task.task_name] = task
                 logger.info("添加任务: %s (类型: %s)", task.task_name, task_config.get("type", "unknown"))
@@ -314,6 +492,9 @@ def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, con
         try:
             uploader = _create_uploader_from_config(uploader_config, variables)
             if uploader:
+                uploader.set_dedup(uploader_config.get("dedup", "off"),
+                                   _resolve_value(uploader_config.get("dedup_index"), variables),
+                                   os.path.dirname(os.path.abspath(task_manager.encipher_file)))
                 uploader_dict[uploader.name] = uploader
                 logger.info("添加上传器: %s (类型: %s)", uploader.name, uploader_config.get("type", "unknown"))
         except Exception as e:
@@ -328,6 +509,7 @@ def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, con
         if not task:
             continue
 
+        task_upload_tasks = []
         for upload_config in task_config.get("uploaders", []):
             try:
                 uploader_name = upload_config.get("uploader_name")
@@ -340,6 +522,7 @@ def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, con
 
                 upload_task = UploadTask(task=task, uploader=uploader, remote_dir=remote_dir)
                 created_upload_tasks.append(upload_task)
+                task_upload_tasks.append(upload_task)
                 logger.info("添加上传任务: 任务=%s, 上传器=%s, 远程目录=%s",
                             task_name, uploader_name, remote_dir)
             except Exception as e:
@@ -347,11 +530,21 @@ def init_from_yaml(task_manager: TaskManager, upload_manager: UploadManager, con
                              task_name, upload_config, str(e))
                 initialization_failed = True
                 continue
+        if task_config.get("direct_upload", False) and task_upload_tasks:
+            task.set_direct_upload(DirectUpload(task_upload_tasks))
+            logger.info("任务 %s 使用直传，不生成本地归档", task_name)
 
     if initialization_failed:
         logger.error("YAML 配置初始化失败，未加载任何任务")
         return False
 
+    if scheduler is not None:
+        scheduler_config = config.get("scheduler") or {}
+        scheduler.configure(task_workers=scheduler_config.get("task_workers"),
+                            upload_workers=scheduler_config.get("upload_workers"),
+                            pools=scheduler_config.get("pools"),
+                            fanout_uploads=scheduler_config.get("fanout_uploads"))
+
     for task in created_tasks:
         task_manager.add_task(task)
     for upload_task in created_upload_tasks:
@@ -386,6 +579,9 @@ def _create_task_from_config(task_config: dict, variables: dict):
         # PackTask
         tar_run_dir = _resolve_value(task_config.get("tar_run_dir"), variables)
         backup_list = _resolve_value(task_config.get("backup_list", []), variables)
+        streaming = task_config.get("streaming", False)
+        incremental = task_config.get("incremental", False)
+        full_backup_interval = task_config.get("full_backup_interval", 7)
         
         if not tar_run_dir:
             raise ValueError("PackTask 配置缺少 tar_run_dir")
@@ -396,7 +592,15 @@ def _create_task_from_config(task_config: dict, variables: dict):
             task_name=task_name,
             output_dir=output_dir,
             tar_run_dir=tar_run_dir,
-            backup_list=backup_list
+            backup_list=backup_list,
+            streaming=streaming,
+            incremental=incremental,
+            full_backup_interval=full_backup_interval,
+            compression_policy=task_config.get("compression_policy", "always"),
+            chunk_store=_resolve_value(task_config.get("chunk_store"), variables),
+            chunk_store_keep=task_config.get("chunk_store_keep", 7),
+            hash_algorithm=task_config.get("hash_algorithm", DEFAULT_ALGORITHM),
+            **_compression_options(task_config),
         )
     
     elif task_type == "mysql":
@@ -409,13 +613,22 @@ def _create_task_from_config(task_config: dict, variables: dict):
         return MysqlTask(
             task_name=task_name,
             output_dir=output_dir,
-            dump_option=dump_option
+            dump_option=dump_option,
+            streaming=task_config.get("streaming", False),
+            split_by=task_config.get("split_by"),
+            databases=_resolve_value(task_config.get("databases"), variables),
+            dump_workers=task_config.get("dump_workers", 4),
+            mysql_option=_resolve_value(task_config.get("mysql_option"), variables),
+            delta=task_config.get("delta", False),
+            full_backup_interval=task_config.get("full_backup_interval", 7),
+            **_compression_options(task_config),
         )
     
     elif task_type == "single_file":
         # SingleFileTask
         source_file = _resolve_value(task_config.get("source_file"), variables)
         backup_on_change = task_config.get("backup_on_change", False)
+        paranoid = task_config.get("paranoid", False)
         
         if not source_file:
             raise ValueError("SingleFileTask 配置缺少 source_file")
@@ -424,9 +637,28 @@ def _create_task_from_config(task_config: dict, variables: dict):
             task_name=task_name,
             output_dir=output_dir,
             source_file=source_file,
-            backup_on_change=backup_on_change
+            backup_on_change=backup_on_change,
+            paranoid=paranoid,
+            hash_algorithm=task_config.get("hash_algorithm", DEFAULT_ALGORITHM),
         )
     
+    elif task_type == "multi_file":
+        # MultiFileTask
+        sources = _resolve_value(task_config.get("sources"), variables)
+
+        if not sources:
+            raise ValueError("MultiFileTask 配置缺少 sources")
+
+        return MultiFileTask(
+            task_name=task_name,
+            output_dir=output_dir,
+            sources=sources,
+            bundle=task_config.get("bundle", False),
+            hash_workers=task_config.get("hash_workers", 4),
+            paranoid=task_config.get("paranoid", False),
+            hash_algorithm=task_config.get("hash_algorithm", DEFAULT_ALGORITHM),
+        )
+
     else:
         raise ValueError(f"不支持的任务类型: {task_type}")
 
@@ -463,6 +695,16 @@ def _create_uploader_from_config(uploader_config: dict, variables: dict = None):
             endpoint=endpoint,
             bucket_name=bucket_name,
             use_temp_object=use_temp_object,
+            max_connections=uploader_config.get("max_connections", 1),
+            multipart_threshold=uploader_config.get("multipart_threshold", MULTIPART_THRESHOLD),
+            part_size=uploader_config.get("part_size", PART_SIZE),
+            part_workers=uploader_config.get("part_workers", 4),
+            checkpoint_dir=_resolve_value(uploader_config.get("checkpoint_dir"), variables),
+            retries=uploader_config.get("retries", 3),
+            atomic_commit=uploader_config.get("atomic_commit", False),
+            stale_upload_age=uploader_config.get("stale_upload_age", STALE_UPLOAD_AGE),
+            stale_upload_prefix=_resolve_value(uploader_config.get("stale_upload_prefix", ""),
+                                               variables),
         )
     
     elif uploader_type == "ftp":
@@ -484,7 +726,9 @@ def _create_uploader_from_config(uploader_config: dict, variables: dict = None):
             username=username,
             password=password,
             secure=secure,
-            passive=passive
+            passive=passive,
+            max_connections=uploader_config.get("max_connections", 1),
+            idle_timeout=uploader_config.get("idle_timeout", 60),
         )
     
     else:
@@ -0,0 +1,334 @@
+"""
+归档流式处理：归档字节流在产生的同时写入文件、计算 SHA-256 并校验完整性，
+输出只写一次，不再为校验和摘要重复读取整个归档。
+"""
+
+
+import hashlib
+import queue
+import subprocess
+import threading
+import time
+import zlib
+
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+TAR_BLOCK_SIZE = 512
+_ZERO_BLOCK = bytes(TAR_BLOCK_SIZE)
+# 这些类型的成员后面不跟数据块（与 tarfile 的处理一致）
+_NO_DATA_TYPES = (b"1", b"2", b"3", b"4", b"5", b"6")
+# 单次解压输出上限，避免高压缩比数据一次性膨胀占用大量内存
+_DECOMPRESS_LIMIT = 4 * 1024 * 1024
+
+
+class TarStreamVerifier():
+    """
+    流式 tar 结构校验器，作用相当于 ``tar -t``。
+
+    逐个解析 512 字节头部，校验头部校验和，并按成员长度跳过数据块；
+    结束时要求数据完整且存在结束标记。
+    """
+
+    def __init__(self):
+        self._header = bytearray()
+        self._skip = 0
+        self._end_blocks = 0
+        self.member_count = 0
+
+    def feed(self, data: bytes):
+        """送入一段未压缩的 tar 数据。"""
+        view = memoryview(data)
+        pos = 0
+        total = len(view)
+        while pos < total:
+            if self._skip:
+                step = min(self._skip, total - pos)
+                self._skip -= step
+                pos += step
+                continue
+            take = min(TAR_BLOCK_SIZE - len(self._header), total - pos)
+            self._header += view[pos:pos + take]
+            pos += take
+            if len(self._header) == TAR_BLOCK_SIZE:
+                self._parse_header(bytes(self._header))
+                self._header.clear()
+
+    def finish(self):
+        """确认 tar 数据流已完整结束。"""
+        if self._skip or self._header:
+            raise ValueError("tar 数据不完整")
+        if not self._end_blocks:
+            raise ValueError("tar 缺少结束标记")
+
+    def _parse_header(self, block: bytes):
+        if block == _ZERO_BLOCK:
+            self._end_blocks += 1
+            return
+        if self._end_blocks:
+            raise ValueError("tar 结束标记之后仍有数据")
+        expected = self._parse_number(block[148:156])
+        actual = sum(block[:148]) + 8 * 0x20 + sum(block[156:])
+        if expected != actual:
+            raise ValueError("tar 头部校验和错误（第 {} 个成员）".format(self.member_count + 1))
+        size = self._parse_number(block[124:136])
+        if block[156:157] not in _NO_DATA_TYPES:
+            self._skip = (size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * TAR_BLOCK_SIZE
+        self.member_count += 1
+
+    @staticmethod
+    def _parse_number(field: bytes) -> int:
+        if field[0] & 0x80:
+            # GNU base-256 编码，用于超过 8 GiB 的成员
+            value = field[0] & 0x7F
+            for byte in field[1:]:
+                value = (value << 8) | byte
+            return value
+        text = field.rstrip(b"\0 ").lstrip(b" ")
+        if not text:
+            return 0
+        try:
+            return int(text, 8)
+        except ValueError:
+            raise ValueError("tar 头部数字字段格式错误: {!r}".format(field)) from None
+
+
+class GzipStreamVerifier():
+    """
+    流式 gzip 校验器。支持多成员 gzip，解压结果交给下一级校验器（通常是 tar）。
+    gzip 尾部的 CRC32 和长度由 zlib 负责校验。
+    """
+
+    def __init__(self, inner=None):
+        self._inner = inner
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started = False
+        self._members = 0
+
+    def feed(self, data: bytes):
+        """送入一段压缩数据。"""
+        while data:
+            self._started = True
+            out = self._decompressor.decompress(data, _DECOMPRESS_LIMIT)
+            self._emit(out)
+            while (len(out) == _DECOMPRESS_LIMIT and not self._decompressor.eof
+                   and not self._decompressor.unconsumed_tail):
+                # 输入已消耗完但输出可能仍有剩余，继续取出
+                out = self._decompressor.decompress(b"", _DECOMPRESS_LIMIT)
+                self._emit(out)
+            if self._decompressor.eof:
+                self._members += 1
+                data = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._started = False
+            else:
+                data = self._decompressor.unconsumed_tail
+
+    def _emit(self, out: bytes):
+        if out and self._inner is not None:
+            self._inner.feed(out)
+
+    def finish(self):
+        """确认 gzip 数据流已完整结束。"""
+        if self._started or not self._members:
+            raise ValueError("gzip 数据不完整")
+        if self._inner is not None:
+            self._inner.finish()
+
+
+class ArchiveStreamWriter():
+    """
+    归档流写入器。
+
+    每个数据块写入目标文件、更新 SHA-256，并交给后台线程中的校验器；
+    校验器队列有上限，内存占用与归档大小无关。
+
+    参数:
+        file_obj  已打开的二进制输出文件
+        verifier  流式校验器（提供 feed/finish），为 None 时不校验
+    """
+
+    def __init__(self, file_obj, verifier=None, queue_size: int = 8):
+        self._file = file_obj
+        self._digest = hashlib.sha256()
+        self._verifier = verifier
+        self._error = None
+        self._queue = None
+        self._thread = None
+        self.bytes_written = 0
+        if verifier is not None:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(
+                target=self._verify_loop, name="archive-verifier", daemon=True)
+            self._thread.start()
+
+    def _verify_loop(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self._verifier.feed(chunk)
+            except Exception as exc:
+                self._error = exc
+        if self._error is None:
+            try:
+                self._verifier.finish()
+            except Exception as exc:
+                self._error = exc
+
+    def write(self, chunk: bytes):
+        """写入一段归档数据。"""
+        if self._error is not None:
+            raise ValueError("归档完整性校验失败: {}".format(self._error))
+        self._digest.update(chunk)
+        self._file.write(chunk)
+        self.bytes_written += len(chunk)
+        if self._queue is not None:
+            self._queue.put(chunk)
+
+    def finish(self) -> str:
+        """
+        结束写入并等待校验完成。
+        返回值: SHA-256 十六进制摘要；校验失败时抛出 ValueError。
+        """
+        self._stop_verifier()
+        if self._error is not None:
+            raise ValueError("归档完整性校验失败: {}".format(self._error))
+        return self._digest.hexdigest()
+
+    def abort(self):
+        """放弃写入，停止后台校验线程。"""
+        if self._error is None:
+            self._error = RuntimeError("写入已中止")
+        self._stop_verifier()
+
+    def _stop_verifier(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def copy_stream(source, writer, chunk_size: int = STREAM_CHUNK_SIZE) -> int:
+    """
+    把 source 中的数据全部读出并写入 writer。
+    返回值: 复制的字节数。
+    """
+    total = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        writer.write(chunk)
+        total += len(chunk)
+    return total
+
+
+class ArchiveStats():
+    """
+    一次流式归档的结果及吞吐统计。
+
+    参数:
+        digest  输出的 SHA-256 十六进制摘要
+        raw_bytes  压缩前字节数，由外部命令自行压缩时无法得知，为 None
+        output_bytes  输出字节数
+        seconds  耗时（秒）
+    """
+
+    def __init__(self, digest: str, raw_bytes, output_bytes: int, seconds: float):
+        self.digest = digest
+        self.raw_bytes = raw_bytes
+        self.output_bytes = output_bytes
+        self.seconds = seconds
+
+    def ratio(self):
+        """压缩后/压缩前的比例，未知时为 None。"""
+        if not self.raw_bytes:
+            return None
+        return self.output_bytes / self.raw_bytes
+
+    def throughput(self) -> float:
+        """按压缩前字节数（未知时按输出字节数）计算的 MiB/s。"""
+        size = self.raw_bytes if self.raw_bytes is not None else self.output_bytes
+        return size / (1024 * 1024) / max(self.seconds, 1e-6)
+
+    def describe(self) -> str:
+        """用于日志的统计描述。"""
+        ratio = self.ratio()
+        return "原始 {} 字节，输出 {} 字节，压缩率 {}，耗时 {:.2f}s，吞吐 {:.1f} MiB/s".format(
+            "未知" if self.raw_bytes is None else self.raw_bytes,
+            self.output_bytes,
+            "未知" if ratio is None else "{:.1%}".format(ratio),
+            self.seconds, self.throughput())
+
+
+class CompressingWriter():
+    """
+    把原始数据交给压缩器，再把压缩结果写入下一级 writer。
+
+    参数:
+        compressor  提供 compress/flush/close 的流式压缩器
+        writer  下一级 writer
+    """
+
+    def __init__(self, compressor, writer):
+        self._compressor = compressor
+        self._writer = writer
+        self.raw_bytes = 0
+
+    def write(self, data: bytes):
+        """写入一段原始数据。"""
+        self.raw_bytes += len(data)
+        for block in self._compressor.compress(data):
+            self._writer.write(block)
+
+    def finish(self):
+        """输出压缩器中剩余的数据。"""
+        for block in self._compressor.flush():
+            self._writer.write(block)
+
+
+def stream_command_to_file(command: list, cwd, output_file, stderr_file,
+                           compressor=None, verifier=None) -> ArchiveStats:
+    """
+    运行 command，把其标准输出（可选经过 compressor 压缩）一次性写入 output_file，
+    同时计算摘要并由 verifier 校验。命令失败时抛出 subprocess.CalledProcessError。
+
+    参数:
+        command  产生归档数据的命令参数列表
+        cwd  命令运行目录
+        output_file  已打开的二进制输出文件
+        stderr_file  命令 stderr 输出文件
+        compressor  流式压缩器，为 None 时直接写入命令输出
+        verifier  流式校验器，为 None 时不校验
+    返回值: ArchiveStats
+    """
+    start = time.monotonic()
+    writer = ArchiveStreamWriter(output_file, verifier)
+    process = None
+    finished = False
+    try:
+        process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=stderr_file)
+        target = writer if compressor is None else CompressingWriter(compressor, writer)
+        copy_stream(process.stdout, target)
+        returncode = process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        if compressor is not None:
+            target.finish()
+        digest = writer.finish()
+        finished = True
+    finally:
+        if not finished:
+            writer.abort()
+        if compressor is not None:
+            compressor.close()
+        if process is not None:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    raw_bytes = None if compressor is None else target.raw_bytes
+    return ArchiveStats(digest, raw_bytes, writer.bytes_written, time.monotonic() - start)
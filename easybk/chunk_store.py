@@ -0,0 +1,578 @@
+"""
+去重块存储：pack 任务的 tar 数据流按内容切块（见 chunking 模块），只保存之前没有
+出现过的数据块，每次备份只生成一个很小的快照清单。多个任务可以共用同一个存储，
+相同的文件（例如多个站点共用的 vendor 目录）只保存一次。
+
+目录结构::
+
+    index.sqlite               数据块索引：摘要 -> (pack, offset, length, raw_length, refs)
+    store.lock                 进程间锁：写入器持有共享锁，gc 需要独占锁
+    packs/pack-<id>.pack       数据块文件，只追加写入；块单独压缩，块之间没有分隔
+    snapshots/<名称>.json      快照清单：按顺序列出 tar 数据流的全部数据块及其位置
+
+索引使用 SQLite（WAL，WITHOUT ROWID 表，主键为 32 字节摘要），几千万个数据块时仍能
+快速查询，批量查询和写入都在单个事务中完成。快照提交时增加所引用数据块的引用计数，
+删除快照时减少；gc 删除引用计数为 0 的数据块，删除空的 pack 文件并重写有效数据不足
+一半的 pack 文件。pack 编号永不复用，已上传到远端的 pack 文件名始终指向相同的内容。
+其他进程（包括 easybk-chunks gc）有写入器正在写入时 gc 跳过。
+
+恢复（安装后提供 easybk-chunks 命令）::
+
+    easybk-chunks restore <snapshot.json> --packs <pack 目录> -o backup.tar
+"""
+
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import zlib
+
+from .chunking import ContentChunker
+from .state_store import _atomic_write
+
+
+STORE_INDEX_NAME = "index.sqlite"
+STORE_LOCK_NAME = "store.lock"
+PACK_DIR_NAME = "packs"
+SNAPSHOT_DIR_NAME = "snapshots"
+SNAPSHOT_VERSION = 1
+
+STORE_CHUNK_MIN_SIZE = 4 * 1024
+STORE_CHUNK_MAX_SIZE = 256 * 1024
+STORE_CHUNK_MASK = 0x1F
+# 当前 pack 文件超过该大小后写入新的 pack 文件
+PACK_TARGET_SIZE = 64 * 1024 * 1024
+# gc 时有效数据低于该比例的 pack 文件会被重写
+GC_REWRITE_RATIO = 0.5
+# 单条 SQL 中最多的参数个数
+_SQL_BATCH = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    hash BLOB PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    raw_length INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    created TEXT NOT NULL,
+    raw_bytes INTEGER NOT NULL,
+    chunk_count INTEGER NOT NULL
+);
+"""
+
+
+def pack_name(pack_id: int) -> str:
+    """pack 文件名。"""
+    return "pack-{:08d}.pack".format(pack_id)
+
+
+def store_key(chunk) -> bytes:
+    """数据块在存储中的键：32 字节 BLAKE2b 摘要。"""
+    return hashlib.blake2b(chunk, digest_size=32).digest()
+
+
+def _batches(items: list):
+    for start in range(0, len(items), _SQL_BATCH):
+        yield items[start:start + _SQL_BATCH]
+
+
+def _decode_chunk(data: bytes, key: bytes, raw_length: int) -> bytes:
+    if len(data) < raw_length:
+        data = zlib.decompress(data)
+    if store_key(data) != key:
+        raise ValueError("数据块校验失败: {}".format(key.hex()))
+    return data
+
+
+class _PackReader():
+    """按需打开 pack 文件读取数据块，同一时间只保持一个文件打开。"""
+
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        self._name = None
+        self._file = None
+
+    def read_raw(self, name: str, offset: int, length: int) -> bytes:
+        """读取 pack 文件中保存的原始字节（可能是压缩的）。"""
+        if name != self._name:
+            self.close()
+            self._file = open(os.path.join(self.pack_dir, name), "rb")
+            self._name = name
+        self._file.seek(offset)
+        data = self._file.read(length)
+        if len(data) != length:
+            raise ValueError("pack 文件不完整: {}".format(name))
+        return data
+
+    def read(self, name: str, key: bytes, offset: int, length: int, raw_length: int) -> bytes:
+        """读取并校验数据块。"""
+        return _decode_chunk(self.read_raw(name, offset, length), key, raw_length)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._name = None
+
+
+def restore_snapshot(manifest: dict, pack_dir: str, output) -> int:
+    """
+    按快照清单中记录的位置从 pack 文件恢复 tar 数据流，不需要索引，
+    适用于从远端下载的快照包。
+
+    参数:
+        manifest  快照清单
+        pack_dir  pack 文件所在目录
+        output  二进制输出文件
+    返回值: 恢复的字节数；数据块或整体摘要校验失败时抛出 ValueError
+    """
+    packs = manifest["packs"]
+    reader = _PackReader(pack_dir)
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        for key, pack_id, offset, length, raw_length in manifest["chunks"]:
+            data = reader.read(packs[str(pack_id)], bytes.fromhex(key), offset, length,
+                               raw_length)
+            digest.update(data)
+            output.write(data)
+            written += len(data)
+    finally:
+        reader.close()
+    if digest.hexdigest() != manifest["sha256"]:
+        raise ValueError("恢复结果校验失败")
+    return written
+
+
+class ChunkStore():
+    """
+    本地去重块存储，线程安全。同一目录请通过 ChunkStore.open 获取共享的实例。
+
+    参数:
+        path  存储目录
+        compress_level  数据块的 zlib 压缩级别，压缩后不变小的块原样保存
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str, compress_level: int = 6):
+        self.logger = logging.getLogger("ChunkStore")
+        self.path = path
+        self.pack_dir = os.path.join(path, PACK_DIR_NAME)
+        self.snapshot_dir = os.path.join(path, SNAPSHOT_DIR_NAME)
+        self.compress_level = compress_level
+        self._lock = threading.RLock()
+        self._db = None
+        self._writers = 0
+        self._lock_fd = None
+
+    @classmethod
+    def open(cls, path: str) -> "ChunkStore":
+        """返回目录对应的共享实例，多个任务使用同一个存储时共用索引连接和锁。"""
+        key = os.path.realpath(path)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(path)
+            return cls._instances[key]
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.pack_dir, exist_ok=True)
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.path, STORE_INDEX_NAME),
+                                 check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(_SCHEMA)
+            self._db = db
+        return self._db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def _store_lock(self) -> int:
+        """
+        进程间锁文件的描述符。flock 锁属于打开的文件，本实例的所有写入器共用一个
+        共享锁，其他进程（或另外创建的实例）的 gc 无法取得独占锁。
+        """
+        if self._lock_fd is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._lock_fd = os.open(os.path.join(self.path, STORE_LOCK_NAME),
+                                    os.O_RDWR | os.O_CREAT, 0o644)
+        return self._lock_fd
+
+    def close(self):
+        """关闭索引连接。"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            if self._lock_fd is not None and not self._writers:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    def writer(self, verifier=None) -> "SnapshotWriter":
+        """
+        创建快照写入器，见 SnapshotWriter，使用完毕后必须调用其 release。
+        第一个写入器取得进程间共享锁，其他进程正在 gc 时等待其完成。
+        """
+        with self._lock:
+            self._connect()
+            if not self._writers:
+                fcntl.flock(self._store_lock(), fcntl.LOCK_SH)
+            self._writers += 1
+        return SnapshotWriter(self, verifier)
+
+    def _release(self):
+        with self._lock:
+            self._writers -= 1
+            if not self._writers:
+                fcntl.flock(self._store_lock(), fcntl.LOCK_UN)
+
+    def _known(self, keys: list) -> set:
+        """返回 keys 中已经存在于索引中的键。"""
+        found = set()
+        with self._lock:
+            db = self._connect()
+            for batch in _batches(keys):
+                found.update(row[0] for row in db.execute(
+                    "SELECT hash FROM chunks WHERE hash IN ({})".format(
+                        ",".join("?" * len(batch))), batch))
+        return found
+
+    def _new_pack(self) -> int:
+        with self._transaction() as db:
+            return db.execute("INSERT INTO packs (size) VALUES (0)").lastrowid
+
+    def _locate(self, db, keys: list) -> dict:
+        locations = {}
+        for batch in _batches(keys):
+            for row in db.execute(
+                    "SELECT hash, pack, offset, length, raw_length FROM chunks "
+                    "WHERE hash IN ({})".format(",".join("?" * len(batch))), batch):
+                locations[row[0]] = row[1:]
+        return locations
+
+    def snapshot_path(self, name: str) -> str:
+        """快照清单文件路径。"""
+        return os.path.join(self.snapshot_dir, name + ".json")
+
+    def commit_snapshot(self, writer: "SnapshotWriter", task: str, name: str) -> dict:
+        """
+        写入器 flush 之后调用：把新数据块加入索引、增加引用计数并保存快照清单。
+        返回值: 快照清单
+        """
+        keys = sorted(set(writer.keys))
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO chunks (hash, pack, offset, length, raw_length) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((key,) + location for key, location in writer.pending.items()))
+            db.executemany("UPDATE packs SET size = ? WHERE id = ?",
+                           ((size, pack_id) for pack_id, size in writer.pack_sizes.items()))
+            for batch in _batches(keys):
+                db.execute("UPDATE chunks SET refs = refs + 1 WHERE hash IN ({})".format(
+                    ",".join("?" * len(batch))), batch)
+            locations = self._locate(db, keys)
+            if len(locations) != len(keys):
+                raise ValueError("快照引用的数据块不在索引中")
+            created = datetime.datetime.now().isoformat(timespec="seconds")
+            db.execute("INSERT INTO snapshots (name, task, created, raw_bytes, chunk_count) "
+                       "VALUES (?, ?, ?, ?, ?)",
+                       (name, task, created, writer.raw_bytes, len(writer.keys)))
+            manifest = {
+                "version": SNAPSHOT_VERSION,
+                "name": name,
+                "task": task,
+                "created": created,
+                "sha256": writer.digest,
+                "raw_bytes": writer.raw_bytes,
+                "packs": {str(location[0]): pack_name(location[0])
+                          for location in locations.values()},
+                "chunks": [[key.hex()] + list(locations[key]) for key in writer.keys],
+            }
+            _atomic_write(self.snapshot_path(name),
+                          lambda fh: json.dump(manifest, fh, separators=(",", ":")))
+        return manifest
+
+    def load_snapshot(self, name: str) -> dict:
+        """读取快照清单。"""
+        with open(self.snapshot_path(name), "r", encoding="utf-8") as fh:
+            return json.load(fh)
+
+    def snapshots(self, task: str) -> list:
+        """任务的快照名称，按创建顺序排列。"""
+        with self._lock:
+            return [row[0] for row in self._connect().execute(
+                "SELECT name FROM snapshots WHERE task = ? ORDER BY created, name", (task,))]
+
+    def drop_snapshot(self, name: str):
+        """删除快照并减少其引用的数据块的引用计数，数据块由 gc 回收。"""
+        keys = sorted({bytes.fromhex(entry[0]) for entry in self.load_snapshot(name)["chunks"]})
+        with self._transaction() as db:
+            for batch in _batches(keys):
+                db.execute("UPDATE chunks SET refs = refs - 1 WHERE hash IN ({})".format(
+                    ",".join("?" * len(batch))), batch)
+            db.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+        os.remove(self.snapshot_path(name))
+
+    def prune(self, task: str, keep: int) -> list:
+        """只保留任务最近的 keep 个快照，返回删除的快照名称。"""
+        dropped = self.snapshots(task)[:-keep] if keep > 0 else []
+        for name in dropped:
+            self.drop_snapshot(name)
+        return dropped
+
+    def gc(self):
+        """
+        回收引用计数为 0 的数据块：删除不再有有效数据的 pack 文件，重写有效数据不足
+        GC_REWRITE_RATIO 的 pack 文件。本进程或其他进程有写入器正在写入时跳过：
+        写入中的 pack 文件还没有加入索引，已复用的数据块也还没有增加引用计数。
+        返回值: 统计字典；跳过时返回 None
+        """
+        with self._lock:
+            if self._writers:
+                self.logger.info("块存储 [%s] 正在写入，跳过 gc", self.path)
+                return None
+            try:
+                fcntl.flock(self._store_lock(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.logger.info("块存储 [%s] 正在被其他进程写入，跳过 gc", self.path)
+                return None
+            try:
+                removed, empty, sparse, rewritten = self._collect()
+            finally:
+                fcntl.flock(self._store_lock(), fcntl.LOCK_UN)
+        stats = {"chunks_removed": removed, "packs_removed": len(empty) + len(sparse),
+                 "bytes_rewritten": rewritten}
+        self.logger.info("块存储 [%s] gc：删除 %s 个数据块、%s 个 pack 文件，重写 %s 字节",
+                         self.path, removed, stats["packs_removed"], rewritten)
+        return stats
+
+    def _collect(self):
+        """
+        gc 的实际工作，调用方持有独占锁。
+        返回值: (删除的数据块数, 删除的空 pack, 重写的 pack, 重写的字节数)
+        """
+        with self._transaction() as db:
+            removed = db.execute("DELETE FROM chunks WHERE refs <= 0").rowcount
+            live = {row[0]: row[1] for row in db.execute(
+                "SELECT pack, SUM(length) FROM chunks GROUP BY pack")}
+            packs = db.execute("SELECT id, size FROM packs").fetchall()
+            empty = [pack_id for pack_id, _ in packs if pack_id not in live]
+            sparse = [pack_id for pack_id, size in packs
+                      if pack_id in live and live[pack_id] < size * GC_REWRITE_RATIO]
+            rewritten = self._rewrite(db, sparse) if sparse else 0
+            for pack_id in empty + sparse:
+                db.execute("DELETE FROM packs WHERE id = ?", (pack_id,))
+        for pack_id in empty + sparse:
+            path = os.path.join(self.pack_dir, pack_name(pack_id))
+            if os.path.exists(path):
+                os.remove(path)
+        return removed, empty, sparse, rewritten
+
+    def _rewrite(self, db, pack_ids: list) -> int:
+        """把 pack_ids 中仍然有效的数据块复制到新的 pack 文件，返回复制的字节数。"""
+        new_id = db.execute("INSERT INTO packs (size) VALUES (0)").lastrowid
+        rows = db.execute(
+            "SELECT hash, pack, offset, length, raw_length FROM chunks WHERE pack IN ({}) "
+            "ORDER BY pack, offset".format(",".join("?" * len(pack_ids))), pack_ids).fetchall()
+        reader = _PackReader(self.pack_dir)
+        moved = []
+        offset = 0
+        try:
+            with open(os.path.join(self.pack_dir, pack_name(new_id)), "wb") as output:
+                for key, pack_id, old_offset, length, _ in rows:
+                    output.write(reader.read_raw(pack_name(pack_id), old_offset, length))
+                    moved.append((new_id, offset, key))
+                    offset += length
+                output.flush()
+                os.fsync(output.fileno())
+        finally:
+            reader.close()
+        db.executemany("UPDATE chunks SET pack = ?, offset = ? WHERE hash = ?", moved)
+        db.execute("UPDATE packs SET size = ? WHERE id = ?", (offset, new_id))
+        return offset
+
+    def restore(self, name: str, output) -> int:
+        """按索引中的当前位置恢复本地快照的 tar 数据流，返回恢复的字节数。"""
+        manifest = self.load_snapshot(name)
+        keys = sorted({bytes.fromhex(entry[0]) for entry in manifest["chunks"]})
+        with self._lock:
+            locations = self._locate(self._connect(), keys)
+        manifest["packs"] = {}
+        chunks = []
+        for entry in manifest["chunks"]:
+            location = locations.get(bytes.fromhex(entry[0]))
+            if location is None:
+                raise ValueError("数据块已被回收: {}".format(entry[0]))
+            manifest["packs"][str(location[0])] = pack_name(location[0])
+            chunks.append([entry[0]] + list(location))
+        manifest["chunks"] = chunks
+        return restore_snapshot(manifest, self.pack_dir, output)
+
+
+class SnapshotWriter():
+    """
+    把 tar 数据流切块写入块存储，接口与流式压缩器相同（compress/flush/close），可以直接
+    交给 stream_command_to_file；不产生输出。已存在的数据块只记录引用，新数据块追加到
+    本写入器独占的 pack 文件，flush 时 fsync，由 ChunkStore.commit_snapshot 加入索引。
+
+    参数:
+        store  块存储
+        verifier  对原始数据流的校验器（如 TarStreamVerifier），为 None 时不校验
+    """
+
+    def __init__(self, store: ChunkStore, verifier=None):
+        self.store = store
+        self.verifier = verifier
+        self._chunker = ContentChunker(STORE_CHUNK_MIN_SIZE, STORE_CHUNK_MAX_SIZE,
+                                       STORE_CHUNK_MASK)
+        self._digest = hashlib.sha256()
+        self._pack_id = None
+        self._pack_file = None
+        self._released = False
+        self.keys = []
+        self.pending = {}
+        self.pack_sizes = {}
+        self.raw_bytes = 0
+        self.new_bytes = 0
+        self.stored_bytes = 0
+        self.digest = None
+
+    def compress(self, data: bytes) -> list:
+        """送入一段 tar 数据。"""
+        self._digest.update(data)
+        self.raw_bytes += len(data)
+        if self.verifier is not None:
+            self.verifier.feed(data)
+        self._add(self._chunker.feed(data))
+        return []
+
+    def flush(self) -> list:
+        """数据结束：写出剩余数据块并把 pack 文件落盘。"""
+        self._add(self._chunker.finish())
+        if self.verifier is not None:
+            self.verifier.finish()
+        self.digest = self._digest.hexdigest()
+        self._close_pack()
+        return []
+
+    def close(self):
+        """关闭 pack 文件。"""
+        self._close_pack()
+
+    def release(self):
+        """
+        快照提交或放弃之后调用：写入器计数归零前 gc 会跳过，避免回收本次
+        已复用但尚未提交引用的数据块。未提交的 pack 文件由之后的 gc 删除。
+        """
+        self.close()
+        if not self._released:
+            self._released = True
+            self.store._release()
+
+    def _add(self, chunks: list):
+        if not chunks:
+            return
+        keys = [store_key(chunk) for chunk in chunks]
+        known = self.store._known([key for key in set(keys) if key not in self.pending])
+        for chunk, key in zip(chunks, keys):
+            self.keys.append(key)
+            if key in known or key in self.pending:
+                continue
+            data = zlib.compress(chunk, self.store.compress_level)
+            if len(data) >= len(chunk):
+                data = chunk
+            if self._pack_file is None or self.pack_sizes[self._pack_id] >= PACK_TARGET_SIZE:
+                self._open_pack()
+            offset = self.pack_sizes[self._pack_id]
+            self._pack_file.write(data)
+            self.pack_sizes[self._pack_id] = offset + len(data)
+            self.pending[key] = (self._pack_id, offset, len(data), len(chunk))
+            self.new_bytes += len(chunk)
+            self.stored_bytes += len(data)
+
+    def _open_pack(self):
+        self._close_pack()
+        self._pack_id = self.store._new_pack()
+        self._pack_file = open(os.path.join(self.store.pack_dir, pack_name(self._pack_id)), "wb")
+        self.pack_sizes[self._pack_id] = 0
+
+    def _close_pack(self):
+        if self._pack_file is not None:
+            self._pack_file.flush()
+            os.fsync(self._pack_file.fileno())
+            self._pack_file.close()
+            self._pack_file = None
+
+    def describe(self) -> str:
+        """用于日志的统计描述。"""
+        return "数据流 {} 字节，{} 个数据块，新增 {} 字节（压缩后 {} 字节），复用 {:.1%}".format(
+            self.raw_bytes, len(self.keys), self.new_bytes, self.stored_bytes,
+            1 - self.new_bytes / max(self.raw_bytes, 1))
+
+
+def main(argv=None) -> int:
+    """命令行入口：恢复快照、回收存储空间。"""
+    parser = argparse.ArgumentParser(prog="easybk-chunks", description="去重块存储工具")
+    commands = parser.add_subparsers(dest="command", required=True)
+    restore_parser = commands.add_parser("restore", help="由快照清单和 pack 文件恢复 tar 归档")
+    restore_parser.add_argument("snapshot", help="快照清单（snapshot.json）")
+    restore_parser.add_argument("--packs", required=True, help="pack 文件所在目录")
+    restore_parser.add_argument("-o", "--output", required=True, help="恢复出的 .tar 文件")
+    gc_parser = commands.add_parser("gc", help="回收不再被快照引用的数据块")
+    gc_parser.add_argument("store", help="块存储目录")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logger = logging.getLogger("ChunkStore")
+    try:
+        if args.command == "gc":
+            ChunkStore(args.store).gc()
+            return 0
+        with open(args.snapshot, "r", encoding="utf-8") as fh:
+            manifest = json.load(fh)
+        temp_path = args.output + ".part"
+        try:
+            with open(temp_path, "wb") as output:
+                size = restore_snapshot(manifest, args.packs, output)
+            os.replace(temp_path, args.output)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    except (OSError, ValueError, sqlite3.Error) as exc:
+        logger.error("%s 失败: %s", args.command, exc)
+        return 1
+    logger.info("已恢复 %s 字节到 %s", size, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+基于内容的切块（content-defined chunking）。
+
+候选切分点是锚点（如换行）之后的位置，两个相邻锚点之间的数据段（不含锚点）的 CRC32
+与 mask 按位与为 0 时在该锚点之后切分。切分位置只取决于附近的内容，插入或删除数据
+后，其后的切分位置不变，相同的内容会得到相同的数据块。块长度限制在
+[min_size, max_size]，没有锚点的数据（如连续的 0）按 max_size 切分。
+
+锚点是固定的字节串，每次 feed 用 bytes.split 一次找出缓冲区中全部锚点，并批量计算
+各数据段的 CRC32，逐个锚点的 Python 循环只剩下按块的二分查找。
+"""
+
+
+import hashlib
+import zlib
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, compress
+from operator import not_, sub
+
+
+NEWLINE_ANCHOR = (b"\n",)
+
+
+def chunk_hash(chunk) -> str:
+    """数据块摘要（十六进制），用于匹配相同的数据块。"""
+    return hashlib.blake2b(chunk, digest_size=16).hexdigest()
+
+
+def _split_segments(data, anchors: tuple, segments: list, separators: list, last: int):
+    """
+    按锚点把 data 切为数据段，追加到 segments，并在 separators 中追加每段之后的锚点
+    长度。先按第一个锚点切分，每一段再按其余锚点切分；data 最后一段之后的锚点长度为 last。
+    """
+    anchor = anchors[0]
+    pieces = data.split(anchor)
+    if len(anchors) == 1:
+        segments.extend(pieces)
+        separators.extend([len(anchor)] * (len(pieces) - 1))
+        separators.append(last)
+        return
+    for piece in pieces[:-1]:
+        _split_segments(piece, anchors[1:], segments, separators, len(anchor))
+    _split_segments(pieces[-1], anchors[1:], segments, separators, last)
+
+
+class ContentChunker():
+    """
+    流式切块器。
+
+    参数:
+        min_size  最小块长度，锚点的起始位置距块首不少于 min_size 时才是候选切分点
+        max_size  最大块长度
+        mask  切分条件，锚点之前数据段的 CRC32 与 mask 按位与为 0 时切分，决定平均块长度
+        anchors  锚点字节串的元组，各锚点之间不能互相包含
+    """
+
+    def __init__(self, min_size: int, max_size: int, mask: int, anchors: tuple = NEWLINE_ANCHOR):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self.anchors = anchors
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        """送入一段数据，返回已经确定的数据块。"""
+        self._buffer += data
+        if len(self._buffer) < self.max_size:
+            return []
+        return self._cut_all(final=False)
+
+    def finish(self) -> list:
+        """数据结束，返回剩余的数据块。"""
+        if not self._buffer:
+            return []
+        return self._cut_all(final=True)
+
+    def _cut_all(self, final: bool) -> list:
+        """
+        切出缓冲区中能够确定的数据块，剩余数据留在缓冲区。数据不足 max_size 的块要等
+        后面的数据（final 为 False 时），下次 feed 从块首重新扫描，结果与一次送入相同。
+        """
+        buffer = self._buffer
+        segments = []
+        separators = []
+        _split_segments(buffer, self.anchors, segments, separators, 0)
+        # 最后一段之后没有锚点，不是候选切分点
+        segments.pop()
+        separators.pop()
+        # ends 是锚点结束（候选切分点）的位置，starts 是锚点起始的位置
+        ends = list(accumulate(map(int.__add__, map(len, segments), separators)))
+        starts = list(map(sub, ends, separators))
+        mask = self.mask
+        hits = list(compress(range(len(ends)),
+                             map(not_, map(mask.__and__, map(zlib.crc32, segments)))))
+
+        chunks = []
+        size = len(buffer)
+        start = 0
+        with memoryview(buffer) as view:
+            while start < size:
+                limit = start + self.max_size
+                if limit > size:
+                    if not final:
+                        break
+                    limit = size
+                cut = limit
+                first = bisect_left(starts, start + self.min_size)
+                if first < len(ends) and ends[first] <= limit:
+                    if first and ends[first - 1] >= start:
+                        hit = bisect_left(hits, first)
+                    # 块内第一个锚点之前的数据段从块首算起
+                    elif not zlib.crc32(view[start:starts[first]]) & mask:
+                        hit = None
+                        cut = ends[first]
+                    else:
+                        hit = bisect_right(hits, first)
+                    if hit is not None and hit < len(hits) and ends[hits[hit]] <= limit:
+                        cut = ends[hits[hit]]
+                chunks.append(bytes(view[start:cut]))
+                start = cut
+        del buffer[:start]
+        return chunks
+
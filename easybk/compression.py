@@ -0,0 +1,409 @@
+"""
+归档压缩引擎。
+
+- ``gzip``：由 tar 自带的 gzip 压缩，单核（默认）。
+- ``parallel_gzip``：按块并行压缩，每块是一个独立的 gzip 成员，多成员 gzip 可被
+  ``tar xzf``/``gzip -d`` 直接解压。
+- ``zstd``：zstandard 多线程压缩，需要安装 ``zstandard``。
+
+压缩策略 ``adaptive``（仅 ``parallel_gzip``）：每块先试压几段采样，压缩收益很小
+（如 JPEG/PNG/PDF 等已压缩内容）时以不压缩的 gzip 成员（deflate 存储块）写出，
+仍可被 ``tar xzf`` 直接解压。
+"""
+
+
+import collections
+import gzip
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .archive_stream import _DECOMPRESS_LIMIT, GzipStreamVerifier
+
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_PARALLEL_GZIP = "parallel_gzip"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_PARALLEL_GZIP, COMPRESSION_ZSTD)
+# 各压缩方式支持的压缩级别范围（含两端）
+# gzip 由 tar 调用 gzip 命令压缩，不支持级别 0
+COMPRESS_LEVELS = {
+    COMPRESSION_GZIP: (1, 9),
+    COMPRESSION_PARALLEL_GZIP: (0, 9),
+    COMPRESSION_ZSTD: (1, 22),
+}
+
+PARALLEL_GZIP_BLOCK_SIZE = 1024 * 1024
+
+COMPRESSION_POLICY_ALWAYS = "always"
+COMPRESSION_POLICY_ADAPTIVE = "adaptive"
+COMPRESSION_POLICIES = (COMPRESSION_POLICY_ALWAYS, COMPRESSION_POLICY_ADAPTIVE)
+# 自适应策略：每块均匀取 ADAPTIVE_SAMPLE_SLICES 段、每段 ADAPTIVE_SAMPLE_SIZE 字节试压，
+# 压缩后仍不小于采样的 ADAPTIVE_STORE_RATIO 时整块不压缩
+ADAPTIVE_SAMPLE_SLICES = 4
+ADAPTIVE_SAMPLE_SIZE = 8 * 1024
+ADAPTIVE_STORE_RATIO = 0.97
+
+
+def _block_sample(block: bytes) -> bytes:
+    """从块中均匀取若干段作为采样。"""
+    last = len(block) - ADAPTIVE_SAMPLE_SIZE
+    return b"".join(block[offset:offset + ADAPTIVE_SAMPLE_SIZE] for offset in
+                    (last * index // (ADAPTIVE_SAMPLE_SLICES - 1)
+                     for index in range(ADAPTIVE_SAMPLE_SLICES)))
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstandard is not installed, please install it first")
+    return zstandard
+
+
+class GzipStreamCompressor():
+    """单线程 gzip 流式压缩器，输出单个 gzip 成员，用于不经过 tar 的数据流。"""
+
+    def __init__(self, level: int = 6):
+        self.level = level
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> list:
+        """送入原始数据，返回已压缩的数据块列表（可能为空）。"""
+        out = self._compressor.compress(data)
+        return [out] if out else []
+
+    def flush(self) -> list:
+        """结束 gzip 成员并返回剩余数据。"""
+        return [self._compressor.flush()]
+
+    def close(self):
+        """zlib 资源随对象释放，无需额外处理。"""
+
+
+class ParallelGzipCompressor():
+    """
+    分块并行 gzip 压缩器。
+
+    输入按 block_size 切块，交给线程池压缩（zlib 压缩时释放 GIL），
+    按提交顺序输出；同时在途的块数不超过 workers * 2，内存占用有上限。
+    adaptive 为 True 时，采样压缩收益不足的块不压缩，并统计节省的 CPU 时间。
+    """
+
+    def __init__(self, level: int = 6, workers: int = None,
+                 block_size: int = PARALLEL_GZIP_BLOCK_SIZE, adaptive: bool = False):
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.adaptive = adaptive
+        self.blocks = 0
+        self.stored_blocks = 0
+        self.stored_bytes = 0
+        self.cpu_seconds = 0.0
+        self.cpu_seconds_saved = 0.0
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="gzip-block")
+
+    def _compress_block(self, block: bytes):
+        """
+        在工作线程中压缩一块。
+        返回值: (gzip 成员, 是否未压缩, 耗用 CPU 秒数, 估计节省的 CPU 秒数)
+        """
+        start = time.thread_time()
+        if self.adaptive and len(block) >= ADAPTIVE_SAMPLE_SLICES * ADAPTIVE_SAMPLE_SIZE * 2:
+            sample = _block_sample(block)
+            trial = zlib.compress(sample, self.level)
+            sample_seconds = time.thread_time() - start
+            if len(trial) >= len(sample) * ADAPTIVE_STORE_RATIO:
+                member = gzip.compress(block, compresslevel=0, mtime=0)
+                seconds = time.thread_time() - start
+                # 按采样的耗时估计整块压缩所需的 CPU 时间
+                estimate = sample_seconds * len(block) / len(sample)
+                return member, True, seconds, max(estimate - seconds, 0.0)
+        # 固定 mtime，保证相同输入得到相同输出
+        member = gzip.compress(block, compresslevel=self.level, mtime=0)
+        return member, False, time.thread_time() - start, 0.0
+
+    def _collect(self, output: list):
+        member, stored, seconds, saved = self._pending.popleft().result()
+        output.append(member)
+        self.blocks += 1
+        self.cpu_seconds += seconds
+        if stored:
+            self.stored_blocks += 1
+            self.stored_bytes += len(member)
+            self.cpu_seconds_saved += saved
+
+    def _submit(self, block: bytes, output: list):
+        self._pending.append(self._executor.submit(self._compress_block, block))
+        while len(self._pending) > self.workers * 2:
+            self._collect(output)
+
+    def compress(self, data: bytes) -> list:
+        """送入原始数据，返回已完成压缩的数据块列表（可能为空）。"""
+        output = []
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, output)
+        return output
+
+    def flush(self) -> list:
+        """压缩剩余数据并返回全部未输出的数据块。"""
+        output = []
+        if self._buffer or not self._pending:
+            self._submit(bytes(self._buffer), output)
+            self._buffer.clear()
+        while self._pending:
+            self._collect(output)
+        return output
+
+    def describe_savings(self) -> str:
+        """用于日志的自适应压缩统计。"""
+        return "共 {} 块，未压缩 {} 块（{} 字节），压缩 CPU {:.2f}s，估计节省 CPU {:.2f}s".format(
+            self.blocks, self.stored_blocks, self.stored_bytes, self.cpu_seconds,
+            self.cpu_seconds_saved)
+
+    def close(self):
+        """释放线程池。"""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+
+class ZstdStreamCompressor():
+    """zstandard 多线程流式压缩器。"""
+
+    def __init__(self, level: int = 3, workers: int = None):
+        zstandard = _import_zstandard()
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self._compressor = zstandard.ZstdCompressor(
+            level=level, threads=self.workers).compressobj()
+
+    def compress(self, data: bytes) -> list:
+        """送入原始数据，返回已压缩的数据块列表（可能为空）。"""
+        out = self._compressor.compress(data)
+        return [out] if out else []
+
+    def flush(self) -> list:
+        """结束压缩帧并返回剩余数据。"""
+        out = self._compressor.flush()
+        return [out] if out else []
+
+    def close(self):
+        """zstandard 内部资源随对象释放，无需额外处理。"""
+
+
+# zstd 帧格式（RFC 8878）中用到的常量
+_ZSTD_MAGIC = 0xFD2FB528
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+_ZSTD_BLOCK_RLE = 1
+_ZSTD_BLOCK_RESERVED = 3
+
+
+class _ZstdFrameTracker():
+    """
+    按 zstd 帧格式只解析帧头和块头、跳过块内容，跟踪帧的边界（不解压），
+    用于判断数据流是否结束在帧的中间。
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self._header = bytearray()
+        self._skip = 0
+        self._next_frame()
+
+    @property
+    def in_frame(self) -> bool:
+        """当前是否处于一个帧的中间。"""
+        return bool(self._header or self._skip) or self._on_header != self._frame_magic
+
+    def feed(self, data: bytes):
+        """送入一段压缩数据，帧头或块头不合法时抛出 ValueError。"""
+        position = 0
+        while position < len(data):
+            if self._skip:
+                step = min(self._skip, len(data) - position)
+                position += step
+                self._skip -= step
+                if not self._skip:
+                    self._on_skipped()
+                continue
+            step = min(self._need - len(self._header), len(data) - position)
+            self._header += data[position:position + step]
+            position += step
+            if len(self._header) == self._need:
+                header = bytes(self._header)
+                self._header.clear()
+                self._on_header(header)
+
+    def _expect(self, size: int, on_header):
+        self._need = size
+        self._on_header = on_header
+
+    def _skip_then(self, size: int, on_skipped):
+        self._skip = size
+        self._on_skipped = on_skipped
+        if not size:
+            on_skipped()
+
+    def _next_frame(self):
+        self._expect(4, self._frame_magic)
+
+    def _end_frame(self):
+        self.frames += 1
+        self._next_frame()
+
+    def _frame_magic(self, header: bytes):
+        magic = int.from_bytes(header, "little")
+        if magic & 0xFFFFFFF0 == _ZSTD_SKIPPABLE_MAGIC:
+            self._expect(4, lambda size: self._skip_then(int.from_bytes(size, "little"),
+                                                         self._end_frame))
+        elif magic == _ZSTD_MAGIC:
+            self._expect(1, self._frame_descriptor)
+        else:
+            raise ValueError("zstd 帧头不合法")
+
+    def _frame_descriptor(self, header: bytes):
+        descriptor = header[0]
+        single_segment = descriptor >> 5 & 1
+        self._checksum = descriptor >> 2 & 1
+        size = (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3] + \
+            (single_segment, 2, 4, 8)[descriptor >> 6]
+        self._skip_then(size, self._next_block)
+
+    def _next_block(self):
+        self._expect(3, self._block_header)
+
+    def _block_header(self, header: bytes):
+        value = int.from_bytes(header, "little")
+        block_type = value >> 1 & 3
+        if block_type == _ZSTD_BLOCK_RESERVED:
+            raise ValueError("zstd 块类型不合法")
+        size = 1 if block_type == _ZSTD_BLOCK_RLE else value >> 3
+        if not value & 1:
+            self._skip_then(size, self._next_block)
+        else:
+            self._skip_then(size, lambda: self._skip_then(4 if self._checksum else 0,
+                                                          self._end_frame))
+
+
+class _FeedWriter():
+    """把 zstd stream_writer 的输出交给下一级校验器。"""
+
+    def __init__(self, inner):
+        self._inner = inner
+
+    def write(self, data) -> int:
+        if self._inner is not None:
+            self._inner.feed(bytes(data))
+        return len(data)
+
+
+class ZstdStreamVerifier():
+    """
+    流式 zstd 校验器，解压结果交给下一级校验器。
+    解压由 stream_writer 完成，每次最多输出 _DECOMPRESS_LIMIT 字节，高压缩比的数据不会
+    一次解压到内存中；stream_writer 不报告帧是否结束，帧边界由 _ZstdFrameTracker 跟踪。
+    """
+
+    def __init__(self, inner=None):
+        zstandard = _import_zstandard()
+        self._inner = inner
+        self._tracker = _ZstdFrameTracker()
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            _FeedWriter(inner), write_size=_DECOMPRESS_LIMIT, closefd=False)
+
+    def feed(self, data: bytes):
+        """送入一段压缩数据。"""
+        self._tracker.feed(data)
+        self._writer.write(data)
+
+    def finish(self):
+        """确认 zstd 数据流已完整结束。"""
+        if self._tracker.in_frame or not self._tracker.frames:
+            raise ValueError("zstd 数据不完整")
+        self._writer.close()
+        if self._inner is not None:
+            self._inner.finish()
+
+
+class Compression():
+    """
+    任务的压缩设置。
+
+    参数:
+        name  压缩方式，gzip / parallel_gzip / zstd
+        level  压缩级别，None 表示使用默认值
+        workers  压缩线程数，None 表示使用 CPU 核数
+        policy  压缩策略，always / adaptive（仅 parallel_gzip）
+    """
+
+    def __init__(self, name: str = COMPRESSION_GZIP, level: int = None, workers: int = None,
+                 policy: str = COMPRESSION_POLICY_ALWAYS):
+        if name not in COMPRESSIONS:
+            raise ValueError("不支持的压缩方式: {}".format(name))
+        if policy not in COMPRESSION_POLICIES:
+            raise ValueError("不支持的压缩策略: {}".format(policy))
+        if policy == COMPRESSION_POLICY_ADAPTIVE and name != COMPRESSION_PARALLEL_GZIP:
+            raise ValueError("adaptive 压缩策略只支持 parallel_gzip")
+        low, high = COMPRESS_LEVELS[name]
+        if level is not None and not low <= level <= high:
+            raise ValueError("{} 的压缩级别必须在 {}～{} 之间: {}".format(name, low, high, level))
+        self.name = name
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.policy = policy
+        if name == COMPRESSION_ZSTD:
+            _import_zstandard()
+
+    def is_tar_builtin(self) -> bool:
+        """是否直接使用 tar 自带的 gzip 压缩。"""
+        return self.name == COMPRESSION_GZIP
+
+    def tar_create_command(self, archive: str) -> list:
+        """
+        tar 自带 gzip 时创建归档的命令前缀（之后接要打包的路径），archive 为 "-" 时输出到
+        标准输出。未设置压缩级别时为 ``tar zcf``，否则用 ``-I "gzip -N"`` 指定级别。
+        """
+        if self.level is None:
+            return ["tar", "zcf", archive]
+        return ["tar", "-I", "gzip -{}".format(self.level), "-cf", archive]
+
+    def tar_suffix(self) -> str:
+        """tar 归档的文件扩展名。"""
+        return ".tar.zst" if self.name == COMPRESSION_ZSTD else ".tgz"
+
+    def stream_suffix(self) -> str:
+        """单个数据流（非 tar）压缩后的扩展名。"""
+        return ".zst" if self.name == COMPRESSION_ZSTD else ".gz"
+
+    def create_compressor(self):
+        """创建流式压缩器。gzip 方式在进程内单线程压缩。"""
+        if self.name == COMPRESSION_ZSTD:
+            return ZstdStreamCompressor(self.level if self.level is not None else 3, self.workers)
+        level = self.level if self.level is not None else 6
+        if self.name == COMPRESSION_GZIP:
+            return GzipStreamCompressor(level)
+        return ParallelGzipCompressor(level, self.workers,
+                                      adaptive=self.policy == COMPRESSION_POLICY_ADAPTIVE)
+
+    def create_verifier(self, inner=None):
+        """创建与压缩方式对应的流式校验器。"""
+        if self.name == COMPRESSION_ZSTD:
+            return ZstdStreamVerifier(inner)
+        return GzipStreamVerifier(inner)
+
+    def describe(self) -> str:
+        """用于日志的简短描述。"""
+        if self.is_tar_builtin():
+            return self.name
+        if self.policy == COMPRESSION_POLICY_ADAPTIVE:
+            return "{}（自适应），{} 线程".format(self.name, self.workers)
+        return "{}，{} 线程".format(self.name, self.workers)
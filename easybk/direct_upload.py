@@ -0,0 +1,114 @@
+"""
+直传：备份任务生成归档的同时上传到各个目的地，不在本地生成归档文件。
+
+归档数据按块写入每个目的地的有界队列（参见 fanout 模块），上传器把数据流上传到
+临时名称；归档结束、摘要确定后再提交为包含摘要的最终名称（FTP 改名，OSS 服务端复制）。
+"""
+
+
+import logging
+import threading
+
+from .fanout import FANOUT_QUEUE_SIZE, FanoutStream
+
+
+class DirectUpload():
+    """
+    把一个备份任务的归档流同时上传给它的所有上传任务
+
+    参数:
+        upload_tasks: 该备份任务的上传任务，上传器必须支持流式上传
+        queue_size: 每个目的地最多缓存的数据块数
+    """
+
+    def __init__(self, upload_tasks: list, queue_size: int = FANOUT_QUEUE_SIZE):
+        self.logger = logging.getLogger("DirectUpload")
+        self.upload_tasks = list(upload_tasks)
+        self.queue_size = queue_size
+        self._streams = {}
+        self._threads = []
+        self._staged = {}
+        self._results = {}
+
+    def start(self):
+        """
+        为每个上传任务启动上传线程，开始接收归档数据
+        """
+        self._streams = {id(ut): FanoutStream(self.queue_size) for ut in self.upload_tasks}
+        self._staged = {}
+        self._results = {}
+        self._threads = [threading.Thread(target=self._stage, args=(ut,), daemon=True,
+                                          name="direct-{}".format(ut.get_uploader().get_name()))
+                         for ut in self.upload_tasks]
+        for thread in self._threads:
+            thread.start()
+
+    def _stage(self, upload_task):
+        stream = self._streams[id(upload_task)]
+        try:
+            self._staged[id(upload_task)] = upload_task.get_uploader().stage_stream(
+                upload_task.get_remote_dir(), stream)
+        except Exception as exc:
+            self.logger.warning("直传到 [%s] 失败: %s", upload_task.get_uploader().get_name(), exc)
+            self._results[id(upload_task)] = False
+        finally:
+            stream.closed = True
+
+    def write(self, chunk: bytes):
+        """
+        分发一段归档数据，队列满时等待；所有目的地都已失败时抛出 IOError
+        """
+        delivered = False
+        for stream in self._streams.values():
+            if not stream.closed and stream._feed(chunk):
+                delivered = True
+        if not delivered:
+            raise IOError("所有直传目的地都已失败")
+
+    def _end(self, item):
+        for stream in self._streams.values():
+            stream._feed(item)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def commit(self, task):
+        """
+        归档已完整写入、任务已设置最终文件名后调用：结束数据流，
+        把上传成功的临时文件提交为最终名称
+        """
+        self._end(None)
+        for upload_task in self.upload_tasks:
+            staged = self._staged.pop(id(upload_task), None)
+            if staged is None:
+                continue
+            uploader = upload_task.get_uploader()
+            try:
+                self._results[id(upload_task)] = bool(
+                    uploader.commit_staged(staged, task, upload_task.get_remote_dir()))
+            except Exception as exc:
+                self.logger.warning("直传提交到 [%s] 失败: %s", uploader.get_name(), exc)
+                self._results[id(upload_task)] = False
+                uploader.discard_staged(staged)
+                continue
+            uploader.record_upload(task, upload_task.get_remote_dir())
+
+    def abort(self, error: BaseException):
+        """
+        归档失败时调用：让各上传线程的读取抛出 error，并删除已上传的临时文件。
+        已经提交过时不做任何事
+        """
+        if not self._threads and not self._staged:
+            return
+        self._end(error if isinstance(error, Exception) else IOError("归档已中止"))
+        for upload_task in self.upload_tasks:
+            staged = self._staged.pop(id(upload_task), None)
+            if staged is not None:
+                upload_task.get_uploader().discard_staged(staged)
+            self._results[id(upload_task)] = False
+
+    def result_of(self, upload_task) -> bool:
+        """
+        返回上传任务的直传结果，尚未直传时为 False
+        """
+        return self._results.get(id(upload_task), False)
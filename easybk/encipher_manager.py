@@ -4,116 +4,372 @@ Date: 2018-07-11
 """
 
 
-import hashlib
 import logging
 import os
-import tempfile
+import threading
+import time
 
+from .hashing import ALGORITHMS, DEFAULT_ALGORITHM, hash_file, token_algorithm
 from .singleton import Singleton
+from .state_store import DEFAULT_STATE_BACKEND, ManifestChange, open_state_store
+
+
+# mtime 距今小于该值的文件不缓存 stat：同一时间戳粒度内的再次修改无法通过 stat 发现
+RACY_STAT_WINDOW_NS = 2 * 1000 * 1000 * 1000
 
 
 class EncipherManager(Singleton):
     """
-    文件摘要管理器。 单例。
+    文件摘要管理器。 单例，可以被多个任务线程同时使用。
+
+    状态保存在可替换的后端中（见 state_store）：``text`` 为原有的文本文件，
+    ``sqlite`` 支持单点查询和只写入变化条目的增量提交。file_dict / stat_dict 是已读取
+    或修改过的条目（文本后端启动时读入全部条目）。
+
+    修改按所属任务（owner，通常为任务名）暂存：任务及其上传全部成功后调用 commit
+    提交该任务的修改，失败时调用 discard 丢弃，已提交的状态保持不变。
+    save_data_to_file 提交全部暂存的修改。任务通过 namespace 取得绑定了任务名的视图。
+
+    所有读写都在同一把锁内完成；后端的读取和提交在锁外进行，不会阻塞其它任务。
     """
 
     def __init__(self):
+        # 单例每次构造都会调用 __init__，只在第一次初始化，避免清空其它任务正在使用的状态
+        if getattr(self, "_initialized", False):
+            return
         self.logger = logging.getLogger("EncipherManager")
+        self._lock = threading.RLock()
         self.file_dict = {}
+        self.stat_dict = {}
         self.changed = False
         self.file_name = None
+        self.backend = DEFAULT_STATE_BACKEND
+        self.store = None
+        # {owner: 暂存的条目名称集合} / {owner: {清单名称: ManifestChange}}
+        self._dirty = {}
+        self._pending_manifests = {}
+        self._initialized = True
 
-    def load_data_from_file(self, file_name):
-        """
-        从文件加载摘要列表
+    def namespace(self, owner) -> "TaskState":
+        """返回绑定到 owner（任务名）的状态视图，见 TaskState。"""
+        return TaskState(self, owner)
+
+    def load_data_from_file(self, file_name, backend=DEFAULT_STATE_BACKEND):
         """
-        self.file_dict = {}
-        self.changed = False
-        self.file_name = file_name
+        打开状态存储并加载摘要列表，丢弃尚未提交的修改
 
-        if not os.path.exists(file_name):
-            self.logger.info("摘要状态文件不存在，将创建新文件: %s", file_name)
-            return
+        参数:
+            file_name  状态文件路径
+            backend  状态后端，text / sqlite
+        """
+        store = open_state_store(file_name, backend)
+        file_dict, stat_dict = {}, {}
+        for name, (digest, file_stat) in store.preload().items():
+            file_dict[name] = digest
+            if file_stat:
+                stat_dict[name] = file_stat
 
-        with open(file_name, "r", encoding="utf-8") as fh:
-            for line_number, line in enumerate(fh, start=1):
-                line = line.rstrip("\n")
-                if not line.strip():
-                    continue
-                cols = line.split(" ", 1)
-                if len(cols) != 2 or not cols[0] or not cols[1]:
-                    raise ValueError("摘要状态文件第 {} 行格式错误".format(line_number))
-                self.file_dict[cols[1]] = cols[0]
-        self.logger.info("已加载 %s 条数据", len(self.file_dict))
+        with self._lock:
+            previous, self.store = self.store, store
+            self.file_dict = file_dict
+            self.stat_dict = stat_dict
+            self.changed = False
+            self.file_name = file_name
+            self.backend = backend
+            self._dirty = {}
+            self._pending_manifests = {}
+        if previous is not None:
+            previous.close()
+        if file_dict:
+            self.logger.info("已加载 %s 条数据", len(file_dict))
 
     def save_data_to_file(self, file_name=None, force=False):
         """
-        保存摘要列表到文件中。
+        提交全部暂存的摘要和清单。
 
         inputs:
-            file_name: 保存的文件名。若为 None ，则保存到读取的源文件中。
+            file_name: 保存的文件名。若为 None ，则保存到读取的源文件中；否则把已加载的
+                       全部条目写入该文件（同一后端）。
             force: 是否强制写入。若数据无变更，默认不会重新保存。设置此字段可强制重新保存。
         """
-        if force or self.changed:
-            if file_name is None:
-                file_name = self.file_name
-            if not file_name:
+        with self._lock:
+            if not force and not self.changed:
+                return
+            if file_name is None or file_name == self.file_name:
+                store = self.store
+                names = set(self.file_dict) if force else set().union(*self._dirty.values())
+            else:
+                store = open_state_store(file_name, self.backend)
+                names = set(self.file_dict)
+            if store is None:
                 raise ValueError("未指定摘要状态文件")
-            target = os.path.abspath(file_name)
-            target_dir = os.path.dirname(target)
-            os.makedirs(target_dir, exist_ok=True)
-            fd, temp_path = tempfile.mkstemp(prefix=".digest-", dir=target_dir, text=True)
+
+            manifests = {}
+            for pending in self._pending_manifests.values():
+                for name, change in pending.items():
+                    manifests[name] = manifests[name].merge(change) if name in manifests \
+                        else change
             try:
-                with os.fdopen(fd, "w", encoding="utf-8", newline="\n") as fh:
-                    for key, value in sorted(self.file_dict.items()):
-                        fh.write("{} {}\n".format(value, key))
-                    fh.flush()
-                    os.fsync(fh.fileno())
-                os.replace(temp_path, target)
-                self.changed = False
+                store.commit(self._entries(names), manifests)
             finally:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+                if store is not self.store:
+                    store.close()
+            self._pending_manifests = {}
+            self._dirty = {}
+            self.changed = False
+
+    def commit(self, owner) -> bool:
+        """
+        提交 owner 暂存的摘要和清单，其它任务暂存的修改不受影响。
+        提交失败时修改仍保留在暂存中。
+        返回值: 有修改被提交时为 True
+        """
+        with self._lock:
+            names = self._dirty.pop(owner, set())
+            manifests = self._pending_manifests.pop(owner, {})
+            if not names and not manifests:
+                return False
+            store = self.store
+            entries = self._entries(names)
+        try:
+            if store is None:
+                raise ValueError("未指定摘要状态文件")
+            store.commit(entries, manifests)
+        except BaseException:
+            with self._lock:
+                # 提交期间 owner 可能又有新的修改，新的修改在提交失败的修改之后应用
+                self._dirty.setdefault(owner, set()).update(names)
+                pending = self._pending_manifests.setdefault(owner, {})
+                for name, change in manifests.items():
+                    pending[name] = change.merge(pending[name]) if name in pending else change
+            raise
+        with self._lock:
+            self.changed = bool(self._dirty or self._pending_manifests)
+        return True
+
+    def discard(self, owner) -> bool:
+        """
+        丢弃 owner 暂存的摘要和清单，恢复为已提交的状态。
+        返回值: 有修改被丢弃时为 True
+        """
+        with self._lock:
+            names = self._dirty.pop(owner, set())
+            manifests = self._pending_manifests.pop(owner, {})
+            for name in names:
+                self.file_dict.pop(name, None)
+                self.stat_dict.pop(name, None)
+            self.changed = bool(self._dirty or self._pending_manifests)
+        for name in names:
+            self._lookup(name)
+        return bool(names or manifests)
+
+    def _entries(self, names) -> dict:
+        """在锁内调用：条目名称对应的 {名称: (摘要, stat 签名)}。"""
+        return {name: (self.file_dict[name], self.stat_dict.get(name)) for name in names}
+
+    def _lookup(self, name):
+        """把条目读入 file_dict / stat_dict，支持单点查询的后端按需读取。"""
+        with self._lock:
+            if name in self.file_dict or self.store is None:
+                return
+            store = self.store
+        row = store.get(name)
+        if row is None:
+            return
+        with self._lock:
+            # 读取期间其它线程可能已经写入或重新加载，此时以内存中的为准
+            if store is self.store and name not in self.file_dict:
+                self.file_dict[name] = row[0]
+                if row[1]:
+                    self.stat_dict[name] = row[1]
+
+    def get_value(self, name):
+        """返回记录的摘要（状态令牌），没有记录时返回 None。"""
+        self._lookup(name)
+        with self._lock:
+            return self.file_dict.get(name)
 
     def check_if_has_changed(self, name, value) -> bool:
         """
         通过摘要判断文件是否有变更。如果有变更返回 True，否则返回 False。
         """
-        if name in self.file_dict:
-            return self.file_dict[name] != value
-        else:
-            return True
+        self._lookup(name)
+        with self._lock:
+            return self.file_dict.get(name) != value
 
-    def set_value(self, name, value):
+    def set_value(self, name, value, file_stat=None, owner=None):
         """
         设置文件名和摘要
+
+        参数:
+            name  文件名
+            value  摘要
+            file_stat  计算摘要时的 stat 签名（见 stat_signature），为 None 时不缓存
+            owner  修改所属的任务名，见 commit / discard
+        """
+        with self._lock:
+            self.file_dict[name] = value
+            if file_stat:
+                self.stat_dict[name] = tuple(file_stat)
+            else:
+                self.stat_dict.pop(name, None)
+            self._dirty.setdefault(owner, set()).add(name)
+            self.changed = True
+
+    def get_cached_digest(self, name, file_stat):
+        """
+        若文件的 stat 签名与记录一致，返回记录的摘要，无需重新读取文件；否则返回 None。
         """
-        self.file_dict[name] = value
-        self.changed = True
+        self._lookup(name)
+        with self._lock:
+            if not file_stat or self.stat_dict.get(name) != tuple(file_stat):
+                return None
+            return self.file_dict.get(name)
+
+    def is_stat_current(self, name, file_stat) -> bool:
+        """记录中的 stat 签名是否与 file_stat 一致。"""
+        self._lookup(name)
+        with self._lock:
+            return bool(file_stat) and self.stat_dict.get(name) == tuple(file_stat)
 
     @staticmethod
-    def digest(file_name) -> str:
+    def stat_signature(file_name):
+        """
+        返回文件的 stat 签名 (size, mtime_ns, inode, ctime_ns)。
+        文件刚被修改（mtime 距今不足 2 秒）时返回 None，此时必须重新计算摘要。
+        """
+        st = os.stat(file_name)
+        if time.time_ns() - st.st_mtime_ns < RACY_STAT_WINDOW_NS:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+    def _pending_manifest(self, name):
+        """在锁内调用：尚未提交的清单修改，没有时返回 None。"""
+        for pending in self._pending_manifests.values():
+            if name in pending:
+                return pending[name]
+        return None
+
+    def load_manifest(self, name):
         """
-        使用 SHA-256 计算文件摘要，仅用于变化检测和备份标识。
+        读取任务清单的头部。优先返回本次运行中尚未保存的清单。
 
-        参数： 文件名
-        返回值：SHA-256 十六进制摘要
+        参数： name 清单名称（通常为任务名）
+        返回值：清单头部字典；不存在时返回 None
         """
-        def read_chunks(fh):
-            while True:
-                chunk = fh.read(1024 * 1024)
-                if chunk:
-                    yield chunk
-                else:
-                    break
+        with self._lock:
+            change = self._pending_manifest(name)
+            if change is not None:
+                return change.header
+            store = self.store
+        if store is None:
+            return None
+        return store.get_manifest(name)
 
-        digest = hashlib.sha256()
-        with open(file_name, "rb") as fh:
-            for chunk in read_chunks(fh):
-                digest.update(chunk)
-        return digest.hexdigest()
+    def load_manifest_entries(self, name) -> dict:
+        """
+        读取任务清单的全部条目，包含本次运行中尚未保存的修改。
+
+        参数： name 清单名称（通常为任务名）
+        返回值：{键: 值}；不存在时返回空字典
+        """
+        with self._lock:
+            change = self._pending_manifest(name)
+            store = self.store
+        entries = {}
+        if store is not None and (change is None or not change.replace):
+            entries = store.get_manifest_entries(name)
+        return entries if change is None else change.apply(entries)
+
+    def set_manifest(self, name, manifest: dict, owner=None, entries: dict = None,
+                     removed=(), replace: bool = False):
+        """
+        暂存任务清单的修改，与摘要一起提交。条目只需要传入变化的部分。
+
+        参数:
+            name  清单名称（通常为任务名）
+            manifest  新的清单头部
+            owner  修改所属的任务名，默认与 name 相同
+            entries  新增或修改的条目 {键: 值}
+            removed  删除的条目键
+            replace  是否先清空已有的全部条目
+        """
+        owner = name if owner is None else owner
+        change = ManifestChange(manifest, entries, removed, replace)
+        with self._lock:
+            pending = self._pending_manifests.setdefault(owner, {})
+            pending[name] = pending[name].merge(change) if name in pending else change
+            self.changed = True
+
+    @staticmethod
+    def digest(file_name, algorithm=DEFAULT_ALGORITHM) -> str:
+        """
+        计算文件摘要，用于变化检测和备份标识。
+
+        参数： file_name 文件名；algorithm 摘要算法，见 hashing 模块
+        返回值：状态令牌，SHA-256 为不带前缀的十六进制摘要
+        """
+        return hash_file(file_name, algorithm)
 
     @staticmethod
     def md5sum(file_name) -> str:
         """兼容旧调用；新实现返回 SHA-256 摘要。"""
         return EncipherManager.digest(file_name)
+
+
+class TaskState():
+    """
+    绑定到一个任务的状态视图：修改都记在该任务名下，清单默认以任务名命名，
+    由任务及其上传的结果决定提交或丢弃（见 EncipherManager.commit / discard）。
+
+    参数:
+        manager  EncipherManager
+        owner  任务名
+    """
+
+    def __init__(self, manager: EncipherManager, owner: str):
+        self.manager = manager
+        self.owner = owner
+
+    def get_value(self, name):
+        return self.manager.get_value(name)
+
+    def check_if_has_changed(self, name, value) -> bool:
+        return self.manager.check_if_has_changed(name, value)
+
+    def has_content_changed(self, file_name, digest: str) -> bool:
+        """
+        文件内容与记录相比是否变化，file_name 同时是记录的名称。记录使用其它算法时
+        （例如修改 hash_algorithm 之前的记录），按记录的算法重新计算一次再比较，
+        切换算法不会让未变化的文件被当作变化。
+        """
+        recorded = self.get_value(file_name)
+        if recorded is None:
+            return True
+        algorithm = token_algorithm(recorded)
+        if algorithm == token_algorithm(digest):
+            return recorded != digest
+        if algorithm not in ALGORITHMS:
+            return True
+        return hash_file(file_name, algorithm) != recorded
+
+    def get_cached_digest(self, name, file_stat):
+        return self.manager.get_cached_digest(name, file_stat)
+
+    def is_stat_current(self, name, file_stat) -> bool:
+        return self.manager.is_stat_current(name, file_stat)
+
+    def set_value(self, name, value, file_stat=None):
+        self.manager.set_value(name, value, file_stat, owner=self.owner)
+
+    def load_manifest(self, name=None):
+        return self.manager.load_manifest(self.owner if name is None else name)
+
+    def load_manifest_entries(self, name=None) -> dict:
+        return self.manager.load_manifest_entries(self.owner if name is None else name)
+
+    def set_manifest(self, manifest: dict, name=None, entries: dict = None, removed=(),
+                     replace: bool = False):
+        self.manager.set_manifest(self.owner if name is None else name, manifest,
+                                  owner=self.owner, entries=entries, removed=removed,
+                                  replace=replace)
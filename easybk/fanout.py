@@ -0,0 +1,112 @@
+"""
+读一次、多路上传：只从磁盘读取一次备份文件，把数据块同时分发给多个上传器。
+
+每个上传器有一个有界队列，内存占用上限约为
+    上传器数 × FANOUT_QUEUE_SIZE × FANOUT_CHUNK_SIZE
+慢的目的地会让读取方等待，而不会让数据在内存中堆积；某个目的地失败后
+不再向它分发，其余目的地继续上传。
+"""
+
+
+import queue
+import threading
+
+
+FANOUT_CHUNK_SIZE = 1024 * 1024
+FANOUT_QUEUE_SIZE = 8
+# 读取方等待队列空位时检查目的地是否已经放弃的间隔（秒）
+_PUT_POLL_INTERVAL = 0.1
+
+
+class FanoutStream():
+    """
+    单个目的地的只读流，数据来自读取方写入的有界队列
+    """
+
+    def __init__(self, queue_size: int = FANOUT_QUEUE_SIZE):
+        self._queue = queue.Queue(queue_size)
+        self._buffer = b""
+        self._eof = False
+        # 目的地结束（成功或失败）后置为 True，读取方不再向它分发
+        self.closed = False
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        读取至多 size 字节；size 为负数时读取到文件末尾。返回空字节串表示结束。
+        """
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(FANOUT_CHUNK_SIZE), b""))
+        while not self._buffer and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, BaseException):
+                self._eof = True
+                raise item
+            else:
+                self._buffer = item
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def _feed(self, item) -> bool:
+        """
+        读取方写入一个数据块，队列满时等待；目的地已经结束时返回 False
+        """
+        while not self.closed:
+            try:
+                self._queue.put(item, timeout=_PUT_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def fanout_file(path: str, consumers: dict, chunk_size: int = FANOUT_CHUNK_SIZE,
+                queue_size: int = FANOUT_QUEUE_SIZE) -> dict:
+    """
+    读取一次本地文件，并发交给每个 consumer 处理
+    参数:
+        path: 本地文件路径
+        consumers: {名称: 可调用对象}，可调用对象接收一个 FanoutStream 并返回结果
+        chunk_size: 每次读取的字节数
+        queue_size: 每个目的地最多缓存的数据块数
+    返回值:
+        {名称: consumer 的返回值，或它抛出的异常}
+    """
+    streams = {name: FanoutStream(queue_size) for name in consumers}
+    results = {}
+
+    def consume(name):
+        stream = streams[name]
+        try:
+            results[name] = consumers[name](stream)
+        except Exception as exc:
+            results[name] = exc
+        finally:
+            stream.closed = True
+
+    threads = [threading.Thread(target=consume, args=(name,), daemon=True,
+                                name="fanout-{}".format(name)) for name in consumers]
+    for thread in threads:
+        thread.start()
+
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                active = [stream for stream in streams.values() if not stream.closed]
+                if not active:
+                    break
+                for stream in active:
+                    stream._feed(chunk)
+        end = None
+    except Exception as exc:
+        # 读取失败时让每个目的地的 read() 抛出同一个异常
+        end = exc
+    for stream in streams.values():
+        stream._feed(end)
+
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,258 @@
+"""
+备份调度器：备份任务完成后立即提交对应的上传任务，
+让本地打包（磁盘/CPU）与上传（网络）同时进行。
+
+任务和上传在执行前还要取得所属资源池的名额：
+    cpu           打包、导出等需要压缩的任务，默认上限为 CPU 核数
+    disk:<设备号>  输出目录所在的磁盘，默认每个设备 1 个，写同一块磁盘的打包任务排队执行
+    net:<上传器>   上传器的网络连接，默认上限为上传器的 max_connections
+也可以在配置中声明自定义资源池，并通过任务的 pools 选项引用。
+
+启用 fanout_uploads 后，同一备份任务发往多个支持流式上传的上传器时，
+只读取一次备份文件，同时供给这些上传器（参见 fanout 模块）。
+"""
+
+
+import contextlib
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .task_manager import TaskManager
+from .upload_manager import UploadManager
+
+
+def _device_of(path: str) -> int:
+    """返回 path 所在的设备号，path 不存在时使用最近的已存在的上级目录。"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+
+class ResourcePools():
+    """
+    命名资源池，每个资源池是一个有上限的信号量
+
+    参数:
+        limits: 资源池上限，键可以是完整名称（如 "disk:2049"）或类别（如 "disk"）
+    """
+
+    def __init__(self, limits: dict = None):
+        self.limits = {"cpu": os.cpu_count() or 1, "disk": 1}
+        self.limits.update(limits or {})
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def limit(self, name: str, default: int = 1) -> int:
+        """
+        返回资源池上限：先按完整名称查找，再按 ":" 之前的类别查找
+        """
+        if name in self.limits:
+            return self.limits[name]
+        return self.limits.get(name.split(":", 1)[0], default)
+
+    def _semaphore(self, name: str, default: int):
+        with self._lock:
+            if name not in self._semaphores:
+                self._semaphores[name] = threading.BoundedSemaphore(self.limit(name, default))
+            return self._semaphores[name]
+
+    @contextlib.contextmanager
+    def acquire(self, names, defaults: dict = None):
+        """
+        按名称排序依次获取多个资源池的名额，避免不同任务交叉等待造成死锁
+        参数:
+            names: 资源池名称
+            defaults: 未配置上限的资源池使用的默认上限
+        """
+        defaults = defaults or {}
+        acquired = []
+        try:
+            for name in sorted(set(names)):
+                semaphore = self._semaphore(name, defaults.get(name, 1))
+                semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+
+class BackupScheduler():
+    """
+    流水线调度器
+
+    参数:
+        task_manager: 备份任务管理器
+        upload_manager: 上传管理器
+        task_workers: 同时执行的备份任务数
+        upload_workers: 同时执行的上传任务数
+        pools: 资源池上限，参见 ResourcePools
+        fanout_uploads: 是否对同一备份任务的多个上传使用读一次、多路上传
+    """
+
+    def __init__(self, task_manager: TaskManager, upload_manager: UploadManager,
+                 task_workers: int = 3, upload_workers: int = 1, pools: dict = None,
+                 fanout_uploads: bool = False):
+        self.logger = logging.getLogger("BackupScheduler")
+        self.task_manager = task_manager
+        self.upload_manager = upload_manager
+        self.task_workers = 1
+        self.upload_workers = 1
+        self.pools = ResourcePools()
+        self.fanout_uploads = False
+        self.configure(task_workers, upload_workers, pools, fanout_uploads)
+
+    def configure(self, task_workers: int = None, upload_workers: int = None,
+                  pools: dict = None, fanout_uploads: bool = None):
+        """
+        修改并发配置，参数为 None 时保持原值
+        """
+        if task_workers is not None:
+            if task_workers < 1:
+                raise ValueError("task_workers must be positive!")
+            self.task_workers = task_workers
+        if upload_workers is not None:
+            if upload_workers < 1:
+                raise ValueError("upload_workers must be positive!")
+            self.upload_workers = upload_workers
+        if pools is not None:
+            self.pools = ResourcePools(pools)
+        if fanout_uploads is not None:
+            self.fanout_uploads = fanout_uploads
+
+    def task_pools(self, task) -> list:
+        """
+        返回备份任务占用的资源池，"disk" 展开为输出目录所在设备；
+        直传的任务同时占用各上传器的 net 资源池
+        """
+        pools = ["disk:{}".format(_device_of(task.get_output_dir())) if name == "disk" else name
+                 for name in task.get_pools()]
+        direct_upload = task.get_direct_upload()
+        if direct_upload is not None:
+            for upload_task in direct_upload.upload_tasks:
+                pools.extend(self.upload_pools(upload_task))
+        return pools
+
+    @staticmethod
+    def upload_pools(upload_task) -> list:
+        """
+        返回上传任务占用的资源池
+        """
+        return ["net:{}".format(upload_task.get_uploader().get_name())]
+
+    def run(self) -> bool:
+        """
+        执行全部备份及上传任务
+        每个备份任务及其上传全部成功后立即提交该任务的状态，失败的任务保留原有状态。
+        返回值:
+            所有备份任务和上传任务都成功时为 True
+        """
+        task_list = self.task_manager.task_list
+        upload_list = list(enumerate(self.upload_manager.upload_task_list, start=1))
+        self.logger.info("开始执行备份及上传任务，备份任务数: %s，上传任务数: %s，"
+                         "并发: 备份 %s / 上传 %s", len(task_list), len(upload_list),
+                         self.task_workers, self.upload_workers)
+        self.task_manager.load_state()
+
+        uploads_by_task = {}
+        for index, upload_task in upload_list:
+            uploads_by_task.setdefault(id(upload_task.get_task()), []).append((index, upload_task))
+
+        results = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.task_workers) as task_executor, \
+                    ThreadPoolExecutor(max_workers=self.upload_workers) as upload_executor:
+                # future -> 所属备份任务，上传任务的 future 同样对应它的备份任务
+                pending = {
+                    task_executor.submit(self._run_task, index, task): task
+                    for index, task in enumerate(task_list, start=1)
+                }
+                upload_futures = set()
+                # 不属于本次备份任务的上传任务没有依赖，可以立即开始，也不涉及状态提交
+                known_tasks = set(id(task) for task in task_list)
+                for task_id, uploads in uploads_by_task.items():
+                    if task_id not in known_tasks:
+                        for future in self._submit_uploads(upload_executor, uploads):
+                            pending[future] = None
+                            upload_futures.add(future)
+
+                # id(备份任务) -> [剩余的上传数, 是否全部成功]
+                outcomes = {}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = pending.pop(future)
+                        result = future.result()
+                        results.append(result)
+                        if task is None:
+                            continue
+                        if future in upload_futures:
+                            outcome = outcomes[id(task)]
+                            outcome[0] -= 1
+                            outcome[1] = outcome[1] and result
+                        else:
+                            futures = self._submit_uploads(upload_executor,
+                                                           uploads_by_task.get(id(task), []))
+                            for upload_future in futures:
+                                pending[upload_future] = task
+                                upload_futures.add(upload_future)
+                            outcome = outcomes[id(task)] = [len(futures), result]
+                        # 任务及其全部上传结束后立即处理它的状态，不受其它任务失败的影响
+                        if outcome[0] == 0:
+                            results.append(self.task_manager.finish_task_state(task, outcome[1]))
+        finally:
+            # 任务、上传或状态提交抛出异常时也要关闭上传器持有的连接
+            self.upload_manager.close_uploaders()
+        self.logger.info("备份及上传任务执行完毕！")
+        return all(results)
+
+    def _submit_uploads(self, executor, uploads):
+        fanout = []
+        if self.fanout_uploads:
+            # 同一个上传器只能加入一次：它的两个流共用连接数时，读取方会互相等待
+            for index, upload_task in uploads:
+                uploader = upload_task.get_uploader()
+                if uploader.supports_stream() and \
+                        not any(uploader is ut.get_uploader() for _, ut in fanout):
+                    fanout.append((index, upload_task))
+        if len(fanout) < 2:
+            fanout = []
+        futures = [executor.submit(self._run_fanout, fanout)] if fanout else []
+        futures.extend(executor.submit(self._run_upload, index, upload_task)
+                       for index, upload_task in uploads if (index, upload_task) not in fanout)
+        return futures
+
+    def _run_task(self, index, task) -> bool:
+        try:
+            pools = self.task_pools(task)
+        except OSError:
+            self.logger.exception("Task [%s]: 无法确定资源池。", task.get_name())
+            return False
+        direct_upload = task.get_direct_upload()
+        defaults = {} if direct_upload is None else {
+            name: upload_task.get_uploader().get_max_connections()
+            for upload_task in direct_upload.upload_tasks
+            for name in self.upload_pools(upload_task)}
+        with self.pools.acquire(pools, defaults):
+            return self.task_manager.run_task(index, task)
+
+    def _run_upload(self, index, upload_task) -> bool:
+        uploader = upload_task.get_uploader()
+        pools = self.upload_pools(upload_task)
+        with self.pools.acquire(pools, {name: uploader.get_max_connections() for name in pools}):
+            return self.upload_manager.run_upload_task(index, upload_task)
+
+    def _run_fanout(self, uploads) -> bool:
+        pools, defaults = [], {}
+        for _, upload_task in uploads:
+            for name in self.upload_pools(upload_task):
+                pools.append(name)
+                defaults[name] = upload_task.get_uploader().get_max_connections()
+        with self.pools.acquire(pools, defaults):
+            return all(self.upload_manager.run_fanout_upload(uploads))
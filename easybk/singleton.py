@@ -5,6 +5,8 @@ Date: 2018-07-11
 
 # 单例模式集锦
 
+import threading
+
 
 def singleton(cls, *args, **kw):
     """
@@ -25,11 +27,16 @@ class Singleton():
     """
     通过__new__实现单例，使用方法：（直接继承）
     class Myclass(Singleton)
+    多个线程同时第一次构造时只创建一个实例。注意每次构造仍会调用 __init__。
     """
+    _instance_lock = threading.Lock()
+
     def __new__(cls, *args, **kw):
-        if not hasattr(cls, '_instance'):
-            orig = super(Singleton, cls)
-            cls._instance = orig.__new__(cls, *args, **kw)
+        if '_instance' not in cls.__dict__:
+            with Singleton._instance_lock:
+                if '_instance' not in cls.__dict__:
+                    orig = super(Singleton, cls)
+                    cls._instance = orig.__new__(cls)
         return cls._instance
 
 
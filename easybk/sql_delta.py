@@ -0,0 +1,322 @@
+"""
+MySQL 导出的差异压缩。
+
+导出的 SQL 按内容切分为数据块（见 chunking 模块，候选切分点在换行或扩展 INSERT 的
+``),(`` 处，插入或删除数据不会影响后面的切分位置）。全量导出时记录每块的
+摘要和长度作为基准索引；差异导出时与基准相同的块只记录为“复制基准中的一段”，
+其余内容原样写入补丁。补丁再经过任务的压缩方式压缩。
+
+补丁格式::
+
+    EBKDELTA1\\n
+    <JSON 头部>\\n                 基准文件名、基准 SQL 的 SHA-256 等
+    C <offset:u64> <length:u32>    复制基准 SQL 中的一段
+    I <length:u32> <data>          插入新内容
+    E <sha256:32 字节> <size:u64>  结束，恢复结果的 SHA-256 和长度
+
+恢复（安装后提供 easybk-sql-restore 命令）::
+
+    easybk-sql-restore <全量备份.sql.gz> <差异备份.delta.gz> -o restore.sql
+"""
+
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from .chunking import ContentChunker, chunk_hash
+from .compression import _import_zstandard
+
+
+DELTA_MAGIC = b"EBKDELTA1\n"
+DELTA_SUFFIX = ".delta"
+DELTA_VERSION = 1
+
+CHUNK_MIN_SIZE = 512
+CHUNK_MAX_SIZE = 64 * 1024
+# 每个候选切分点以 1/64 的概率切分
+CHUNK_MASK = 0x3F
+_CHUNK_ANCHORS = (b"\n", b"),(")
+# 基准索引的数据块数上限。差异导出时基准索引整体读入内存（连同状态中的条目约 450 字节
+# 每块），全量导出的 SQL 超过该块数（常见的扩展 INSERT 约 3 GiB）时不建立索引
+BASE_INDEX_MAX_CHUNKS = 1000000
+# 连续的新内容超过该长度时先写出，限制内存占用
+LITERAL_FLUSH_SIZE = 1024 * 1024
+
+_COPY = struct.Struct(">QI")
+_INSERT = struct.Struct(">I")
+_END = struct.Struct(">32sQ")
+
+
+class SqlChunker(ContentChunker):
+    """SQL 切块器：候选切分点是换行和扩展 INSERT 中 ``),(`` 之后的位置。"""
+
+    def __init__(self):
+        super().__init__(CHUNK_MIN_SIZE, CHUNK_MAX_SIZE, CHUNK_MASK, _CHUNK_ANCHORS)
+
+
+class SqlDeltaEncoder():
+    """
+    把 SQL 数据流编码为全量或差异输出，接口与流式压缩器相同（compress/flush/close），
+    可以直接交给 stream_command_to_file。
+
+    参数:
+        inner  对输出再次压缩的流式压缩器
+        base  基准索引（见 base_index），为 None 时原样输出 SQL 并建立新的索引
+        base_file  基准备份的文件名，写入补丁头部便于恢复时查找
+    """
+
+    def __init__(self, inner, base: dict = None, base_file: str = None):
+        self._inner = inner
+        self._chunker = SqlChunker()
+        self._sql_digest = hashlib.sha256()
+        self._base_offsets = None
+        self._pending_copy = None
+        self._pending_literal = bytearray()
+        self.base = base
+        self.chunks = []
+        self.sql_bytes = 0
+        self.copied_bytes = 0
+        self.literal_bytes = 0
+        self.sql_digest = None
+        self._started = False
+        if base is not None:
+            self._base_offsets = {}
+            offset = 0
+            for digest, length in base["chunks"]:
+                self._base_offsets.setdefault(digest, (offset, length))
+                offset += length
+            self._header = DELTA_MAGIC + json.dumps({
+                "version": DELTA_VERSION,
+                "base_file": base_file,
+                "base_sha256": base["sql_sha256"],
+                "base_size": offset,
+            }, sort_keys=True).encode("utf-8") + b"\n"
+
+    @property
+    def is_delta(self) -> bool:
+        """是否输出差异补丁。"""
+        return self.base is not None
+
+    def compress(self, data: bytes) -> list:
+        """送入一段 SQL，返回压缩后的输出块。"""
+        self._sql_digest.update(data)
+        self.sql_bytes += len(data)
+        out = self._start()
+        if self.is_delta:
+            for chunk in self._chunker.feed(data):
+                self._encode(chunk, out)
+        else:
+            if self.chunks is not None:
+                self._index(self._chunker.feed(data))
+            out.append(data)
+        return self._compress_all(out)
+
+    def flush(self) -> list:
+        """数据结束，返回剩余的输出块。"""
+        out = self._start()
+        digest = self._sql_digest.digest()
+        self.sql_digest = digest.hex()
+        if self.is_delta:
+            for chunk in self._chunker.finish():
+                self._encode(chunk, out)
+            self._flush_copy(out)
+            self._flush_literal(out)
+            out.append(b"E" + _END.pack(digest, self.sql_bytes))
+        elif self.chunks is not None:
+            self._index(self._chunker.finish())
+        blocks = self._compress_all(out)
+        return blocks + list(self._inner.flush())
+
+    def close(self):
+        """释放内层压缩器的资源。"""
+        self._inner.close()
+
+    def _start(self) -> list:
+        if self._started or not self.is_delta:
+            return []
+        self._started = True
+        return [self._header]
+
+    def _compress_all(self, pieces: list) -> list:
+        blocks = []
+        for piece in pieces:
+            blocks.extend(self._inner.compress(piece))
+        return blocks
+
+    def _index(self, chunks: list):
+        self.chunks.extend([chunk_hash(chunk), len(chunk)] for chunk in chunks)
+        if len(self.chunks) > BASE_INDEX_MAX_CHUNKS:
+            self.chunks = None
+            self._chunker = None
+
+    def _encode(self, chunk: bytes, out: list):
+        found = self._base_offsets.get(chunk_hash(chunk))
+        if found is not None and found[1] == len(chunk):
+            self._flush_literal(out)
+            offset, length = found
+            self.copied_bytes += length
+            if self._pending_copy is not None and \
+                    sum(self._pending_copy) == offset and self._pending_copy[1] + length < 2 ** 32:
+                self._pending_copy[1] += length
+            else:
+                self._flush_copy(out)
+                self._pending_copy = [offset, length]
+            return
+        self._flush_copy(out)
+        self.literal_bytes += len(chunk)
+        self._pending_literal += chunk
+        if len(self._pending_literal) >= LITERAL_FLUSH_SIZE:
+            self._flush_literal(out)
+
+    def _flush_copy(self, out: list):
+        if self._pending_copy is not None:
+            out.append(b"C" + _COPY.pack(*self._pending_copy))
+            self._pending_copy = None
+
+    def _flush_literal(self, out: list):
+        if self._pending_literal:
+            out.append(b"I" + _INSERT.pack(len(self._pending_literal)))
+            out.append(bytes(self._pending_literal))
+            self._pending_literal = bytearray()
+
+    def base_index(self) -> dict:
+        """
+        flush 之后调用：全量输出的基准索引，保存后供之后的差异导出使用。
+        数据块超过 BASE_INDEX_MAX_CHUNKS 时返回 None。
+        """
+        if self.chunks is None:
+            return None
+        return {"sql_sha256": self.sql_digest, "chunks": self.chunks}
+
+    def describe(self) -> str:
+        """用于日志的统计描述。"""
+        if self.chunks is None:
+            return "全量导出 {} 字节，数据块超过 {} 个，不建立基准索引".format(
+                self.sql_bytes, BASE_INDEX_MAX_CHUNKS)
+        if not self.is_delta:
+            return "全量导出 {} 字节，{} 个数据块".format(self.sql_bytes, len(self.chunks))
+        return "SQL {} 字节，复用基准 {} 字节（{:.1%}），新增 {} 字节".format(
+            self.sql_bytes, self.copied_bytes, self.copied_bytes / max(self.sql_bytes, 1),
+            self.literal_bytes)
+
+
+def _read_exact(fh, size: int) -> bytes:
+    data = fh.read(size)
+    if len(data) != size:
+        raise ValueError("差异补丁不完整")
+    return data
+
+
+def read_delta_header(patch) -> dict:
+    """读取并返回补丁头部。"""
+    if _read_exact(patch, len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError("不是 easybk 差异补丁")
+    return json.loads(patch.readline().decode("utf-8"))
+
+
+def apply_delta(base, patch, output) -> int:
+    """
+    把补丁应用到基准 SQL 上，写出完整的 SQL。
+
+    参数:
+        base  可 seek 的基准 SQL（未压缩）二进制文件
+        patch  未压缩的补丁数据流
+        output  二进制输出文件
+    返回值: 输出字节数；基准不匹配或结果摘要不一致时抛出 ValueError
+    """
+    header = read_delta_header(patch)
+    base.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: base.read(1024 * 1024), b""):
+        digest.update(block)
+    if digest.hexdigest() != header["base_sha256"]:
+        raise ValueError("基准备份与补丁不匹配，需要 {}".format(header.get("base_file")))
+
+    digest = hashlib.sha256()
+    written = 0
+    while True:
+        op = _read_exact(patch, 1)
+        if op == b"C":
+            offset, length = _COPY.unpack(_read_exact(patch, _COPY.size))
+            base.seek(offset)
+            while length:
+                block = base.read(min(length, 1024 * 1024))
+                if not block:
+                    raise ValueError("补丁引用了基准之外的数据")
+                digest.update(block)
+                output.write(block)
+                written += len(block)
+                length -= len(block)
+        elif op == b"I":
+            (length,) = _INSERT.unpack(_read_exact(patch, _INSERT.size))
+            block = _read_exact(patch, length)
+            digest.update(block)
+            output.write(block)
+            written += length
+        elif op == b"E":
+            expected, size = _END.unpack(_read_exact(patch, _END.size))
+            if size != written or expected != digest.digest():
+                raise ValueError("恢复结果校验失败")
+            return written
+        else:
+            raise ValueError("差异补丁格式错误")
+
+
+def open_compressed(path: str):
+    """按扩展名打开 .gz / .zst 压缩文件（其它扩展名视为未压缩），返回二进制读取流。"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        zstandard = _import_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def restore(base_path: str, patch_path: str, output_path: str) -> int:
+    """
+    用全量备份和差异备份恢复完整的 SQL，结果先写入临时文件，校验通过后再改名。
+    返回值: 恢复的 SQL 字节数
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryFile(dir=output_dir) as base:
+        with open_compressed(base_path) as source:
+            shutil.copyfileobj(source, base, 1024 * 1024)
+        fd, temp_path = tempfile.mkstemp(prefix=".easybk-restore-", dir=output_dir)
+        try:
+            with os.fdopen(fd, "wb") as output, open_compressed(patch_path) as patch:
+                size = apply_delta(base, patch, output)
+            os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return size
+
+
+def main(argv=None) -> int:
+    """命令行入口：由全量备份和差异备份恢复完整的 SQL。"""
+    parser = argparse.ArgumentParser(prog="easybk-sql-restore",
+                                     description="由全量备份和差异备份恢复完整的 SQL")
+    parser.add_argument("base", help="全量备份（.sql.gz / .sql.zst）")
+    parser.add_argument("patch", help="差异备份（.delta.gz / .delta.zst）")
+    parser.add_argument("-o", "--output", required=True, help="恢复出的 .sql 文件")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    try:
+        size = restore(args.base, args.patch, args.output)
+    except (OSError, ValueError) as exc:
+        logging.getLogger("sql_delta").error("恢复失败: %s", exc)
+        return 1
+    logging.getLogger("sql_delta").info("已恢复 %s 字节到 %s", size, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,339 @@
+"""
+变化检测状态的存储后端。
+
+- ``text``：原有的文本格式，每行 ``<摘要>[@<size>,<mtime_ns>,<inode>,<ctime_ns>] <路径>``，
+  清单保存在 ``{state_file}.{name}.manifest``。启动时读入全部条目，每次提交整体原子重写。
+- ``sqlite``：``{state_file}.sqlite``，WAL 模式。按路径单点查询，只读取用到的条目；
+  提交时只写入变化的条目和清单，全部在一个事务中完成，中途崩溃不会留下部分提交。
+  第一次打开时自动导入同名的文本状态文件及其清单（原文件保留不动，之后不再更新；
+  此后再以文本后端打开时记录警告）。
+
+清单由一个较小的头部和任意多个条目（如文件清单中的每个路径）组成，修改以 ManifestChange
+表示：新的头部加上新增/修改和删除的条目。sqlite 后端每个条目一行，以 (清单名称, 键) 为主键，
+提交时只写入变化的条目；文本后端把条目保存在清单文件的 ``entries`` 字段中，整体重写。
+"""
+
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+STATE_BACKEND_TEXT = "text"
+STATE_BACKEND_SQLITE = "sqlite"
+STATE_BACKENDS = (STATE_BACKEND_TEXT, STATE_BACKEND_SQLITE)
+# 命令行和 TaskManager 共用的默认后端；sqlite 需要显式指定
+DEFAULT_STATE_BACKEND = STATE_BACKEND_TEXT
+SQLITE_STATE_SUFFIX = ".sqlite"
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    stat TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS manifests (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifest_entries (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _atomic_write(file_name, write):
+    """通过临时文件、fsync 和 os.replace 原子地写入文本文件。"""
+    target = os.path.abspath(file_name)
+    target_dir = os.path.dirname(target)
+    os.makedirs(target_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".digest-", dir=target_dir, text=True)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="\n") as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _format_stat(file_stat) -> str:
+    return ",".join(str(field) for field in file_stat)
+
+
+def _parse_stat(text: str):
+    file_stat = tuple(int(field) for field in text.split(","))
+    if len(file_stat) != 4:
+        raise ValueError("stat 签名格式错误: {}".format(text))
+    return file_stat
+
+
+def manifest_path(file_name: str, name: str) -> str:
+    """文本后端中清单文件的路径。"""
+    return "{}.{}.manifest".format(file_name, name)
+
+
+class ManifestChange():
+    """
+    对一个清单的修改
+
+    参数:
+        header  新的清单头部（不含条目）
+        entries  新增或修改的条目 {键: 值}
+        removed  删除的条目键
+        replace  是否先清空已有的全部条目
+    """
+
+    def __init__(self, header: dict, entries: dict = None, removed=(), replace: bool = False):
+        self.header = header
+        self.entries = dict(entries or {})
+        self.removed = set(removed) - set(self.entries)
+        self.replace = replace
+
+    def merge(self, later: "ManifestChange") -> "ManifestChange":
+        """返回先应用本修改、再应用 later 的合并结果。"""
+        if later.replace:
+            return later
+        entries = dict(self.entries)
+        for key in later.removed:
+            entries.pop(key, None)
+        entries.update(later.entries)
+        return ManifestChange(later.header, entries, (self.removed | later.removed),
+                              self.replace)
+
+    def apply(self, entries: dict) -> dict:
+        """把修改应用到已有的条目，返回新的条目字典。"""
+        result = {} if self.replace else dict(entries)
+        for key in self.removed:
+            result.pop(key, None)
+        result.update(self.entries)
+        return result
+
+
+def read_text_state(file_name: str) -> dict:
+    """
+    读取文本格式的状态文件，不带 stat 的旧格式仍可读取。
+    返回值: {路径: (摘要, stat 签名或 None)}；文件不存在时为空字典
+    """
+    entries = {}
+    if not os.path.exists(file_name):
+        return entries
+    with open(file_name, "r", encoding="utf-8") as fh:
+        for line_number, line in enumerate(fh, start=1):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            cols = line.split(" ", 1)
+            if len(cols) != 2 or not cols[0] or not cols[1]:
+                raise ValueError("摘要状态文件第 {} 行格式错误".format(line_number))
+            digest, _, stat_text = cols[0].partition("@")
+            if not digest:
+                raise ValueError("摘要状态文件第 {} 行格式错误".format(line_number))
+            file_stat = None
+            if stat_text:
+                try:
+                    file_stat = _parse_stat(stat_text)
+                except ValueError:
+                    raise ValueError("摘要状态文件第 {} 行格式错误".format(line_number)) from None
+            entries[cols[1]] = (digest, file_stat)
+    return entries
+
+
+class StateStore():
+    """
+    状态存储后端接口。条目为 {路径: (摘要, stat 签名或 None)}，清单的修改为
+    {名称: ManifestChange}。
+
+    参数:
+        file_name  状态文件路径（--state-file）
+    """
+
+    def __init__(self, file_name: str):
+        self.logger = logging.getLogger("StateStore")
+        self.file_name = file_name
+
+    def preload(self) -> dict:
+        """启动时需要全部读入内存的条目；支持单点查询的后端返回空字典。"""
+        return {}
+
+    def get(self, name: str):
+        """单点查询，返回 (摘要, stat 签名或 None)，不存在时返回 None。"""
+        raise NotImplementedError("StateStore.get")
+
+    def get_manifest(self, name: str):
+        """读取清单头部，不存在时返回 None。"""
+        raise NotImplementedError("StateStore.get_manifest")
+
+    def get_manifest_entries(self, name: str) -> dict:
+        """读取清单的全部条目，不存在时返回空字典。"""
+        raise NotImplementedError("StateStore.get_manifest_entries")
+
+    def commit(self, entries: dict, manifests: dict):
+        """批量写入变化的条目和清单修改，要么全部生效，要么都不生效。"""
+        raise NotImplementedError("StateStore.commit")
+
+    def close(self):
+        """释放后端持有的资源。"""
+
+
+class TextStateStore(StateStore):
+    """原有的文本格式状态文件，见模块说明。"""
+
+    def __init__(self, file_name: str):
+        super().__init__(file_name)
+        if not os.path.exists(file_name):
+            self.logger.info("摘要状态文件不存在，将创建新文件: %s", file_name)
+        if os.path.exists(file_name + SQLITE_STATE_SUFFIX):
+            self.logger.warning("%s 已存在，文本状态可能早于其中的记录，"
+                                "切换到 sqlite 后应继续使用 --state-backend sqlite",
+                                file_name + SQLITE_STATE_SUFFIX)
+        self._lock = threading.Lock()
+        self._entries = read_text_state(file_name)
+
+    def preload(self) -> dict:
+        with self._lock:
+            return dict(self._entries)
+
+    def get(self, name: str):
+        with self._lock:
+            return self._entries.get(name)
+
+    def _read_manifest(self, name: str):
+        """返回 (头部, 条目)，清单不存在时为 (None, {})。"""
+        path = manifest_path(self.file_name, name)
+        if not os.path.exists(path):
+            return None, {}
+        with open(path, "r", encoding="utf-8") as fh:
+            header = json.load(fh)
+        return header, header.pop("entries", {})
+
+    def get_manifest(self, name: str):
+        return self._read_manifest(name)[0]
+
+    def get_manifest_entries(self, name: str) -> dict:
+        return self._read_manifest(name)[1]
+
+    def commit(self, entries: dict, manifests: dict):
+        def write_digests(fh):
+            for key, (digest, file_stat) in sorted(self._entries.items()):
+                if file_stat:
+                    digest = "{}@{}".format(digest, _format_stat(file_stat))
+                fh.write("{} {}\n".format(digest, key))
+
+        with self._lock:
+            self._entries.update(entries)
+            _atomic_write(self.file_name, write_digests)
+            for name, change in sorted(manifests.items()):
+                data = dict(change.header, entries=change.apply(self._read_manifest(name)[1]))
+                _atomic_write(manifest_path(self.file_name, name),
+                              lambda fh, data=data: json.dump(data, fh, ensure_ascii=False))
+
+
+class SqliteStateStore(StateStore):
+    """SQLite（WAL）状态存储，见模块说明。"""
+
+    def __init__(self, file_name: str):
+        super().__init__(file_name)
+        self.db_path = file_name + SQLITE_STATE_SUFFIX
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(_SQLITE_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """第一次打开时导入文本状态文件及其清单。"""
+        if self._db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return
+        entries = read_text_state(self.file_name)
+        manifests = {}
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        prefix = os.path.basename(self.file_name) + "."
+        if os.path.isdir(directory):
+            for file_name in os.listdir(directory):
+                if file_name.startswith(prefix) and file_name.endswith(".manifest"):
+                    name = file_name[len(prefix):-len(".manifest")]
+                    with open(os.path.join(directory, file_name), "r", encoding="utf-8") as fh:
+                        header = json.load(fh)
+                    manifests[name] = ManifestChange(header, header.pop("entries", {}),
+                                                     replace=True)
+        self.commit(entries, manifests, meta={"migrated": self.file_name})
+        if entries or manifests:
+            self.logger.info("已从 %s 导入 %s 条摘要、%s 个清单到 %s", self.file_name,
+                             len(entries), len(manifests), self.db_path)
+
+    def get(self, name: str):
+        with self._lock:
+            row = self._db.execute("SELECT digest, stat FROM digests WHERE path = ?",
+                                   (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0], _parse_stat(row[1]) if row[1] else None
+
+    def get_manifest(self, name: str):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM manifests WHERE name = ?",
+                                   (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_manifest_entries(self, name: str) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT key, data FROM manifest_entries WHERE name = ?",
+                                    (name,)).fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def commit(self, entries: dict, manifests: dict, meta: dict = None):
+        rows = [(name, digest, _format_stat(file_stat) if file_stat else None)
+                for name, (digest, file_stat) in entries.items()]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO digests (path, digest, stat) VALUES (?, ?, ?)", rows)
+                for name, change in manifests.items():
+                    if change.replace:
+                        self._db.execute("DELETE FROM manifest_entries WHERE name = ?", (name,))
+                    self._db.executemany(
+                        "DELETE FROM manifest_entries WHERE name = ? AND key = ?",
+                        ((name, key) for key in change.removed))
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO manifest_entries (name, key, data) "
+                        "VALUES (?, ?, ?)",
+                        ((name, key, json.dumps(value, ensure_ascii=False))
+                         for key, value in change.entries.items()))
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO manifests (name, data) VALUES (?, ?)",
+                        (name, json.dumps(change.header, ensure_ascii=False)))
+                self._db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                     (meta or {}).items())
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_state_store(file_name: str, backend: str = DEFAULT_STATE_BACKEND) -> StateStore:
+    """按后端名称打开状态存储。"""
+    if backend == STATE_BACKEND_TEXT:
+        return TextStateStore(file_name)
+    if backend == STATE_BACKEND_SQLITE:
+        return SqliteStateStore(file_name)
+    raise ValueError("不支持的状态后端: {}".format(backend))
@@ -8,6 +8,7 @@ import logging
 from concurrent.futures import ThreadPoolExecutor
 
 from .encipher_manager import EncipherManager
+from .state_store import DEFAULT_STATE_BACKEND
 from .tasks import Task
 
 
@@ -21,12 +22,14 @@ class TaskManager():
         self.task_list = []
         self.encipher_manager = EncipherManager()
         self.encipher_file = "md5_list.txt"
+        self.state_backend = DEFAULT_STATE_BACKEND
 
-    def set_encipher_file(self, path: str):
+    def set_encipher_file(self, path: str, backend: str = DEFAULT_STATE_BACKEND):
         """
-        加载配置文件
+        设置摘要状态文件及其存储后端（见 state_store 模块）
         """
         self.encipher_file = path
+        self.state_backend = backend
 
     def add_task(self, task: Task):
         """
@@ -47,41 +50,73 @@ class TaskManager():
         :param max_workers: 线程池最大并发数
         """
         self.logger.info("开始执行任务！")
-        # 加载 encipher 文件
-        self.encipher_manager.load_data_from_file(self.encipher_file)
+        self.load_state()
 
         self.logger.info("准备执行备份任务！ ")
 
         task_count = len(self.task_list)
         self.logger.info("总备份任务数: %s", task_count)
 
-        def _run_task(index, tsk):
-            try:
-                self.logger.info("准备执行第 %s 个备份任务，[%s]", index, tsk.get_name())
-                result = tsk.run()
-                if result:
-                    self.logger.info("第 %s 个备份任务执行成功，[%s]", index, tsk.get_name())
-                else:
-                    self.logger.info("第 %s 个备份任务未生成新备份，[%s]", index, tsk.get_name())
-                return True
-            except Exception:
-                self.logger.exception("Task [%s]: 备份发生异常。", tsk.get_name())
-                return False
-
         results = []
         if use_thread_pool and task_count > 0:
             with ThreadPoolExecutor(max_workers=min(max_workers, task_count)) as executor:
-                futures = [executor.submit(_run_task, idx, t) for idx, t in enumerate(self.task_list, start=1)]
+                futures = [executor.submit(self.run_task, idx, t) for idx, t in enumerate(self.task_list, start=1)]
                 for f in futures:
                     results.append(f.result())
         else:
-            results = [_run_task(index, task)
+            results = [self.run_task(index, task)
                        for index, task in enumerate(self.task_list, start=1)]
 
         self.logger.info("备份任务执行完毕！ ")
         return all(results)
 
+    def load_state(self):
+        """
+        加载 encipher 文件
+        """
+        self.encipher_manager.load_data_from_file(self.encipher_file, self.state_backend)
+
+    def run_task(self, index: int, task: Task) -> bool:
+        """
+        执行单个备份任务
+        :param index: 任务序号，仅用于日志
+        :param task: 备份任务
+        返回值:
+            未发生异常时为 True（包括没有生成新备份的情况）
+        """
+        try:
+            self.logger.info("准备执行第 %s 个备份任务，[%s]", index, task.get_name())
+            result = task.run()
+            if result:
+                self.logger.info("第 %s 个备份任务执行成功，[%s]", index, task.get_name())
+            else:
+                self.logger.info("第 %s 个备份任务未生成新备份，[%s]", index, task.get_name())
+            return True
+        except Exception:
+            self.logger.exception("Task [%s]: 备份发生异常。", task.get_name())
+            return False
+
     def save_state(self):
         """在备份及上传全部成功后提交变化检测状态。"""
         self.encipher_manager.save_data_to_file()
 
+    def finish_task_state(self, task: Task, success: bool) -> bool:
+        """
+        备份任务及其全部上传结束后处理该任务的状态：成功时立即提交，
+        失败时丢弃本次的修改，保留上次提交的状态，下次运行会重新备份。
+        返回值:
+            提交失败时为 False
+        """
+        name = task.get_name()
+        if not success:
+            if self.encipher_manager.discard(name):
+                self.logger.warning("Task [%s]: 备份或上传失败，保留原有状态。", name)
+            return True
+        try:
+            if self.encipher_manager.commit(name):
+                self.logger.info("Task [%s]: 已提交状态。", name)
+            return True
+        except Exception:
+            self.logger.exception("Task [%s]: 提交状态失败。", name)
+            return False
+
@@ -7,4 +7,5 @@ Date: 2018-07-11
 from .task import Task
 from .pack_task import PackTask
 from .single_file_task import SingleFileTask
+from .multi_file_task import MultiFileTask
 from .mysql_task import MysqlTask
@@ -0,0 +1,227 @@
+"""
+多文件备份任务：一个任务监视一批文件（glob 或目录），只备份内容变化的文件。
+"""
+
+
+import datetime
+import glob
+import logging
+import os
+import posixpath
+import shutil
+import stat
+import tarfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .task import OutputFile, Task
+from ..encipher_manager import EncipherManager
+from ..file_copy import copy_file_fast, copy_file_with_digest
+from ..hashing import ALGORITHMS, DEFAULT_ALGORITHM, hash_file, parse_token
+
+
+class _Candidate():
+    """
+    一个待检查的文件
+
+    参数:
+        path  绝对路径，同时是状态中的记录名称
+        file_stat  stat 签名，刚修改的文件为 None
+        digest  内容摘要（状态令牌）
+        changed  内容与记录相比是否变化
+    """
+
+    def __init__(self, path: str, file_stat, digest: str, changed: bool):
+        self.path = path
+        self.file_stat = file_stat
+        self.digest = digest
+        self.changed = changed
+
+    @property
+    def relative_path(self) -> str:
+        """批次中的相对路径：去掉开头的 "/"，与 tar 的处理相同。"""
+        return self.path.lstrip(os.sep)
+
+
+class MultiFileTask(Task):
+    """
+    多文件备份任务。
+
+    sources 中的每一项可以是文件、目录（递归包含其中的普通文件）或 glob（支持 ``**``）。
+    候选文件由多个线程并行检查：stat 签名未变化时沿用记录的摘要，否则重新计算。只有内容
+    变化的文件被复制到本次的批次目录 ``{task_name}.{%y%m%d_%H%M%S}/``（保留绝对路径去掉
+    开头 "/" 后的目录结构），上传时逐个文件上传；设置 bundle 后批次打包为一个
+    ``{task_name}_batch_{%y%m%d_%H%M%S}_{digest}.tgz``，上传只有一个对象。
+
+    参数:
+        task_name  任务名
+        output_dir  备份输出目录
+        sources  文件、目录或 glob 列表
+        bundle  是否把每次的批次打包为一个归档
+        hash_workers  并行检查文件的线程数
+        paranoid  是否忽略 stat 缓存，每次都重新计算摘要
+        hash_algorithm  摘要算法，见 hashing 模块
+    """
+
+    DEFAULT_POOLS = ("cpu", "disk")
+
+    def __init__(self, task_name: str, output_dir: str, sources: list, bundle: bool = False,
+                 hash_workers: int = 4, paranoid: bool = False,
+                 hash_algorithm: str = DEFAULT_ALGORITHM):
+        """
+        参数:
+            task_name  任务名
+            output_dir  备份输出目录
+            sources  文件、目录或 glob 列表
+            bundle  是否把每次的批次打包为一个归档
+            hash_workers  并行检查文件的线程数
+            paranoid  是否忽略 stat 缓存，每次都重新计算摘要
+            hash_algorithm  摘要算法，sha256 / blake2b / blake2b-tree
+        """
+        Task.__init__(self, task_name, output_dir)
+        self.logger = logging.getLogger("MultiFileTask")
+        if not sources:
+            raise ValueError("sources must not be empty!")
+        if hash_workers < 1:
+            raise ValueError("hash_workers must be positive!")
+        if hash_algorithm not in ALGORITHMS:
+            raise ValueError("不支持的摘要算法: {}".format(hash_algorithm))
+        self.sources = list(sources)
+        self.bundle = bundle
+        self.hash_workers = hash_workers
+        self.paranoid = paranoid
+        self.hash_algorithm = hash_algorithm
+        self.state = EncipherManager().namespace(task_name)
+        self.outputs = []
+
+    def do_task(self) -> bool:
+        """
+        执行任务
+        返回值: 有文件变化并生成了批次时为 True
+        """
+        self.logger.info("Task [%s]: 开始检查文件.", self.task_name)
+        self.outputs = []
+        paths = self._collect()
+        with ThreadPoolExecutor(max_workers=min(self.hash_workers, max(len(paths), 1))) as executor:
+            candidates = [candidate for candidate in executor.map(self._check, paths)
+                          if candidate is not None]
+        changed = [candidate for candidate in candidates if candidate.changed]
+        self.logger.info("Task [%s]: 检查 %s 个文件，%s 个变化", self.task_name,
+                         len(candidates), len(changed))
+
+        result = False
+        if changed:
+            now = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+            staging = os.path.join(self.output_dir,
+                                   ".{}.{}.tmp".format(self.task_name, uuid.uuid4().hex))
+            try:
+                for candidate in changed:
+                    self._copy(candidate, staging)
+                if self.bundle:
+                    self._write_bundle(staging, changed, now)
+                else:
+                    self._publish_batch(staging, changed, now)
+            finally:
+                if os.path.exists(staging):
+                    shutil.rmtree(staging)
+            result = True
+
+        for candidate in candidates:
+            # 变化的文件记录新摘要；内容未变但 stat 变化或记录使用其它算法的，更新记录
+            if candidate.changed or \
+                    self.state.get_value(candidate.path) != candidate.digest or \
+                    not self.state.is_stat_current(candidate.path, candidate.file_stat):
+                self.state.set_value(candidate.path, candidate.digest, candidate.file_stat)
+
+        self.logger.info("Task [%s]: 结束备份.", self.task_name)
+        return result
+
+    def get_outputs(self) -> list:
+        """打包时为归档本身，否则为批次中的每个文件。"""
+        if self.bundle:
+            return [self]
+        return list(self.outputs)
+
+    def _collect(self) -> list:
+        """展开 sources，返回去重、排序后的普通文件绝对路径。"""
+        paths = set()
+        for source in self.sources:
+            matches = glob.glob(source, recursive=True) if glob.has_magic(source) else [source]
+            if not matches:
+                self.logger.warning("Task [%s]: 没有匹配的文件: %s", self.task_name, source)
+            for match in matches:
+                if os.path.isdir(match):
+                    for root, _, files in os.walk(match):
+                        paths.update(os.path.join(root, name) for name in files)
+                else:
+                    paths.add(match)
+        return sorted(path for path in (os.path.abspath(path) for path in paths)
+                      if self._is_regular_file(path))
+
+    def _is_regular_file(self, path: str) -> bool:
+        try:
+            return stat.S_ISREG(os.stat(path).st_mode)
+        except FileNotFoundError:
+            return False
+
+    def _check(self, path: str):
+        """在线程池中执行：取得文件的摘要并判断是否变化，文件已被删除时返回 None。"""
+        try:
+            file_stat = EncipherManager.stat_signature(path)
+            digest = None
+            if not self.paranoid:
+                digest = self.state.get_cached_digest(path, file_stat)
+            if digest is None:
+                digest = hash_file(path, self.hash_algorithm)
+            return _Candidate(path, file_stat, digest,
+                              self.state.has_content_changed(path, digest))
+        except FileNotFoundError:
+            self.logger.warning("Task [%s]: 文件已被删除，跳过: %s", self.task_name, path)
+            return None
+
+    def _copy(self, candidate: _Candidate, staging: str):
+        """把变化的文件复制到暂存目录，复制期间文件变化时改为边复制边计算摘要。"""
+        target = os.path.join(staging, candidate.relative_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if candidate.file_stat is not None:
+            copy_file_fast(candidate.path, target)
+            if EncipherManager.stat_signature(candidate.path) == candidate.file_stat:
+                return
+            os.remove(target)
+        # 刚修改或复制期间发生变化的文件：以实际复制的内容为准，不缓存 stat
+        candidate.digest = copy_file_with_digest(candidate.path, target, self.hash_algorithm)
+        candidate.file_stat = None
+
+    def _publish_batch(self, staging: str, changed: list, now: str):
+        batch_name = "{}.{}".format(self.task_name, now)
+        self.set_output_file_name_and_full_path(batch_name)
+        if os.path.exists(self.output_full_path):
+            # 同一秒内的第二次运行
+            batch_name = "{}.{}_{}".format(self.task_name, now, uuid.uuid4().hex[:8])
+            self.set_output_file_name_and_full_path(batch_name)
+        os.replace(staging, self.output_full_path)
+        self.outputs = [
+            OutputFile(self, posixpath.join(batch_name, *candidate.relative_path.split(os.sep)),
+                       os.path.join(self.output_full_path, candidate.relative_path),
+                       candidate.digest)
+            for candidate in changed]
+        self.logger.info("Task [%s]: 批次 %s，%s 个文件", self.task_name,
+                         self.output_full_path, len(changed))
+
+    def _write_bundle(self, staging: str, changed: list, now: str):
+        temp_path = os.path.join(self.output_dir,
+                                 ".{}.{}.tgz.tmp".format(self.task_name, uuid.uuid4().hex))
+        try:
+            with tarfile.open(temp_path, "w:gz") as bundle:
+                for candidate in changed:
+                    bundle.add(os.path.join(staging, candidate.relative_path),
+                               arcname=candidate.relative_path, recursive=False)
+            digest = EncipherManager.digest(temp_path)
+            self.set_output_file_name_and_full_path(
+                "{}_batch_{}_{}.tgz".format(self.task_name, now, parse_token(digest)[1]), digest)
+            self.commit_output(temp_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.logger.info("Task [%s]: 打包 %s 个文件到 %s", self.task_name, len(changed),
+                         self.output_full_path)
@@ -5,14 +5,56 @@ Date: 2018-07-11
 
 
 import datetime
+import json
 import logging
 import os
+import re
 import shlex
+import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+from .pack_task import _read_stderr_tail
 from .task import Task
+from ..archive_stream import TarStreamVerifier, stream_command_to_file
+from ..compression import Compression
 from ..encipher_manager import EncipherManager
+from ..sql_delta import DELTA_SUFFIX, SqlDeltaEncoder
+
+
+SPLIT_BY_DATABASE = "database"
+SPLIT_BY_TABLE = "table"
+SPLIT_MODES = (SPLIT_BY_DATABASE, SPLIT_BY_TABLE)
+SPLIT_MANIFEST_NAME = "manifest.json"
+# 2：基准索引的数据块作为单独的清单条目保存，差异导出次数保存在单独的清单中
+# 3：数据块按相邻锚点之间数据段的 CRC32 切分，旧的基准索引不再匹配
+DELTA_MANIFEST_VERSION = 3
+
+# 列出数据表时从 dump_option 中沿用的连接参数
+_CONNECTION_OPTIONS = ("--defaults-file", "--defaults-extra-file", "--defaults-group-suffix",
+                       "--login-path", "--user", "--password", "--host", "--port", "--socket",
+                       "--protocol", "--ssl", "--tls", "--default-auth", "--plugin-dir")
+_CONNECTION_SHORT_OPTIONS = ("-u", "-h", "-P", "-S")
+
+
+def _connection_options(dump_options: list) -> list:
+    """从 mysqldump 参数中提取可同样传给 mysql 客户端的连接参数。"""
+    result = []
+    index = 0
+    while index < len(dump_options):
+        option = dump_options[index]
+        if option.startswith(_CONNECTION_OPTIONS):
+            result.append(option)
+        elif option.startswith("-p") and not option.startswith("--"):
+            result.append(option)
+        elif option in _CONNECTION_SHORT_OPTIONS and index + 1 < len(dump_options):
+            result.extend(dump_options[index:index + 2])
+            index += 1
+        elif option.startswith(_CONNECTION_SHORT_OPTIONS):
+            result.append(option)
+        index += 1
+    return result
 
 
 class MysqlTask(Task):
@@ -23,19 +65,62 @@ class MysqlTask(Task):
         task_name  任务名
         output_dir  备份输出目录
         dump_option  运行 mysqldump 所需参数
+        compression  压缩方式，gzip / parallel_gzip / zstd
+        compress_level  压缩级别
+        compress_workers  并行压缩线程数
+        streaming  是否把 mysqldump 输出直接流式压缩，不生成临时 .sql 文件
+        split_by  并行导出的拆分方式，database / table，为 None 时使用单个 mysqldump
+        databases  拆分导出时的数据库列表
+        dump_workers  并行运行的 mysqldump 进程数
+        mysql_option  列出数据表时 mysql 客户端的参数，为 None 时沿用 dump_option 中的连接参数
+        delta  是否启用差异导出：只输出与上次全量导出相比变化的内容
+        full_backup_interval  两次全量导出之间的差异导出次数
     """
 
-    def __init__(self, task_name: str, output_dir: str, dump_option):
+    # 导出主要受数据库和压缩速度限制，默认不占用磁盘资源池
+    DEFAULT_POOLS = ("cpu",)
+
+    def __init__(self, task_name: str, output_dir: str, dump_option, compression: str = "gzip",
+                 compress_level: int = None, compress_workers: int = None,
+                 streaming: bool = False, split_by: str = None, databases: list = None,
+                 dump_workers: int = 4, mysql_option=None, delta: bool = False,
+                 full_backup_interval: int = 7):
         """
         参数:
             task_name  任务名
             output_dir  备份输出目录
             dump_option  运行 mysqldump 所需参数
+            compression  压缩方式，gzip / parallel_gzip / zstd
+            compress_level  压缩级别
+            compress_workers  并行压缩线程数
+            streaming  是否把 mysqldump 输出直接流式压缩
+            split_by  并行导出的拆分方式，database / table
+            databases  拆分导出时的数据库列表
+            dump_workers  并行运行的 mysqldump 进程数
+            mysql_option  列出数据表时 mysql 客户端的参数
+            delta  是否启用差异导出
+            full_backup_interval  两次全量导出之间的差异导出次数
         """
         # super(MysqlTask, self).__init__(name)
         Task.__init__(self, task_name, output_dir)
         self.logger = logging.getLogger("MysqlTask")
         self.dump_option = dump_option
+        self.compression = Compression(compression, compress_level, compress_workers)
+        self.archive_stats = None
+        self.streaming = streaming
+        if split_by is not None and split_by not in SPLIT_MODES:
+            raise ValueError("不支持的拆分方式: {}".format(split_by))
+        if split_by is not None and not databases:
+            raise ValueError("拆分导出需要指定 databases")
+        self.split_by = split_by
+        self.databases = databases or []
+        self.dump_workers = dump_workers
+        self.mysql_option = mysql_option
+        if delta and split_by is not None:
+            raise ValueError("差异导出不支持拆分导出")
+        self.delta = delta
+        self.full_backup_interval = full_backup_interval
+        self.state = EncipherManager().namespace(task_name) if delta else None
 
     def do_task(self) -> bool:
         """
@@ -46,33 +131,63 @@ class MysqlTask(Task):
 
         dump_options = (self.dump_option if isinstance(self.dump_option, list)
                         else shlex.split(self.dump_option))
+        if self.delta:
+            self._dump_delta(dump_options)
+        elif self.split_by is not None:
+            self._dump_split(dump_options)
+        elif self.streaming:
+            self._dump_streaming(dump_options)
+        else:
+            self._dump_with_temp_file(dump_options)
+
+        self.logger.info("Task [%s]: 结束备份Mysql.", self.task_name)
+
+        return True
+
+    def _dump_with_temp_file(self, dump_options: list):
+        """
+        先把 mysqldump 输出写入临时 .sql 文件，再打包为 tar 归档。
+        """
         sql_fd, sql_path = tempfile.mkstemp(
             prefix="{}_backup_".format(self.task_name), suffix=".sql", dir=self.output_dir)
         os.close(sql_fd)
+        suffix = self.compression.tar_suffix()
         archive_fd, archive_path = tempfile.mkstemp(
-            prefix="{}_backup_".format(self.task_name), suffix=".tgz", dir=self.output_dir)
+            prefix="{}_backup_".format(self.task_name), suffix=suffix, dir=self.output_dir)
         os.close(archive_fd)
 
         try:
             with open(sql_path, "wb") as output_file:
                 subprocess.run(["mysqldump", *dump_options], stdout=output_file, check=True)
 
-            subprocess.run(
-                ["tar", "zcf", archive_path, os.path.basename(sql_path)],
-                cwd=self.output_dir,
-                check=True,
-            )
-            subprocess.run(["tar", "tzf", archive_path], check=True,
-                           stdout=subprocess.DEVNULL)
-            self.logger.info("Task [%s]: create temp file %s", self.task_name, archive_path)
-
-            digest = EncipherManager.digest(archive_path)
+            if self.compression.is_tar_builtin():
+                subprocess.run(
+                    [*self.compression.tar_create_command(archive_path),
+                     os.path.basename(sql_path)],
+                    cwd=self.output_dir,
+                    check=True,
+                )
+                subprocess.run(["tar", "tzf", archive_path], check=True,
+                               stdout=subprocess.DEVNULL)
+                self.logger.info("Task [%s]: create temp file %s", self.task_name, archive_path)
+                digest = EncipherManager.digest(archive_path)
+            else:
+                with open(archive_path, "wb") as archive_file:
+                    stats = stream_command_to_file(
+                        ["tar", "cf", "-", os.path.basename(sql_path)], self.output_dir,
+                        archive_file, None, self.compression.create_compressor(),
+                        self.compression.create_verifier(TarStreamVerifier()))
+                self.archive_stats = stats
+                self.logger.info("Task [%s]: create temp file %s", self.task_name, archive_path)
+                self.logger.info("Task [%s]: 压缩方式 %s，%s", self.task_name,
+                                 self.compression.describe(), stats.describe())
+                digest = stats.digest
             self.logger.info("Task [%s]: SHA-256 is %s", self.task_name, digest)
 
             now = datetime.datetime.now()
-            output_file_name = "{}_backup.sql.{}_{}.tgz".format(
-                self.task_name, now.strftime("%y%m%d_%H%M%S"), digest)
-            self.set_output_file_name_and_full_path(output_file_name)
+            output_file_name = "{}_backup.sql.{}_{}{}".format(
+                self.task_name, now.strftime("%y%m%d_%H%M%S"), digest, suffix)
+            self.set_output_file_name_and_full_path(output_file_name, digest)
             os.replace(archive_path, self.output_full_path)
             self.logger.info("Task [%s]: rename file to %s",
                              self.task_name, self.output_full_path)
@@ -81,6 +196,219 @@ class MysqlTask(Task):
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
 
-        self.logger.info("Task [%s]: 结束备份Mysql.", self.task_name)
+    def _dump_streaming(self, dump_options: list, compressor=None, kind: str = ""):
+        """
+        mysqldump 的标准输出直接经过压缩、SHA-256 和压缩格式校验写入最终文件，
+        不生成临时 .sql 文件，内存占用有上限。输出为压缩的 SQL 文本（不含 tar）。
 
-        return True
+        参数:
+            compressor  流式压缩器，为 None 时按任务的压缩方式创建
+            kind  插入到压缩扩展名之前的输出类型扩展名，如差异导出的 ".delta"
+        """
+        suffix = ".sql" + kind + self.compression.stream_suffix()
+        archive_fd, archive_path = tempfile.mkstemp(
+            prefix="{}_backup_".format(self.task_name), suffix=suffix, dir=self.output_dir)
+        os.close(archive_fd)
+        stderr_fd, stderr_path = tempfile.mkstemp(
+            prefix="{}_mysqldump_".format(self.task_name), suffix=".stderr.log",
+            dir=self.output_dir)
+        command = ["mysqldump", *dump_options]
+        try:
+            with os.fdopen(stderr_fd, "wb") as stderr_file:
+                try:
+                    with self.open_output(archive_path) as archive_file:
+                        stats = stream_command_to_file(
+                            command, None, archive_file, stderr_file,
+                            compressor or self.compression.create_compressor(),
+                            self.compression.create_verifier())
+                except subprocess.CalledProcessError as exc:
+                    stderr_file.flush()
+                    self.logger.error(
+                        "Task [%s]: mysqldump 失败，退出码=%s，stderr=%s",
+                        self.task_name, exc.returncode,
+                        _read_stderr_tail(stderr_path) or "<无错误输出>")
+                    raise
+            self.archive_stats = stats
+            self.logger.info("Task [%s]: create temp file %s", self.task_name, archive_path)
+            self.logger.info("Task [%s]: 压缩方式 %s，%s", self.task_name,
+                             self.compression.describe(), stats.describe())
+            self.logger.info("Task [%s]: SHA-256 is %s", self.task_name, stats.digest)
+
+            now = datetime.datetime.now()
+            output_file_name = "{}_backup.sql.{}_{}{}".format(
+                self.task_name, now.strftime("%y%m%d_%H%M%S"), stats.digest,
+                kind + self.compression.stream_suffix())
+            self.set_output_file_name_and_full_path(output_file_name, stats.digest)
+            self.commit_output(archive_path)
+        finally:
+            for temp_path in (archive_path, stderr_path):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def _dump_delta(self, dump_options: list):
+        """
+        流式导出，并与上次全量导出的数据块索引比较：全量导出时输出压缩的 SQL 并建立索引，
+        差异导出时只输出补丁（见 sql_delta 模块）。索引随摘要状态一起，在备份及上传成功后提交。
+        基准索引只在全量导出时写入；差异导出的次数保存在单独的 "<任务名>.delta" 清单中，
+        差异导出时只更新它。
+        """
+        manifest = self.state.load_manifest()
+        counter_name = "{}.delta".format(self.task_name)
+        counter = self.state.load_manifest(counter_name) or {}
+        # 计数属于其它基准时（例如基准提交后计数未能写入）视为从 0 开始
+        delta_count = counter.get("delta_count", 0) \
+            if manifest and counter.get("base_file") == manifest.get("base_file") else 0
+        full = (manifest is None or manifest.get("version") != DELTA_MANIFEST_VERSION
+                or manifest.get("base_sql_sha256") is None
+                or delta_count >= self.full_backup_interval)
+        if full:
+            encoder = SqlDeltaEncoder(self.compression.create_compressor())
+        else:
+            chunks = self.state.load_manifest_entries()
+            base = {"sql_sha256": manifest["base_sql_sha256"],
+                    "chunks": [chunks[key] for key in sorted(chunks)]}
+            encoder = SqlDeltaEncoder(self.compression.create_compressor(), base,
+                                      manifest["base_file"])
+            self.logger.info("Task [%s]: 差异导出，基准 %s", self.task_name,
+                             manifest["base_file"])
+        self._dump_streaming(dump_options, encoder, "" if full else DELTA_SUFFIX)
+        self.logger.info("Task [%s]: %s", self.task_name, encoder.describe())
+        if full:
+            # 基准索引的每个数据块按序号保存为一个清单条目，差异导出时不再重写
+            base = encoder.base_index()
+            if base is None:
+                # 索引过大时清空旧的基准，之后仍然全量导出
+                self.logger.warning("Task [%s]: 数据块过多，不保存差异基准", self.task_name)
+                manifest = {"version": DELTA_MANIFEST_VERSION, "base_file": None,
+                            "base_sql_sha256": None}
+                self.state.set_manifest(manifest, replace=True)
+            else:
+                manifest = {"version": DELTA_MANIFEST_VERSION,
+                            "base_file": self.get_output_file_name(),
+                            "base_sql_sha256": base["sql_sha256"]}
+                self.state.set_manifest(manifest, replace=True, entries={
+                    "{:010d}".format(index): chunk
+                    for index, chunk in enumerate(base["chunks"])})
+            delta_count = 0
+        else:
+            delta_count += 1
+        self.state.set_manifest({"base_file": manifest["base_file"], "delta_count": delta_count},
+                                name=counter_name)
+
+    def _list_dump_units(self, dump_options: list) -> list:
+        """返回需要分别导出的 (数据库, 数据表) 列表，按库拆分时数据表为 None。"""
+        if self.split_by == SPLIT_BY_DATABASE:
+            return [(database, None) for database in self.databases]
+        if self.mysql_option is None:
+            mysql_options = _connection_options(dump_options)
+        elif isinstance(self.mysql_option, list):
+            mysql_options = self.mysql_option
+        else:
+            mysql_options = shlex.split(self.mysql_option)
+        units = []
+        for database in self.databases:
+            result = subprocess.run(
+                ["mysql", *mysql_options, "--batch", "--skip-column-names",
+                 "-e", "SHOW TABLES", database],
+                check=True, stdout=subprocess.PIPE)
+            tables = [line.split("\t", 1)[0]
+                      for line in result.stdout.decode("utf-8").splitlines() if line]
+            self.logger.info("Task [%s]: 数据库 %s 共 %s 个表",
+                             self.task_name, database, len(tables))
+            units.extend((database, table) for table in tables)
+        return units
+
+    def _dump_split(self, dump_options: list):
+        """
+        按库或按表并行运行多个 mysqldump，每个数据流独立压缩，最后连同清单
+        打包为一个 tar（成员已压缩，tar 本身不再压缩），恢复时也可以并行导入。
+        """
+        units = self._list_dump_units(dump_options)
+        staging_dir = tempfile.mkdtemp(prefix="{}_split_".format(self.task_name),
+                                       dir=self.output_dir)
+        archive_path = None
+        try:
+            suffix = ".sql" + self.compression.stream_suffix()
+            jobs = []
+            for index, (database, table) in enumerate(units, start=1):
+                label = database if table is None else "{}.{}".format(database, table)
+                file_name = "{:04d}_{}{}".format(
+                    index, re.sub(r"[^0-9A-Za-z_.-]", "_", label), suffix)
+                if table is None:
+                    command = ["mysqldump", *dump_options, "--databases", database]
+                else:
+                    command = ["mysqldump", *dump_options, database, table]
+                jobs.append((label, database, table, file_name, command))
+
+            self.logger.info("Task [%s]: 并行导出 %s 个%s，并发数 %s", self.task_name, len(jobs),
+                             "库" if self.split_by == SPLIT_BY_DATABASE else "表",
+                             self.dump_workers)
+            with ThreadPoolExecutor(max_workers=max(1, min(self.dump_workers, len(jobs) or 1)),
+                                    thread_name_prefix="mysqldump") as executor:
+                futures = [executor.submit(self._dump_unit, staging_dir, job) for job in jobs]
+                try:
+                    entries = [future.result() for future in futures]
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            manifest = {
+                "version": 1,
+                "split_by": self.split_by,
+                "compression": self.compression.name,
+                "files": entries,
+            }
+            with open(os.path.join(staging_dir, SPLIT_MANIFEST_NAME), "w",
+                      encoding="utf-8") as fh:
+                json.dump(manifest, fh, ensure_ascii=False, indent=2)
+
+            archive_fd, archive_path = tempfile.mkstemp(
+                prefix="{}_backup_".format(self.task_name), suffix=".tar", dir=self.output_dir)
+            os.close(archive_fd)
+            members = [SPLIT_MANIFEST_NAME] + [entry["file"] for entry in entries]
+            with self.open_output(archive_path) as archive_file:
+                stats = stream_command_to_file(["tar", "cf", "-", *members], staging_dir,
+                                               archive_file, None, None, TarStreamVerifier())
+            self.archive_stats = stats
+            self.logger.info("Task [%s]: SHA-256 is %s", self.task_name, stats.digest)
+
+            now = datetime.datetime.now()
+            output_file_name = "{}_backup.sql.{}_{}.tar".format(
+                self.task_name, now.strftime("%y%m%d_%H%M%S"), stats.digest)
+            self.set_output_file_name_and_full_path(output_file_name, stats.digest)
+            self.commit_output(archive_path)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if archive_path is not None and os.path.exists(archive_path):
+                os.remove(archive_path)
+
+    def _dump_unit(self, staging_dir: str, job) -> dict:
+        """导出单个库或表并压缩，返回清单条目。"""
+        label, database, table, file_name, command = job
+        stderr_path = os.path.join(staging_dir, file_name + ".stderr.log")
+        try:
+            with open(stderr_path, "wb") as stderr_file:
+                try:
+                    with open(os.path.join(staging_dir, file_name), "wb") as output_file:
+                        stats = stream_command_to_file(
+                            command, None, output_file, stderr_file,
+                            self.compression.create_compressor(),
+                            self.compression.create_verifier())
+                except subprocess.CalledProcessError as exc:
+                    stderr_file.flush()
+                    self.logger.error(
+                        "Task [%s]: 导出 %s 失败，退出码=%s，stderr=%s",
+                        self.task_name, label, exc.returncode,
+                        _read_stderr_tail(stderr_path) or "<无错误输出>")
+                    raise
+        finally:
+            os.remove(stderr_path)
+        self.logger.info("Task [%s]: 导出 %s 完成，%s", self.task_name, label, stats.describe())
+        return {
+            "file": file_name,
+            "database": database,
+            "table": table,
+            "sha256": stats.digest,
+            "bytes": stats.output_bytes,
+        }
@@ -7,14 +7,29 @@ Date: 2018-07-10
 import datetime
 import logging
 import os
+import shutil
+import stat
 import subprocess
+import tarfile
 import tempfile
 
 from .task import Task
+from ..archive_stream import (ArchiveStreamWriter, GzipStreamVerifier, TarStreamVerifier,
+                              stream_command_to_file)
+from ..chunk_store import ChunkStore
+from ..compression import Compression
 from ..encipher_manager import EncipherManager
+from ..hashing import ALGORITHMS, DEFAULT_ALGORITHM, new_hasher, token_algorithm
 
 
 STDERR_LOG_TAIL_BYTES = 64 * 1024
+# 增量归档中记录已删除路径的成员名，内容为以 NUL 分隔的相对路径
+DELETED_LIST_NAME = ".easybk-deleted"
+# 2：文件清单的每个路径作为单独的清单条目保存，头部只保留版本和增量次数
+MANIFEST_VERSION = 2
+# 块存储模式下快照包中的快照清单名及 pack 文件目录
+SNAPSHOT_MANIFEST_NAME = "snapshot.json"
+SNAPSHOT_PACK_DIR = "packs"
 
 
 def _read_stderr_tail(file_path: str) -> str:
@@ -38,21 +53,61 @@ class PackTask(Task):
         output_dir  备份输出目录
         tar_run_dir  tar 命令运行路径
         backup_list  备份列表
+        streaming  是否使用单次读取的流式打包（边生成边计算摘要并校验）
+        compression  压缩方式，gzip / parallel_gzip / zstd
+        compress_level  压缩级别
+        compress_workers  并行压缩线程数
+        incremental  是否启用基于文件清单的增量备份
+        full_backup_interval  两次全量备份之间的增量备份次数
+        compression_policy  压缩策略，always / adaptive（跳过已压缩内容，仅 parallel_gzip）
+        chunk_store  去重块存储目录，设置后 tar 数据流切块保存到块存储，只输出快照包
+        chunk_store_keep  块存储中为本任务保留的快照数
+        hash_algorithm  增量备份文件清单使用的摘要算法，见 hashing 模块
     """
 
-    def __init__(self, task_name: str, output_dir: str, tar_run_dir: str, backup_list: list):
+    def __init__(self, task_name: str, output_dir: str, tar_run_dir: str, backup_list: list,
+                 streaming: bool = False, compression: str = "gzip",
+                 compress_level: int = None, compress_workers: int = None,
+                 incremental: bool = False, full_backup_interval: int = 7,
+                 compression_policy: str = "always", chunk_store: str = None,
+                 chunk_store_keep: int = 7, hash_algorithm: str = DEFAULT_ALGORITHM):
         """
         参数:
             task_name  任务名
             output_dir  备份输出目录
             tar_run_dir  tar 命令运行路径
             backup_list  备份列表
+            streaming  是否使用单次读取的流式打包
+            compression  压缩方式，gzip / parallel_gzip / zstd
+            compress_level  压缩级别
+            compress_workers  并行压缩线程数
+            incremental  是否启用增量备份
+            full_backup_interval  两次全量备份之间的增量备份次数
+            compression_policy  压缩策略，always / adaptive
+            chunk_store  去重块存储目录
+            chunk_store_keep  块存储中为本任务保留的快照数
+            hash_algorithm  增量备份文件清单使用的摘要算法
         """
         # super(PackTask, self).__init__(name)
         Task.__init__(self, task_name, output_dir)
         self.logger = logging.getLogger("PackTask")
         self.tar_run_dir = tar_run_dir
         self.backup_list = backup_list
+        self.streaming = streaming
+        self.compression = Compression(compression, compress_level, compress_workers,
+                                       compression_policy)
+        self.archive_stats = None
+        self.incremental = incremental
+        self.full_backup_interval = full_backup_interval
+        if incremental and chunk_store is not None:
+            raise ValueError("块存储不能与增量备份同时使用")
+        if hash_algorithm not in ALGORITHMS:
+            raise ValueError("不支持的摘要算法: {}".format(hash_algorithm))
+        self.hash_algorithm = hash_algorithm
+        self.chunk_store = None if chunk_store is None else ChunkStore.open(chunk_store)
+        self.chunk_store_keep = chunk_store_keep
+        self.state = (EncipherManager().namespace(task_name)
+                      if incremental or chunk_store is not None else None)
 
     def do_task(self) -> bool:
         """
@@ -61,43 +116,50 @@ class PackTask(Task):
         """
         self.logger.info("Task [%s]: 开始打包.", self.task_name)
 
+        plan = self._plan_incremental() if self.incremental else None
+        if plan is not None and not plan.full and not plan.changed and not plan.deleted:
+            self.logger.info("Task [%s]: 文件清单无变化，跳过任务。", self.task_name)
+            self.logger.info("Task [%s]: 结束打包.", self.task_name)
+            return False
+
+        suffix = ".tar" if self.chunk_store is not None else self.compression.tar_suffix()
         fd, temp_file = tempfile.mkstemp(
-            prefix="{}_backup_".format(self.task_name), suffix=".tgz", dir=self.output_dir)
+            prefix="{}_backup_".format(self.task_name), suffix=suffix, dir=self.output_dir)
         os.close(fd)
         stderr_fd, stderr_path = tempfile.mkstemp(
             prefix="{}_tar_".format(self.task_name), suffix=".stderr.log",
             dir=self.output_dir)
         try:
             with os.fdopen(stderr_fd, "wb") as stderr_file:
-                try:
-                    subprocess.run(
-                        ["tar", "zcf", temp_file, *self.backup_list],
-                        cwd=self.tar_run_dir,
-                        check=True,
-                        stderr=stderr_file,
-                    )
-                except subprocess.CalledProcessError as exc:
-                    stderr_file.flush()
-                    tar_error = _read_stderr_tail(stderr_path)
-                    self.logger.error(
-                        "Task [%s]: tar 失败，退出码=%s，stderr=%s",
-                        self.task_name, exc.returncode,
-                        tar_error or "<无错误输出>")
-                    raise
-            subprocess.run(["tar", "tzf", temp_file], check=True,
-                           stdout=subprocess.DEVNULL)
-            self.logger.info("Task [%s]: create temp file %s", self.task_name, temp_file)
-
-            digest = EncipherManager.digest(temp_file)
+                if self.chunk_store is not None:
+                    digest = self._create_snapshot(temp_file, stderr_file, stderr_path)
+                elif plan is not None and not plan.full:
+                    digest = self._create_incremental_archive(
+                        plan, temp_file, stderr_file, stderr_path)
+                elif (self.streaming or self.incremental or self.direct_upload is not None
+                      or not self.compression.is_tar_builtin()):
+                    digest = self._create_archive_streaming(
+                        temp_file, stderr_file, stderr_path, self.backup_list)
+                else:
+                    self._create_archive(temp_file, stderr_file, stderr_path)
+                    digest = EncipherManager.digest(temp_file)
             self.logger.info("Task [%s]: SHA-256 is %s", self.task_name, digest)
 
             now = datetime.datetime.now()
-            output_file_name = "{}_backup_{}_{}.tgz".format(
-                self.task_name, now.strftime("%y%m%d_%H%M%S"), digest)
-            self.set_output_file_name_and_full_path(output_file_name)
-            os.replace(temp_file, self.output_full_path)
-            self.logger.info("Task [%s]: rename file to %s",
-                             self.task_name, self.output_full_path)
+            if self.chunk_store is not None:
+                kind = "_snap"
+            else:
+                kind = "_inc" if plan is not None and not plan.full else ""
+            output_file_name = "{}_backup{}_{}_{}{}".format(
+                self.task_name, kind, now.strftime("%y%m%d_%H%M%S"), digest, suffix)
+            self.set_output_file_name_and_full_path(output_file_name, digest)
+            self.commit_output(temp_file)
+            if plan is not None:
+                # 清单随摘要状态一起，在备份及上传成功后提交，只写入变化的路径
+                self.state.set_manifest(plan.to_manifest(), entries=plan.updated_entries(),
+                                        removed=plan.deleted, replace=plan.replace)
+            if self.chunk_store is not None:
+                self._prune_snapshots()
         finally:
             if os.path.exists(temp_file):
                 os.remove(temp_file)
@@ -107,3 +169,247 @@ class PackTask(Task):
         self.logger.info("Task [%s]: 结束打包.", self.task_name)
 
         return True
+
+    def _log_tar_failure(self, returncode, stderr_file, stderr_path: str):
+        stderr_file.flush()
+        tar_error = _read_stderr_tail(stderr_path)
+        self.logger.error(
+            "Task [%s]: tar 失败，退出码=%s，stderr=%s",
+            self.task_name, returncode, tar_error or "<无错误输出>")
+
+    def _create_archive(self, temp_file: str, stderr_file, stderr_path: str):
+        """
+        先用 tar 生成归档，再整体读取一遍执行完整性检查。
+        """
+        try:
+            subprocess.run(
+                [*self.compression.tar_create_command(temp_file), *self.backup_list],
+                cwd=self.tar_run_dir,
+                check=True,
+                stderr=stderr_file,
+            )
+        except subprocess.CalledProcessError as exc:
+            self._log_tar_failure(exc.returncode, stderr_file, stderr_path)
+            raise
+        subprocess.run(["tar", "tzf", temp_file], check=True,
+                       stdout=subprocess.DEVNULL)
+        self.logger.info("Task [%s]: create temp file %s", self.task_name, temp_file)
+
+    def _create_archive_streaming(self, temp_file: str, stderr_file, stderr_path: str,
+                                  tar_args: list) -> str:
+        """
+        tar 输出到管道，单次读取的同时写入临时文件、计算摘要并校验压缩及 tar 结构。
+        使用 tar 自带 gzip 时，输出与 ``tar zcf`` 直接写文件的字节完全一致，
+        摘要和文件名不变；其它压缩方式由 tar 输出未压缩数据，在进程内并行压缩。
+        返回值: SHA-256 十六进制摘要
+        """
+        if self.compression.is_tar_builtin():
+            command = [*self.compression.tar_create_command("-"), *tar_args]
+            compressor = None
+            verifier = GzipStreamVerifier(TarStreamVerifier())
+        else:
+            command = ["tar", "cf", "-", *tar_args]
+            compressor = self.compression.create_compressor()
+            verifier = self.compression.create_verifier(TarStreamVerifier())
+        try:
+            with self.open_output(temp_file) as output_file:
+                stats = stream_command_to_file(command, self.tar_run_dir, output_file,
+                                               stderr_file, compressor, verifier)
+        except subprocess.CalledProcessError as exc:
+            self._log_tar_failure(exc.returncode, stderr_file, stderr_path)
+            raise
+        self.archive_stats = stats
+        self.logger.info("Task [%s]: create temp file %s", self.task_name, temp_file)
+        self.logger.info("Task [%s]: 压缩方式 %s，%s", self.task_name,
+                         self.compression.describe(), stats.describe())
+        if getattr(compressor, "adaptive", False):
+            self.logger.info("Task [%s]: 自适应压缩 %s", self.task_name,
+                             compressor.describe_savings())
+        return stats.digest
+
+    def _create_incremental_archive(self, plan, temp_file: str, stderr_file,
+                                    stderr_path: str) -> str:
+        """
+        只打包新增或变化的文件，并附带已删除路径列表。
+        返回值: SHA-256 十六进制摘要
+        """
+        self.logger.info("Task [%s]: 增量备份，变化 %s 个文件，删除 %s 个文件",
+                         self.task_name, len(plan.changed), len(plan.deleted))
+        meta_dir = tempfile.mkdtemp(prefix="{}_inc_".format(self.task_name),
+                                    dir=os.path.abspath(self.output_dir))
+        try:
+            list_path = os.path.join(meta_dir, "files.list")
+            with open(list_path, "wb") as fh:
+                for path in plan.changed:
+                    fh.write(os.fsencode(path) + b"\0")
+            with open(os.path.join(meta_dir, DELETED_LIST_NAME), "wb") as fh:
+                for path in plan.deleted:
+                    fh.write(os.fsencode(path) + b"\0")
+            tar_args = ["--no-recursion", "--verbatim-files-from", "--null", "-T", list_path,
+                        "-C", meta_dir, DELETED_LIST_NAME]
+            return self._create_archive_streaming(temp_file, stderr_file, stderr_path, tar_args)
+        finally:
+            shutil.rmtree(meta_dir, ignore_errors=True)
+
+    def _create_snapshot(self, temp_file: str, stderr_file, stderr_path: str) -> str:
+        """
+        tar 数据流切块写入块存储并提交快照，然后输出快照包：一个不压缩的 tar，包含快照
+        清单和本任务尚未上传过的 pack 文件，上传量约等于新增的数据。
+        已上传的 pack 文件列表随摘要状态一起，在备份及上传成功后提交。远端的旧快照包可能已被
+        清理，因此第一次运行以及每 full_backup_interval 个快照后输出完整快照包，包含快照引用的
+        全部 pack 文件，恢复时不依赖更早的快照包。
+        返回值: 快照包的 SHA-256 十六进制摘要
+        """
+        writer = self.chunk_store.writer(TarStreamVerifier())
+        try:
+            with open(os.devnull, "wb") as null_file:
+                try:
+                    stream_command_to_file(["tar", "cf", "-", *self.backup_list],
+                                           self.tar_run_dir, null_file, stderr_file, writer)
+                except subprocess.CalledProcessError as exc:
+                    self._log_tar_failure(exc.returncode, stderr_file, stderr_path)
+                    raise
+            now = datetime.datetime.now()
+            manifest = self.chunk_store.commit_snapshot(
+                writer, self.task_name,
+                "{}_{}".format(self.task_name, now.strftime("%y%m%d_%H%M%S_%f")))
+        finally:
+            writer.release()
+        self.logger.info("Task [%s]: 块存储快照 %s，%s", self.task_name, manifest["name"],
+                         writer.describe())
+
+        state = self.state.load_manifest()
+        snapshot_count = state.get("snapshot_count", 0) if state else 0
+        full = state is None or snapshot_count >= self.full_backup_interval
+        uploaded = set() if full else set(state.get("uploaded_packs", []))
+        packs = sorted(set(manifest["packs"].values()) - uploaded)
+        manifest_path = self.chunk_store.snapshot_path(manifest["name"])
+        with self.open_output(temp_file) as output_file:
+            archive_writer = ArchiveStreamWriter(output_file, TarStreamVerifier())
+            try:
+                with tarfile.open(fileobj=archive_writer, mode="w|",
+                                  format=tarfile.PAX_FORMAT) as bundle:
+                    bundle.add(manifest_path, arcname=SNAPSHOT_MANIFEST_NAME)
+                    for name in packs:
+                        bundle.add(os.path.join(self.chunk_store.pack_dir, name),
+                                   arcname="{}/{}".format(SNAPSHOT_PACK_DIR, name))
+                digest = archive_writer.finish()
+            except BaseException:
+                archive_writer.abort()
+                raise
+        self.logger.info("Task [%s]: %s快照包包含 %s 个 pack 文件，%s 字节", self.task_name,
+                         "完整" if full else "增量", len(packs), archive_writer.bytes_written)
+        existing = set(os.listdir(self.chunk_store.pack_dir))
+        self.state.set_manifest({
+            "version": MANIFEST_VERSION,
+            "uploaded_packs": sorted((uploaded | set(packs)) & existing),
+            "snapshot_count": 0 if full else snapshot_count + 1,
+        })
+        return digest
+
+    def _prune_snapshots(self):
+        """只保留最近 chunk_store_keep 个快照，并回收不再引用的数据块。"""
+        dropped = self.chunk_store.prune(self.task_name, self.chunk_store_keep)
+        if dropped:
+            self.logger.info("Task [%s]: 删除旧快照 %s", self.task_name, ", ".join(dropped))
+            self.chunk_store.gc()
+
+    def _plan_incremental(self):
+        """
+        对比文件清单，确定本次是全量还是增量备份以及变化的文件。
+        stat（大小、mtime、inode）未变化的文件沿用清单中的摘要，不重新读取。
+        """
+        manifest = self.state.load_manifest()
+        # 其它版本的清单格式不同，丢弃后重新全量备份
+        replace = manifest is not None and manifest.get("version") != MANIFEST_VERSION
+        if replace:
+            manifest = None
+        previous = self.state.load_manifest_entries() if manifest else {}
+        incremental_count = manifest.get("incremental_count", 0) if manifest else 0
+        full = manifest is None or incremental_count >= self.full_backup_interval
+
+        entries = {}
+        changed = []
+        for path, st in self._scan_files():
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            old = previous.get(path)
+            if old is not None and old[:3] == key:
+                digest = old[3]
+            else:
+                digest = self._file_digest(path, st)
+                if old is None or not self._same_content(path, st, old[3], digest):
+                    changed.append(path)
+            entries[path] = key + [digest]
+        deleted = sorted(set(previous) - set(entries))
+        return _IncrementalPlan(full, entries, changed, deleted,
+                                0 if full else incremental_count + 1, previous, replace)
+
+    def _scan_files(self):
+        """遍历 backup_list，生成 (相对 tar_run_dir 的路径, lstat 结果)，只包含普通文件和符号链接。"""
+        for entry in self.backup_list:
+            top = os.path.join(self.tar_run_dir, entry)
+            st = os.lstat(top)
+            if not stat.S_ISDIR(st.st_mode):
+                if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                    yield os.path.relpath(top, self.tar_run_dir), st
+                continue
+            for root, dirs, files in os.walk(top):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    full_path = os.path.join(root, name)
+                    st = os.lstat(full_path)
+                    if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                        yield os.path.relpath(full_path, self.tar_run_dir), st
+
+    def _file_digest(self, path: str, st, algorithm: str = None) -> str:
+        algorithm = algorithm or self.hash_algorithm
+        full_path = os.path.join(self.tar_run_dir, path)
+        if stat.S_ISLNK(st.st_mode):
+            hasher = new_hasher(algorithm)
+            hasher.update(os.fsencode(os.readlink(full_path)))
+            return hasher.hexdigest()
+        return EncipherManager.digest(full_path, algorithm)
+
+    def _same_content(self, path: str, st, recorded: str, digest: str) -> bool:
+        """清单中的摘要使用其它算法时（修改 hash_algorithm 之前的清单），按原算法重新计算后比较。"""
+        algorithm = token_algorithm(recorded)
+        if algorithm == token_algorithm(digest):
+            return recorded == digest
+        return algorithm in ALGORITHMS and self._file_digest(path, st, algorithm) == recorded
+
+
+class _IncrementalPlan():
+    """
+    一次增量备份的计划。
+
+    参数:
+        full  是否为全量备份
+        entries  新清单 {路径: [size, mtime_ns, inode, digest]}
+        changed  新增或内容变化的路径
+        deleted  自上次清单以来删除的路径
+        incremental_count  新清单中记录的、自上次全量以来的增量次数
+        previous  上次的清单 {路径: [size, mtime_ns, inode, digest]}
+        replace  保存时是否清空已有的清单条目（上次的清单版本不同时）
+    """
+
+    def __init__(self, full: bool, entries: dict, changed: list, deleted: list,
+                 incremental_count: int, previous: dict = None, replace: bool = False):
+        self.full = full
+        self.entries = entries
+        self.changed = changed
+        self.deleted = deleted
+        self.incremental_count = incremental_count
+        self.previous = previous or {}
+        self.replace = replace
+
+    def to_manifest(self) -> dict:
+        """转换为保存到状态中的清单头部。"""
+        return {
+            "version": MANIFEST_VERSION,
+            "incremental_count": self.incremental_count,
+        }
+
+    def updated_entries(self) -> dict:
+        """与上次清单相比新增或变化（包括只有 stat 变化）的条目。"""
+        return {path: entry for path, entry in self.entries.items()
+                if self.previous.get(path) != entry}
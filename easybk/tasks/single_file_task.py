@@ -7,10 +7,12 @@ Date: 2018-07-10
 import datetime
 import logging
 import os
-import shutil
+import uuid
 
 from .task import Task
 from ..encipher_manager import EncipherManager
+from ..file_copy import copy_file_fast, copy_file_with_digest
+from ..hashing import ALGORITHM_BLAKE2B_TREE, ALGORITHMS, DEFAULT_ALGORITHM, hash_file, parse_token
 
 
 class SingleFileTask(Task):
@@ -22,22 +24,34 @@ class SingleFileTask(Task):
         output_dir  备份输出目录
         source_file  需要备份的文件
         backup_on_change 是否在只有变更的时候才进行备份
+        paranoid 是否忽略 stat 缓存，每次都重新计算摘要
+        hash_algorithm 摘要算法，见 hashing 模块
     """
 
-    def __init__(self, task_name: str, output_dir: str, source_file: str, backup_on_change: bool = False):
+    # 只复制单个文件，耗时很短，默认不占用 CPU 和磁盘资源池，不必排在打包任务之后
+    DEFAULT_POOLS = ()
+
+    def __init__(self, task_name: str, output_dir: str, source_file: str, backup_on_change: bool = False,
+                 paranoid: bool = False, hash_algorithm: str = DEFAULT_ALGORITHM):
         """
         参数:
             task_name  任务名
             output_dir  备份输出目录
             source_file  需要备份的文件
             backup_on_change  是否在只有变更的时候才进行备份
+            paranoid  是否忽略 stat 缓存，每次都重新计算摘要
+            hash_algorithm  摘要算法，sha256 / blake2b / blake2b-tree，见 hashing 模块
         """
         # super(SingleFileTask, self).__init__(name)
         Task.__init__(self, task_name, output_dir)
         self.logger = logging.getLogger("SingleFileTask")
         self.backup_file = source_file
-        self.encipher_manager = EncipherManager()
+        self.state = EncipherManager().namespace(task_name)
         self.backup_on_change = backup_on_change
+        self.paranoid = paranoid
+        if hash_algorithm not in ALGORITHMS:
+            raise ValueError("不支持的摘要算法: {}".format(hash_algorithm))
+        self.hash_algorithm = hash_algorithm
 
 
     def do_task(self) -> bool:
@@ -47,42 +61,83 @@ class SingleFileTask(Task):
         """
         self.logger.info("Task [%s]: 开始备份单文件.", self.task_name)
 
-        # 计算用于变化检测的 SHA-256 摘要
-        digest = EncipherManager.digest(self.backup_file)
-        self.logger.info("Task [%s]: SHA-256 is %s", self.task_name, digest)
-
-        should_backup = False
-        digest_changed = self.encipher_manager.check_if_has_changed(self.backup_file, digest)
-
-        if self.backup_on_change:
-            if digest_changed:
-                self.logger.info("Task [%s]: 文件摘要已变化", self.task_name)
+        # stat 签名未变化时沿用记录的摘要，否则重新计算。backup_on_change 时先只计算摘要，
+        # 内容变化才复制，只被 touch 的文件不会复制；一定要备份时边复制到临时文件边计算，
+        # 只读一次文件。blake2b-tree 总是先多线程计算摘要，需要备份时再在内核中复制
+        file_stat = EncipherManager.stat_signature(self.backup_file)
+        digest = None
+        if not self.paranoid:
+            digest = self.state.get_cached_digest(self.backup_file, file_stat)
+        temp_path = None
+        try:
+            if digest is not None:
+                self.logger.info("Task [%s]: 文件 stat 未变化，沿用记录的摘要", self.task_name)
+            elif self.backup_on_change or \
+                    (self.hash_algorithm == ALGORITHM_BLAKE2B_TREE and file_stat is not None):
+                digest = hash_file(self.backup_file, self.hash_algorithm)
+            else:
+                temp_path = self._make_temp_path()
+                digest = copy_file_with_digest(self.backup_file, temp_path, self.hash_algorithm)
+            self.logger.info("Task [%s]: 摘要 %s", self.task_name, digest)
+
+            should_backup = False
+            digest_changed = self.state.has_content_changed(self.backup_file, digest)
+
+            if self.backup_on_change:
+                if digest_changed:
+                    self.logger.info("Task [%s]: 文件摘要已变化", self.task_name)
+                    should_backup = True
+                else:
+                    self.logger.info(
+                        "Task [%s]: 文件摘要未变化，跳过任务。", self.task_name)
+                    should_backup = False
+            else:
+                # 直接备份
                 should_backup = True
+
+            if should_backup:
+                if temp_path is None:
+                    temp_path = self._make_temp_path()
+                    if file_stat is None:
+                        # 文件刚被修改，无法通过 stat 确认复制期间未变化，边复制边重新计算摘要
+                        digest = copy_file_with_digest(self.backup_file, temp_path,
+                                                       self.hash_algorithm)
+                    else:
+                        method = copy_file_fast(self.backup_file, temp_path)
+                        self.logger.info("Task [%s]: 复制方式 %s", self.task_name, method)
+                        # 摘要不是边复制边计算的，复制期间文件变化时备份内容与摘要不符
+                        if EncipherManager.stat_signature(self.backup_file) != file_stat:
+                            raise RuntimeError("复制期间文件发生变化: {}".format(self.backup_file))
+
+                # 重命名文件
+                now = datetime.datetime.now()
+                output_file_name = "{}.{}_{}".format(
+                    self.task_name, now.strftime("%y%m%d_%H%M%S"), parse_token(digest)[1])
+                self.set_output_file_name_and_full_path(output_file_name, digest)
+
+                self.logger.info("Task [%s]: copy file from %s to %s",
+                                 self.task_name, self.backup_file, self.output_full_path)
+                os.replace(temp_path, self.output_full_path)
+                temp_path = None
+
+                if digest_changed:
+                    self.state.set_value(self.backup_file, digest, file_stat)
+
+                result = True
             else:
-                self.logger.info(
-                    "Task [%s]: 文件摘要未变化，跳过任务。", self.task_name)
-                should_backup = False
-        else:
-            # 直接备份
-            should_backup = True
-
-        if should_backup:
-            # 重命名文件
-            now = datetime.datetime.now()
-            output_file_name = "{}.{}_{}".format(
-                self.task_name, now.strftime("%y%m%d_%H%M%S"), digest)
-            self.set_output_file_name_and_full_path(output_file_name)
-
-            self.logger.info("Task [%s]: copy file from %s to %s",
-                             self.task_name, self.backup_file, self.output_full_path)
-            shutil.copyfile(self.backup_file, self.output_full_path)
-
-            if digest_changed:
-                self.encipher_manager.set_value(self.backup_file, digest)
-
-            result = True
-        else:
-            result = False
+                result = False
+        finally:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        if not digest_changed and (self.state.get_value(self.backup_file) != digest or
+                                   not self.state.is_stat_current(self.backup_file, file_stat)):
+            # 内容未变但 stat 变化（例如 touch）或记录使用其它算法，更新记录以便下次直接跳过
+            self.state.set_value(self.backup_file, digest, file_stat)
 
         self.logger.info("Task [%s]: 结束备份.", self.task_name)
         return result
+
+    def _make_temp_path(self) -> str:
+        """输出目录中的临时文件名，写完后通过 os.replace 原子地改为正式文件名。"""
+        return os.path.join(self.output_dir, ".{}.{}.tmp".format(self.task_name, uuid.uuid4().hex))
@@ -5,6 +5,7 @@ Date: 2018-07-10
 
 
 import abc
+import contextlib
 import logging
 import os
 
@@ -15,6 +16,9 @@ class Task():
     """
     __metaclass__ = abc.ABCMeta
 
+    # 未配置 pools 时占用的资源池
+    DEFAULT_POOLS = ("cpu", "disk")
+
     def __init__(self, task_name: str, output_dir: str):
         """
         参数:
@@ -27,6 +31,9 @@ class Task():
         self.output_dir = output_dir
         self.output_file_name = None
         self.output_full_path = None
+        self.output_digest = None
+        self.pools = None
+        self.direct_upload = None
 
 
     def get_name(self) -> str:
@@ -41,6 +48,66 @@ class Task():
         """
         return self.result
 
+    def get_output_dir(self) -> str:
+        """
+        获取备份输出目录
+        """
+        return self.output_dir
+
+    def get_pools(self) -> list:
+        """
+        获取任务占用的资源池名称，未设置时返回 DEFAULT_POOLS
+        """
+        return list(self.DEFAULT_POOLS) if self.pools is None else self.pools
+
+    def set_pools(self, pools: list):
+        """
+        设置任务占用的资源池
+        参数:
+            pools: 资源池名称列表，"disk" 表示输出目录所在磁盘
+        """
+        self.pools = list(pools) if pools is not None else None
+
+    def get_direct_upload(self):
+        """
+        获取直传对象，未启用直传时为 None
+        """
+        return self.direct_upload
+
+    def set_direct_upload(self, direct_upload):
+        """
+        设置直传对象（DirectUpload），设置后归档边生成边上传，不写入本地输出文件
+        """
+        self.direct_upload = direct_upload
+
+    @contextlib.contextmanager
+    def open_output(self, temp_path: str):
+        """
+        打开备份输出：默认写入本地临时文件；直传时返回 DirectUpload，
+        出现异常时中止直传并删除已上传的临时文件
+        """
+        if self.direct_upload is None:
+            with open(temp_path, "wb") as output_file:
+                yield output_file
+            return
+        self.logger.info("Task [%s]: 直传模式，不生成本地归档", self.task_name)
+        self.direct_upload.start()
+        try:
+            yield self.direct_upload
+        except BaseException as exc:
+            self.direct_upload.abort(exc)
+            raise
+
+    def commit_output(self, temp_path: str):
+        """
+        设置最终文件名后调用：把临时文件改为最终文件；直传时把远端临时文件提交为最终名称
+        """
+        if self.direct_upload is None:
+            os.replace(temp_path, self.output_full_path)
+            self.logger.info("Task [%s]: rename file to %s", self.task_name, self.output_full_path)
+        else:
+            self.direct_upload.commit(self)
+
     def run(self) -> bool:
         """
         执行备份任务并上传
@@ -53,7 +120,12 @@ class Task():
                              self.task_name, self.output_dir)
             os.makedirs(self.output_dir, exist_ok=True)
 
-        self.result = self.do_task()
+        try:
+            self.result = self.do_task()
+        except BaseException as exc:
+            if self.direct_upload is not None:
+                self.direct_upload.abort(exc)
+            raise
         return self.result
 
     @abc.abstractmethod
@@ -65,14 +137,16 @@ class Task():
         """
         raise NotImplementedError("Task.do_task")
 
-    def set_output_file_name_and_full_path(self, output_file_name: str):
+    def set_output_file_name_and_full_path(self, output_file_name: str, digest: str = None):
         """
         设置备份出来的文件名
         参数:
             output_file_name: 备份出来的文件名
+            digest: 备份文件内容的摘要（状态令牌，见 hashing 模块），用于上传去重
         """
         self.output_file_name = output_file_name
         self.output_full_path = os.path.join(self.output_dir, self.output_file_name)
+        self.output_digest = digest
 
     def get_output_file_name(self) -> str:
         """
@@ -80,8 +154,52 @@ class Task():
         """
         return self.output_file_name
 
+    def get_output_digest(self) -> str:
+        """
+        返回备份文件的摘要（默认 SHA-256），未知时为 None
+        """
+        return self.output_digest
+
     def get_output_full_path(self) -> str:
         """
         返回备份出来的文件的绝对路径
         """
         return self.output_full_path
+
+    def get_outputs(self) -> list:
+        """
+        返回需要上传的输出，每项提供 get_output_file_name / get_output_full_path /
+        get_output_digest。默认只有任务自身的输出文件；一次输出多个文件的任务返回
+        OutputFile 列表，上传器逐个上传。
+        """
+        return [self]
+
+
+class OutputFile():
+    """
+    任务输出中的单个文件，见 Task.get_outputs
+
+    参数:
+        task  所属任务
+        file_name  上传时的文件名，可以包含子目录
+        full_path  本地文件路径
+        digest  文件内容的摘要，用于上传去重
+    """
+
+    def __init__(self, task: Task, file_name: str, full_path: str, digest: str = None):
+        self.task = task
+        self.output_file_name = file_name
+        self.output_full_path = full_path
+        self.output_digest = digest
+
+    def get_name(self) -> str:
+        return self.task.get_name()
+
+    def get_output_file_name(self) -> str:
+        return self.output_file_name
+
+    def get_output_full_path(self) -> str:
+        return self.output_full_path
+
+    def get_output_digest(self) -> str:
+        return self.output_digest
@@ -5,8 +5,10 @@ Date: 2025-10-31
 
 
 import logging
+import os
 from concurrent.futures import ThreadPoolExecutor
 
+from .fanout import fanout_file
 from .tasks import Task
 from .uploaders import Uploader
 
@@ -72,7 +74,15 @@ class UploadTask():
                 "UploadTask [%s -> %s]: 准备上传任务[%s]",
                 self.task.get_name(), self.uploader.get_name(), self.task.get_name())
 
-            result = self.uploader.do_upload(self.task, self.remote_dir)
+            direct_upload = self.task.get_direct_upload()
+            if direct_upload is not None:
+                # 备份时已经直传，只汇报结果
+                result = direct_upload.result_of(self)
+            else:
+                # 一次输出多个文件的任务逐个上传，全部成功才算成功
+                results = [self.uploader.upload(output, self.remote_dir)
+                           for output in self.task.get_outputs()]
+                result = all(results)
 
             if result:
                 self.logger.info(
@@ -132,28 +142,95 @@ class UploadManager():
             self.logger.info("没有上传任务，跳过上传任务。")
             return True
 
-        def _run_upload_task(index, ut):
-            try:
-                self.logger.info("准备执行第 %s 个上传任务: [%s -> %s]", index, ut.get_task().get_name(), ut.get_uploader().get_name())
-                result = ut.run()
-                if result or not ut.get_task().get_result():
-                    self.logger.info("上传任务 [%s]: 执行完成: [%s -> %s]", index, ut.get_task().get_name(), ut.get_uploader().get_name())
-                    return True
-                return False
-            except Exception:
-                self.logger.exception("UploadTask [%s]: 执行发生异常。: [%s -> %s]", index, ut.get_task().get_name(), ut.get_uploader().get_name())
-                return False
-
         results = []
         if use_thread_pool and upload_task_count > 0:
             with ThreadPoolExecutor(max_workers=min(max_workers, upload_task_count)) as executor:
-                futures = [executor.submit(_run_upload_task, idx, ut) for idx, ut in enumerate(self.upload_task_list, start=1)]
+                futures = [executor.submit(self.run_upload_task, idx, ut) for idx, ut in enumerate(self.upload_task_list, start=1)]
                 for f in futures:
                     results.append(f.result())
         else:
-            results = [_run_upload_task(index, upload_task)
+            results = [self.run_upload_task(index, upload_task)
                        for index, upload_task in enumerate(self.upload_task_list, start=1)]
 
+        self.close_uploaders()
         self.logger.info("上传任务执行完毕！")
         return all(results)
 
+    def run_upload_task(self, index: int, upload_task: UploadTask) -> bool:
+        """
+        执行单个上传任务
+        :param index: 上传任务序号，仅用于日志
+        :param upload_task: 上传任务
+        返回值:
+            上传成功，或对应备份任务没有生成新备份时为 True
+        """
+        ut = upload_task
+        try:
+            self.logger.info("准备执行第 %s 个上传任务: [%s -> %s]", index, ut.get_task().get_name(), ut.get_uploader().get_name())
+            result = ut.run()
+            if result or not ut.get_task().get_result():
+                self.logger.info("上传任务 [%s]: 执行完成: [%s -> %s]", index, ut.get_task().get_name(), ut.get_uploader().get_name())
+                return True
+            return False
+        except Exception:
+            self.logger.exception("UploadTask [%s]: 执行发生异常。: [%s -> %s]", index, ut.get_task().get_name(), ut.get_uploader().get_name())
+            return False
+
+    def run_fanout_upload(self, uploads: list) -> list:
+        """
+        读一次、多路上传：同一备份任务的多个上传任务共用一次文件读取
+        :param uploads: [(序号, 上传任务)]，属于同一备份任务，上传器各不相同且都支持流式上传
+        返回值:
+            与 uploads 顺序一致的每个上传任务的结果；流式上传失败的上传任务
+            改为单独读取文件上传（可续传、重试），结果以此为准
+        """
+        task = uploads[0][1].get_task()
+        path = task.get_output_full_path()
+        if not task.get_result() or not path or not os.path.isfile(path):
+            return [self.run_upload_task(index, ut) for index, ut in uploads]
+        # 远端已有相同内容的上传不需要数据，按普通上传任务跳过或引用
+        duplicates = [(index, ut) for index, ut in uploads
+                      if ut.get_uploader().find_duplicate(task) is not None]
+        if len(uploads) - len(duplicates) < 2:
+            return [self.run_upload_task(index, ut) for index, ut in uploads]
+
+        size = os.path.getsize(path)
+        self.logger.info("读一次多路上传: [%s -> %s]，%s 字节", task.get_name(),
+                         ", ".join(ut.get_uploader().get_name() for index, ut in uploads
+                                   if (index, ut) not in duplicates), size)
+        consumers = {
+            index: (lambda stream, ut=ut: ut.get_uploader().upload_stream(
+                task, ut.get_remote_dir(), stream, size))
+            for index, ut in uploads if (index, ut) not in duplicates
+        }
+        outcomes = fanout_file(path, consumers)
+
+        results = []
+        for index, ut in uploads:
+            if (index, ut) in duplicates:
+                results.append(self.run_upload_task(index, ut))
+                continue
+            outcome = outcomes.get(index)
+            if outcome is True:
+                ut.get_uploader().record_upload(task, ut.get_remote_dir())
+                self.logger.info("上传任务 [%s]: 执行完成: [%s -> %s]", index, task.get_name(), ut.get_uploader().get_name())
+                results.append(True)
+                continue
+            self.logger.warning("上传任务 [%s]: 多路上传失败，改为单独上传: [%s -> %s]: %s",
+                                index, task.get_name(), ut.get_uploader().get_name(), outcome)
+            results.append(self.run_upload_task(index, ut))
+        return results
+
+    def close_uploaders(self):
+        """
+        关闭所有上传器持有的连接
+        """
+        uploaders = []
+        for upload_task in self.upload_task_list:
+            if not any(upload_task.get_uploader() is uploader for uploader in uploaders):
+                uploaders.append(upload_task.get_uploader())
+        for uploader in uploaders:
+            try:
+                uploader.close()
+            except Exception:
+                self.logger.warning("关闭上传器失败: [%s]", uploader.get_name())
@@ -0,0 +1,68 @@
+"""
+上传去重索引：记录某个上传器上已经存在的内容摘要及其远端路径
+"""
+
+
+import json
+import logging
+import os
+import threading
+
+from ..state_store import _atomic_write
+
+
+DEDUP_MODES = ("off", "skip", "copy", "symlink")
+
+
+class DedupIndex():
+    """
+    本地保存的 {SHA-256 摘要: 远端路径} 索引，每次记录后原子地写回文件。
+
+    参数:
+        file_name: 索引文件路径，不存在时视为空索引
+    """
+
+    def __init__(self, file_name: str):
+        self.logger = logging.getLogger("DedupIndex")
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.file_name):
+                with open(self.file_name, "r", encoding="utf-8") as fh:
+                    self._entries = json.load(fh)
+        return self._entries
+
+    def _save(self):
+        _atomic_write(self.file_name,
+                      lambda fh: json.dump(self._entries, fh, ensure_ascii=False, indent=1,
+                                           sort_keys=True))
+
+    def lookup(self, digest: str):
+        """
+        返回已上传过该摘要的远端路径，没有记录时返回 None
+        """
+        with self._lock:
+            return self._load().get(digest)
+
+    def record(self, digest: str, remote_path: str):
+        """
+        记录摘要对应的远端路径；已有记录时保留原路径，作为后续引用的源
+        """
+        with self._lock:
+            entries = self._load()
+            if digest in entries:
+                return
+            entries[digest] = remote_path
+            self._save()
+
+    def forget(self, digest: str):
+        """
+        删除失效的记录（例如远端对象已被清理）
+        """
+        with self._lock:
+            if self._load().pop(digest, None) is not None:
+                self._save()
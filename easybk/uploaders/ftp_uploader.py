@@ -4,15 +4,39 @@ Date: 2025-10-30
 """
 
 
+import contextlib
 import logging
 import os
 import posixpath
+import threading
+import time
 import uuid
 from ftplib import FTP, FTP_TLS, error_perm
 
 from .uploader import Uploader, Task
 
 
+class _CountingReader():
+    """
+    包装只读流，统计读取的字节数。storbinary 只在服务器接受命令、数据连接建立后
+    才读取数据，started 为 True 说明数据已经开始传输（空文件同样如此）。
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self.started = False
+
+    def read(self, size: int = -1) -> bytes:
+        self.started = True
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset: int):
+        self.stream.seek(offset)
+
+
 class FTPClient():
     """
     轻量 FTP 客户端封装，支持TLS及被动模式
@@ -28,6 +52,23 @@ class FTPClient():
         self.passive = passive
         self._ftp = None
         self._connected = False
+        # 已确认存在的远程目录（绝对路径），目录不会因重连而消失，重连后继续使用
+        self._known_dirs = set()
+        # 服务器是否接受带路径的 STOR/SIZE/RNFR 等命令，拒绝时退回逐级 cwd
+        self._use_paths = True
+        self._cwd = None
+        # 控制连接上发送的命令数，每条命令对应一次往返
+        self.command_count = 0
+
+    def _count_commands(self, ftp):
+        """包装 putcmd，统计控制连接上发送的命令数。"""
+        putcmd = ftp.putcmd
+
+        def counting_putcmd(line):
+            self.command_count += 1
+            return putcmd(line)
+
+        ftp.putcmd = counting_putcmd
 
     def _connect(self):
         if self._ftp is not None and self._connected:
@@ -37,6 +78,7 @@ class FTPClient():
             ftp = FTP_TLS()
         else:
             ftp = FTP()
+        self._count_commands(ftp)
         ftp.connect(self.host, self.port, timeout=60)
         ftp.login(self.username, self.password)
         # TLS模式：保护数据。要在登录和cwd后调用prot_p
@@ -51,30 +93,84 @@ class FTPClient():
             self.logger.warning("FTPUploader: 设置被动模式失败。")
         self._ftp = ftp
         self._connected = True
+        self._cwd = None
         self.logger.info("FTPUploader: FTP 连接完成")
 
+    @staticmethod
+    def _absolute_dir(remote_dir: str) -> str:
+        """把相对根目录的远程目录转换为绝对路径，没有目录时返回空字符串。"""
+        # 使用 POSIX 分隔符，避免 Windows 反斜杠
+        parts = [p for p in remote_dir.replace('\\', '/').split('/') if p and p != '.']
+        return "/" + "/".join(parts) if parts else ""
+
     def _ensure_dir(self, remote_dir: str):
         """
-        确保远程目录存在（逐级创建）。
+        确保远程目录存在（逐级创建），已确认存在的目录直接跳过。
         """
-        if not remote_dir or remote_dir in ("/", "."):
+        absolute_dir = self._absolute_dir(remote_dir)
+        if not absolute_dir or absolute_dir in self._known_dirs:
             return
-        # 使用 POSIX 分隔符，避免 Windows 反斜杠
-        parts = [p for p in remote_dir.split('/') if p and p != '.']
-        if not parts:
-            return
-        cwd_backup = self._ftp.pwd()
         try:
-            # 从根或当前目录开始逐级进入/创建
-            for part in parts:
+            # 目录通常已经存在，一次 CWD 即可确认
+            self._ftp.cwd(absolute_dir)
+            self._cwd = absolute_dir
+        except error_perm:
+            prefix = ""
+            for part in absolute_dir.strip("/").split("/"):
+                prefix += "/" + part
+                if prefix in self._known_dirs:
+                    continue
                 try:
-                    self._ftp.cwd(part)
+                    self._ftp.mkd(prefix)
                 except error_perm:
-                    self._ftp.mkd(part)
-                    self._ftp.cwd(part)
-        finally:
-            # 回到原目录
-            self._ftp.cwd(cwd_backup)
+                    # 已经存在，或已被另一个连接上的并发上传创建
+                    pass
+        prefix = ""
+        for part in absolute_dir.strip("/").split("/"):
+            prefix += "/" + part
+            self._known_dirs.add(prefix)
+
+    def _target(self, remote_path: str) -> str:
+        """
+        返回命令中使用的远程文件名：支持时使用绝对路径，省去切换目录；
+        否则切换到文件所在目录（已在该目录时不再发送 CWD）并返回文件名。
+        """
+        remote_path = remote_path.replace('\\', '/')
+        absolute_dir = self._absolute_dir(posixpath.dirname(remote_path))
+        remote_name = posixpath.basename(remote_path)
+        if not absolute_dir:
+            return remote_name
+        if self._use_paths:
+            return posixpath.join(absolute_dir, remote_name)
+        if self._cwd != absolute_dir:
+            self._ftp.cwd(absolute_dir)
+            self._cwd = absolute_dir
+        return remote_name
+
+    def _path_command(self, remote_path: str, command, reader: _CountingReader = None):
+        """
+        以 command(远程文件名) 执行带文件名的命令。带路径的命令被拒绝（error_perm）时，
+        切换到文件所在目录用文件名重试一次；只有重试成功才认定服务器不接受带路径的命令，
+        之后改为切换目录。文件不存在、没有权限等错误重试同样失败，不影响后续命令。
+        reader 为命令发送的数据流：数据开始传输后的错误（例如传输结束后的 552 空间不足）
+        与路径无关，不重试，避免重新发送整个文件或重读已经耗尽的流。
+        """
+        remote_name = self._target(remote_path)
+        try:
+            return command(remote_name)
+        except error_perm as e:
+            if not (self._use_paths and "/" in remote_name) or \
+                    (reader is not None and reader.started):
+                raise
+            error = e
+        self._use_paths = False
+        try:
+            result = command(self._target(remote_path))
+        except Exception:
+            self._use_paths = True
+            raise
+        self.logger.info("FTPUploader: 服务器不接受带路径的命令，改为切换目录: %s", error)
+        return result
 
     def put_file(self, remote_path: str, local_path: str, retry: int = 3):
         """
@@ -86,39 +182,33 @@ class FTPClient():
                 if not os.path.isfile(local_path):
                     raise FileNotFoundError(local_path)
 
-                # 归一化远程路径为 POSIX 路径
-                remote_path = remote_path.replace('\\', '/')
-                remote_dir = posixpath.dirname(remote_path)
-                remote_name = posixpath.basename(remote_path)
-
-                if remote_dir and remote_dir not in ("/", "."):
-                    # 切换到根目录，逐级创建
-                    try:
-                        self._ftp.cwd('/')
-                    except Exception:
-                        # 某些服务器不支持，忽略
-                        pass
-                    self._ensure_dir(remote_dir)
-
-                # 进入目标目录（如果有）
-                if remote_dir and remote_dir not in ("/", "."):
-                    for part in [p for p in remote_dir.split('/') if p and p != '.']:
-                        self._ftp.cwd(part)
+                self._ensure_dir(posixpath.dirname(remote_path.replace('\\', '/')))
+                local_size = os.path.getsize(local_path)
 
                 with open(local_path, 'rb') as f:
-                    self._ftp.storbinary(f'STOR {remote_name}', f)
+                    reader = _CountingReader(f)
 
-                remote_size = self._ftp.size(remote_name)
-                local_size = os.path.getsize(local_path)
+                    def store(remote_name):
+                        # 重试时从远端已有的部分继续，避免重新发送整个文件
+                        offset = self._resume_offset(remote_name, local_size) if t > 0 else 0
+                        if offset == 0:
+                            self._ftp.storbinary(f'STOR {remote_name}', reader)
+                        elif offset < local_size:
+                            self.logger.info("FTPUploader: 从 %d/%d 字节处续传 %s",
+                                             offset, local_size, remote_name)
+                            self._store_from(remote_name, reader, offset)
+                        return self._ftp.size(remote_name)
+
+                    remote_size = self._path_command(remote_path, store, reader)
                 if remote_size != local_size:
                     raise IOError("FTP 上传后大小校验失败: 本地={}, 远端={}".format(
                         local_size, remote_size))
 
                 self.logger.info("FTPUploader: 文件 %s 上传完成", local_path)
-                # 上传后回到根
-                self._ftp.cwd("/")
                 return  # 成功
             except Exception as e:
+                # 目录可能已被删除，失败后重新确认
+                self._known_dirs.clear()
                 if t < retry - 1:
                     self.logger.warning("FTPUploader: 上传失败，第%d次重试: %s", t+1, str(e))
                     # 断线重连
@@ -128,21 +218,206 @@ class FTPClient():
                     self.logger.error("FTPUploader: 上传失败已重试%d次，放弃：%s", retry, str(e))
                     raise
 
+    def put_stream(self, remote_path: str, stream, size: int = None) -> int:
+        """
+        将只读流上传到远程路径（包含文件名）。流无法回退，失败时不重试。
+        size 为 None 时按实际读取的字节数校验。
+        返回值: 上传的字节数
+        """
+        reader = _CountingReader(stream)
+        try:
+            self._connect()
+            self._ensure_dir(posixpath.dirname(remote_path.replace('\\', '/')))
+            # 只有 STOR 在数据传输前被拒绝时才会切换目录重试，已读取的流不会再次发送
+            self._path_command(
+                remote_path, lambda remote_name: self._ftp.storbinary(f'STOR {remote_name}', reader),
+                reader)
+            size = reader.bytes_read if size is None else size
+            remote_size = self._path_command(remote_path, self._ftp.size)
+            if remote_size != size:
+                raise IOError("FTP 上传后大小校验失败: 本地={}, 远端={}".format(size, remote_size))
+        except Exception:
+            self._known_dirs.clear()
+            raise
+        self.logger.info("FTPUploader: 流式上传 %s 完成", remote_path)
+        return size
+
+    def _resume_offset(self, remote_name: str, local_size: int) -> int:
+        """
+        返回可以续传的偏移量：远端已有部分文件的大小；无法获取或大于本地文件时为 0。
+        """
+        try:
+            # 部分服务器在 ASCII 模式下拒绝 SIZE
+            self._ftp.voidcmd("TYPE I")
+            remote_size = self._ftp.size(remote_name)
+        except error_perm:
+            return 0
+        if remote_size is None or remote_size > local_size:
+            return 0
+        return remote_size
+
+    def file_size(self, remote_path: str):
+        """
+        返回远端文件的大小，文件或所在目录不存在时返回 None
+        """
+        self._connect()
+        self._ftp.voidcmd("TYPE I")
+        try:
+            return self._path_command(remote_path, self._ftp.size)
+        except error_perm:
+            return None
+
+    def _store_from(self, remote_name: str, reader: _CountingReader, offset: int):
+        """
+        从 offset 开始续传：优先 REST + STOR，不支持时使用 APPE，都不支持时完整重传。
+        只有命令在数据传输前被拒绝才换用下一种方式，传输开始后的错误直接抛出。
+        """
+        reader.seek(offset)
+        try:
+            self._ftp.storbinary(f'STOR {remote_name}', reader, rest=offset)
+            return
+        except error_perm as e:
+            if reader.started:
+                raise
+            self.logger.info("FTPUploader: 服务器不支持 REST 续传: %s", e)
+        try:
+            self._ftp.storbinary(f'APPE {remote_name}', reader)
+            return
+        except error_perm as e:
+            if reader.started:
+                raise
+            self.logger.info("FTPUploader: 服务器不支持 APPE 续传，完整重传: %s", e)
+        reader.seek(0)
+        self._ftp.storbinary(f'STOR {remote_name}', reader)
+
+    def is_alive(self) -> bool:
+        """使用 NOOP 检查控制连接是否仍然可用。"""
+        if self._ftp is None or not self._connected:
+            return False
+        try:
+            self._ftp.voidcmd("NOOP")
+            return True
+        except Exception:
+            return False
+
+    def disconnect(self):
+        """关闭连接，下次使用时重新登录。"""
+        ftp = self._ftp
+        self._ftp = None
+        self._connected = False
+        if ftp is None:
+            return
+        try:
+            ftp.quit()
+        except Exception:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
     def rename_file(self, source_path: str, target_path: str):
         """将同一远端目录中的临时文件原子改名为最终文件。"""
-        source_path = source_path.replace('\\', '/')
-        target_path = target_path.replace('\\', '/')
         self._connect()
-        self._ftp.rename(source_path, target_path)
+        self._path_command(source_path,
+                           lambda source: self._ftp.rename(source, self._target(target_path)))
 
     def remove_file(self, remote_path: str):
         try:
             self._connect()
-            self._ftp.delete(remote_path.replace('\\', '/'))
+            self._path_command(remote_path, self._ftp.delete)
         except Exception:
             self.logger.warning("FTPUploader: 清理远端临时文件失败: %s", remote_path)
 
 
+class FTPConnectionPool():
+    """
+    已登录 FTP/FTPS 连接池，供同一个上传器的多个上传任务并发使用
+
+    参数：
+        max_size: 最大连接数，超过时等待其他上传归还连接
+        idle_timeout: 空闲超过该秒数的连接在下次取用前关闭
+        health_check_interval: 空闲超过该秒数的连接在取用前发送 NOOP 检查
+        其余参数同 FTPClient
+    """
+
+    def __init__(self, host: str, port: int, username: str, password: str, logger: logging.Logger,
+                 secure: bool = False, passive: bool = True, max_size: int = 1,
+                 idle_timeout: float = 60, health_check_interval: float = 5):
+        if max_size < 1:
+            raise ValueError("max_size must be positive!")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.logger = logger
+        self.secure = secure
+        self.passive = passive
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # (client, 归还时间)，最近归还的在末尾
+        self._idle = []
+
+    def _new_client(self) -> FTPClient:
+        return FTPClient(self.host, self.port, self.username, self.password, self.logger,
+                         secure=self.secure, passive=self.passive)
+
+    def _take_idle(self):
+        """取出最近归还且仍可用的连接，顺带关闭超时的空闲连接。"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [client for client, returned in self._idle
+                       if now - returned > self.idle_timeout]
+            self._idle = [(client, returned) for client, returned in self._idle
+                          if now - returned <= self.idle_timeout]
+            candidate = self._idle.pop() if self._idle else (None, now)
+        for client in expired:
+            self.logger.info("FTPUploader: 关闭空闲连接 %s:%s", self.host, self.port)
+            client.disconnect()
+        return candidate[0], now - candidate[1]
+
+    def _checkout(self) -> FTPClient:
+        while True:
+            client, idle_seconds = self._take_idle()
+            if client is None:
+                return self._new_client()
+            # 刚归还的连接直接复用，省去一次 NOOP 往返
+            if idle_seconds <= self.health_check_interval or client.is_alive():
+                return client
+            self.logger.info("FTPUploader: 连接已失效，重新连接 %s:%s", self.host, self.port)
+            client.disconnect()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        借出一个连接，退出时归还；执行中出现异常的连接直接关闭，不再复用
+        """
+        self._slots.acquire()
+        client = None
+        try:
+            client = self._checkout()
+            yield client
+        except BaseException:
+            if client is not None:
+                client.disconnect()
+                client = None
+            raise
+        finally:
+            if client is not None:
+                with self._lock:
+                    self._idle.append((client, time.monotonic()))
+            self._slots.release()
+
+    def close(self):
+        """关闭所有空闲连接。"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client, _ in idle:
+            client.disconnect()
+
+
 class FTPUploader(Uploader):
     """
     FTP 上传器
@@ -155,10 +430,13 @@ class FTPUploader(Uploader):
         password: FTP 密码
         secure: 是否启用FTP_TLS
         passive: 是否使用被动模式
+        max_connections: 连接池最大连接数，即同时进行的上传数
+        idle_timeout: 空闲连接保留的秒数
     """
 
-    def __init__(self, name: str, host: str, port: int, username: str, password: str, secure: bool = False, passive: bool = True):
-        Uploader.__init__(self, name)
+    def __init__(self, name: str, host: str, port: int, username: str, password: str, secure: bool = False, passive: bool = True,
+                 max_connections: int = 1, idle_timeout: float = 60):
+        Uploader.__init__(self, name, max_connections)
         self.logger = logging.getLogger("FTPUploader")
         self.host = host
         self.port = port
@@ -166,7 +444,9 @@ class FTPUploader(Uploader):
         self.password = password
         self.secure = secure
         self.passive = passive
-        self.ftp_client = FTPClient(host, port, username, password, self.logger, secure=secure, passive=passive)
+        self.ftp_pool = FTPConnectionPool(host, port, username, password, self.logger,
+                                          secure=secure, passive=passive,
+                                          max_size=max_connections, idle_timeout=idle_timeout)
 
     def do_upload(self, task: Task, remote_dir: str) -> bool:
         """
@@ -175,15 +455,81 @@ class FTPUploader(Uploader):
             task: 备份任务
             remote_dir: 远程目录
         """
+        local_full_path = task.get_output_full_path()
+        return self._upload(task, remote_dir, local_full_path,
+                            lambda client, path: client.put_file(path, local_full_path, retry=3))
+
+    def supports_stream(self) -> bool:
+        return True
+
+    def upload_stream(self, task: Task, remote_dir: str, stream, size: int) -> bool:
+        """
+        从只读流上传，同样先写入临时文件再改名
+        """
+        return self._upload(task, remote_dir, "<stream>",
+                            lambda client, path: client.put_stream(path, stream, size))
+
+    def stage_stream(self, remote_dir: str, stream) -> str:
+        """
+        把长度未知的流上传到 remote_dir 下的临时文件，失败时删除临时文件
+        返回值: 临时文件的远端路径
+        """
+        temp_remote_path = posixpath.join(remote_dir, ".easybk-stream-{}.part".format(uuid.uuid4().hex))
+        with self.ftp_pool.connection() as client:
+            try:
+                size = client.put_stream(temp_remote_path, stream)
+            except Exception:
+                client.disconnect()
+                client.remove_file(temp_remote_path)
+                raise
+        self.logger.info("FTPUploader: 直传到临时文件 [%s]，%d 字节", temp_remote_path, size)
+        return temp_remote_path
+
+    def commit_staged(self, staged: str, task: Task, remote_dir: str) -> bool:
+        """
+        把临时文件改名为任务的最终文件名
+        """
+        remote_full_path = posixpath.join(remote_dir, task.get_output_file_name())
+        with self.ftp_pool.connection() as client:
+            client.rename_file(staged, remote_full_path)
+        self.logger.info("FTPUploader: 直传完成: [%s] -> [%s]", staged, remote_full_path)
+        return True
+
+    def discard_staged(self, staged: str):
+        with self.ftp_pool.connection() as client:
+            client.remove_file(staged)
+
+    def remote_size(self, remote_path: str):
+        """
+        使用 SIZE 命令获取远端文件大小，不存在时返回 None
+        """
+        with self.ftp_pool.connection() as client:
+            return client.file_size(remote_path)
+
+    def _upload(self, task: Task, remote_dir: str, source: str, put) -> bool:
+        """
+        借出连接，调用 put(client, 临时路径) 上传临时文件，成功后改名为最终文件
+        """
         remote_full_path = posixpath.join(remote_dir, task.get_output_file_name())
         temp_remote_path = "{}.part-{}".format(remote_full_path, uuid.uuid4().hex)
-        local_full_path = task.get_output_full_path()
-        self.logger.info("FTPUploader: 上传文件: [%s] -> [%s]", local_full_path, remote_full_path)
-        try:
-            self.ftp_client.put_file(temp_remote_path, local_full_path, retry=3)
-            self.ftp_client.rename_file(temp_remote_path, remote_full_path)
-        except Exception:
-            self.ftp_client.remove_file(temp_remote_path)
-            raise
-        self.logger.info("FTPUploader: 上传文件完成: [%s] -> [%s]", local_full_path, remote_full_path)
+        self.logger.info("FTPUploader: 上传文件: [%s] -> [%s]", source, remote_full_path)
+        with self.ftp_pool.connection() as client:
+            commands = client.command_count
+            try:
+                put(client, temp_remote_path)
+                client.rename_file(temp_remote_path, remote_full_path)
+            except Exception:
+                # 控制连接可能处于未知状态，重新登录后清理临时文件
+                client.disconnect()
+                client.remove_file(temp_remote_path)
+                raise
+            commands = client.command_count - commands
+        self.logger.info("FTPUploader: 上传文件完成: [%s] -> [%s]，控制连接命令 %d 次",
+                         source, remote_full_path, commands)
         return True
+
+    def close(self):
+        """
+        关闭连接池中的空闲连接
+        """
+        self.ftp_pool.close()
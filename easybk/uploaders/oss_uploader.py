@@ -3,14 +3,91 @@ Author: liujun (ljskryj@163.com)
 Date: 2018-07-10
 """
 
+import contextlib
+import hashlib
+import itertools
+import json
 import logging
 import os
 import posixpath
+import re
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from ..hashing import hash_file
+from ..state_store import _atomic_write
 from .uploader import Uploader, Task
 
 
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+# CopyObject 支持的最大对象，更大的对象需要分片复制
+COPY_OBJECT_LIMIT = 1024 * 1024 * 1024
+# 默认不清理过期的分片上传；启用时建议的时长（秒）为一天
+STALE_UPLOAD_AGE = 0
+# 未设置 checkpoint_dir 时断点文件的保存目录
+DEFAULT_CHECKPOINT_DIR = os.path.join(os.path.expanduser("~"), ".easybk-oss-upload")
+# 断点文件名：<内容摘要的 MD5>.<上传器名称>.checkpoint
+_CHECKPOINT_NAME = re.compile(r"^[0-9a-f]{32}\.(.+)\.checkpoint$")
+
+
+def _load_checkpoint(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def _save_checkpoint(path: str, record: dict):
+    _atomic_write(path, lambda fh: json.dump(record, fh))
+
+
+class CRCMismatchError(IOError):
+    """上传响应中的 CRC64 与本地文件不一致。"""
+
+
+class _Crc64Reader():
+    """包装只读流，边读取边计算 CRC64。"""
+
+    def __init__(self, stream):
+        import oss2
+
+        self.stream = stream
+        self._crc = oss2.utils.Crc64(0)
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self._crc.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def read_full(self, size: int) -> bytes:
+        """读取 size 字节，只有到达流末尾时才返回更少的数据。"""
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.read(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        return b"".join(chunks)
+
+    @property
+    def crc(self) -> int:
+        return self._crc.crc
+
+
+class _StagedObject():
+    """直传时上传的临时对象。"""
+
+    def __init__(self, key: str, size: int, crc: int):
+        self.key = key
+        self.size = size
+        self.crc = crc
+
+
 class OSSBucket():
     """
     阿里云 oss bucket
@@ -35,7 +112,8 @@ class OSSBucket():
         except ImportError:
             raise ImportError("oss2 is not installed, please install it first")
         self.auth = oss2.Auth(self.access_id, self.access_key)
-        self.bucket = oss2.Bucket(self.auth, self.endpoint, self.bucket_name)
+        # enable_crc：上传时边读取边计算 CRC64，并与响应中的 CRC64 比较
+        self.bucket = oss2.Bucket(self.auth, self.endpoint, self.bucket_name, enable_crc=True)
         self.has_connect = True
 
     def get_auth(self):
@@ -65,14 +143,301 @@ class OSSUploader(Uploader):
         access_key: oss 认证密钥
         endpoint: oss 认证端点
         bucket_name: oss 认证 bucket 名称
+        max_connections: 允许同时进行的上传数
+        multipart_threshold: 文件大小达到该字节数时使用分片上传
+        part_size: 分片大小（字节）
+        part_workers: 每个文件同时上传的分片数
+        checkpoint_dir: 分片上传断点文件的保存目录，None 时使用 DEFAULT_CHECKPOINT_DIR；
+                        下次运行上传相同内容时从断点续传
+        retries: 分片上传失败后的重试次数，重试时跳过已完成的分片
+        atomic_commit: 直接上传到最终 key，使用上传响应中的 CRC64 校验，
+                       启用时忽略 use_temp_object
+        stale_upload_age: 首次上传前删除本上传器超过该秒数的断点并中止对应的分片上传，
+                          同时中止 stale_upload_prefix 下同样过期的分片上传；默认 0 不清理，
+                          启用时必须设置 stale_upload_prefix
+        stale_upload_prefix: 清理过期分片上传时扫描的 key 前缀，不能为空
     """
 
     def __init__(self, name: str, access_id: str, access_key: str, endpoint: str,
-                 bucket_name: str, use_temp_object: bool = True):
-        Uploader.__init__(self, name)
+                 bucket_name: str, use_temp_object: bool = True, max_connections: int = 1,
+                 multipart_threshold: int = MULTIPART_THRESHOLD, part_size: int = PART_SIZE,
+                 part_workers: int = 4, checkpoint_dir: str = None, retries: int = 3,
+                 atomic_commit: bool = False, stale_upload_age: int = STALE_UPLOAD_AGE,
+                 stale_upload_prefix: str = ""):
+        Uploader.__init__(self, name, max_connections)
+        if stale_upload_age and not stale_upload_prefix:
+            # 扫描整个 bucket 会中止共用 bucket 的其他程序的上传
+            raise ValueError("stale_upload_age requires a non-empty stale_upload_prefix!")
         self.logger = logging.getLogger("OSSUploader")
         self.oss_bucket = OSSBucket(access_id, access_key, endpoint, bucket_name)
         self.use_temp_object = use_temp_object
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_workers = part_workers
+        self.checkpoint_dir = checkpoint_dir or DEFAULT_CHECKPOINT_DIR
+        self.retries = retries
+        self.atomic_commit = atomic_commit
+        self.stale_upload_age = stale_upload_age
+        self.stale_upload_prefix = stale_upload_prefix
+        # 每个上传器实例只清理一次
+        self._cleaned = False
+        self._cleanup_lock = threading.Lock()
+        # 内容摘要 -> 锁，相同内容的上传共用一个断点
+        self._digest_locks = {}
+
+    def _checkpoint_path(self, digest: str) -> str:
+        """断点文件路径，文件名由内容摘要和上传器名称组成，与远端文件名无关。"""
+        return os.path.join(self.checkpoint_dir, "{}.{}.checkpoint".format(
+            hashlib.md5(digest.encode("utf-8")).hexdigest(), self.name))
+
+    def _own_checkpoints(self) -> list:
+        """checkpoint_dir 中属于本上传器的断点文件。"""
+        if not os.path.isdir(self.checkpoint_dir):
+            return []
+        return [entry for entry in os.scandir(self.checkpoint_dir) if entry.is_file()
+                and (_CHECKPOINT_NAME.match(entry.name) or [None, None])[1] == self.name]
+
+    def _cleanup_stale_uploads(self, bucket):
+        """
+        删除本上传器超过 stale_upload_age 没有更新的断点文件并中止其中记录的分片上传，
+        再中止 stale_upload_prefix 下发起超过 stale_upload_age、且不属于任何有效断点的
+        分片上传（内容不再出现时断点不会被续传，分片会一直占用存储）。
+        stale_upload_age 为 0 时不清理。清理失败只记录警告，不影响上传。
+        """
+        if not self.stale_upload_age:
+            return
+        with self._cleanup_lock:
+            if self._cleaned:
+                return
+            self._cleaned = True
+        import oss2
+
+        cutoff = time.time() - self.stale_upload_age
+        live = set()
+        for entry in self._own_checkpoints():
+            try:
+                record = _load_checkpoint(entry.path)
+                if entry.stat().st_mtime >= cutoff:
+                    live.add(record.get("upload_id"))
+                    continue
+                try:
+                    bucket.abort_multipart_upload(record["key"], record["upload_id"])
+                except oss2.exceptions.NoSuchUpload:
+                    pass
+                os.remove(entry.path)
+                self.logger.info("OSSUploader: 删除过期的断点并中止分片上传: %s", entry.path)
+            except Exception as exc:
+                self.logger.warning("OSSUploader: 清理过期的断点失败: %s: %s", entry.path, exc)
+        try:
+            for upload in oss2.MultipartUploadIterator(bucket, prefix=self.stale_upload_prefix):
+                if upload.initiation_date < cutoff and upload.upload_id not in live:
+                    bucket.abort_multipart_upload(upload.key, upload.upload_id)
+                    self.logger.info("OSSUploader: 中止过期的分片上传: %s (%s)",
+                                     upload.key, upload.upload_id)
+        except Exception as exc:
+            self.logger.warning("OSSUploader: 清理过期的分片上传失败: %s", exc)
+
+    def _put_file(self, bucket, key: str, local_path: str, local_size: int, digest: str = None):
+        """
+        上传本地文件。小文件单次上传；大文件并发上传分片，每完成一个分片就写入以内容摘要
+        命名的断点文件。备份文件名每次运行都不同，下次运行上传相同内容（摘要相同）时，
+        从断点记录的远端 key 和 upload_id 继续，只补传缺失的分片，完成后复制为本次的 key。
+        本次上传内的重试同样只补传缺失的分片。digest 为 None 时计算文件摘要。
+
+        返回值: 最后一个请求（PutObject 或 CompleteMultipartUpload）的结果
+        """
+        if local_size < self.multipart_threshold:
+            return bucket.put_object_from_file(key, local_path)
+
+        import oss2
+
+        if digest is None:
+            digest = hash_file(local_path)
+        path = self._checkpoint_path(digest)
+        with self._digest_lock(digest):
+            record = self._resume_record(bucket, path, digest, local_size)
+            if record is None:
+                record = {"digest": digest, "key": key, "size": local_size,
+                          "part_size": max(self.part_size, -(-local_size // 10000)),
+                          "upload_id": bucket.init_multipart_upload(key).upload_id,
+                          "parts": {}}
+                _save_checkpoint(path, record)
+            else:
+                self.logger.info("OSSUploader: 从断点续传 [%s]，已完成 %d 个分片",
+                                 record["key"], len(record["parts"]))
+            for attempt in range(1, self.retries + 1):
+                try:
+                    self._upload_parts(bucket, local_path, path, record)
+                    break
+                except oss2.exceptions.OssError as exc:
+                    # 只重试网络错误和服务端 5xx；认证、权限、CRC 不一致等错误重试无意义
+                    retryable = isinstance(exc, oss2.exceptions.RequestError) or exc.status >= 500
+                    if attempt == self.retries or not retryable:
+                        raise
+                    self.logger.warning("OSSUploader: 分片上传失败，第%d次重试: %s", attempt, exc)
+            parts = [oss2.models.PartInfo(int(number), etag, size=size, part_crc=crc)
+                     for number, (etag, crc, size) in sorted(record["parts"].items(),
+                                                             key=lambda item: int(item[0]))]
+            result = bucket.complete_multipart_upload(record["key"], record["upload_id"], parts)
+            os.remove(path)
+        if record["key"] != key:
+            # 续传的是之前运行的 key，服务端复制为本次的 key
+            self._copy(bucket, record["key"], key, local_size)
+            try:
+                bucket.delete_object(record["key"])
+            except Exception:
+                self.logger.warning("OSSUploader: 清理续传的旧对象失败: %s", record["key"])
+        return result
+
+    @contextlib.contextmanager
+    def _digest_lock(self, digest: str):
+        """同一内容的上传共用一个断点文件，依次执行。"""
+        with self._cleanup_lock:
+            lock = self._digest_locks.setdefault(digest, threading.Lock())
+        with lock:
+            yield
+
+    def _resume_record(self, bucket, path: str, digest: str, local_size: int):
+        """
+        读取断点，只保留远端 ListParts 中仍然存在且 ETag 一致的分片。
+        没有断点、断点与文件不符或分片上传已不存在时返回 None
+        """
+        import oss2
+
+        try:
+            record = _load_checkpoint(path)
+        except (OSError, ValueError):
+            return None
+        if record.get("digest") != digest or record.get("size") != local_size:
+            return None
+        try:
+            uploaded = {part.part_number: part.etag for part in
+                        oss2.PartIterator(bucket, record["key"], record["upload_id"])}
+        except oss2.exceptions.NoSuchUpload:
+            return None
+        record["parts"] = {number: part for number, part in record["parts"].items()
+                           if uploaded.get(int(number)) == part[0]}
+        return record
+
+    def _upload_parts(self, bucket, local_path: str, path: str, record: dict):
+        """并发上传 record 中缺失的分片，每完成一个分片更新断点文件。"""
+        size, part_size = record["size"], record["part_size"]
+        lock = threading.Lock()
+
+        def upload(number):
+            offset = (number - 1) * part_size
+            with open(local_path, "rb") as f:
+                f.seek(offset)
+                data = f.read(min(part_size, size - offset))
+            result = bucket.upload_part(record["key"], record["upload_id"], number, data)
+            with lock:
+                record["parts"][str(number)] = [result.etag, result.crc, len(data)]
+                _save_checkpoint(path, record)
+
+        numbers = [number for number in range(1, -(-size // part_size) + 1)
+                   if str(number) not in record["parts"]]
+        with ThreadPoolExecutor(max_workers=self.part_workers) as executor:
+            futures = [executor.submit(upload, number) for number in numbers]
+        for future in futures:
+            future.result()
+
+    def _put_stream(self, bucket, key: str, stream, size: int = None):
+        """
+        上传只读流。小于 multipart_threshold 时单次上传；否则按 part_size 顺序读取并上传分片，
+        每次只在内存中保留一个分片的读取窗口。流无法回退，失败时中止分片上传，不重试。
+        size 为 None（长度未知）时 stream 必须是 _Crc64Reader：先读取一个分片，
+        不足一个分片时单次上传，否则逐个读取完整分片上传。
+
+        返回值: 最后一个请求（PutObject 或 CompleteMultipartUpload）的结果
+        """
+        import oss2
+
+        if size is None:
+            first = stream.read_full(self.part_size)
+            if len(first) < self.part_size:
+                return bucket.put_object(key, first)
+            parts_data = itertools.chain(
+                [first], iter(lambda: stream.read_full(self.part_size), b""))
+        elif size < self.multipart_threshold:
+            return bucket.put_object(key, oss2.utils.SizedFileAdapter(stream, size))
+        else:
+            parts_data = (oss2.utils.SizedFileAdapter(stream, min(self.part_size, size - offset))
+                          for offset in range(0, size, self.part_size))
+
+        upload_id = bucket.init_multipart_upload(key).upload_id
+        try:
+            parts = []
+            for number, data in enumerate(parts_data, start=1):
+                part_length = data.len if isinstance(data, oss2.utils.SizedFileAdapter) \
+                    else len(data)
+                result = bucket.upload_part(key, upload_id, number, data)
+                parts.append(oss2.models.PartInfo(number, result.etag, size=part_length,
+                                                  part_crc=result.crc))
+            return bucket.complete_multipart_upload(key, upload_id, parts)
+        except Exception:
+            try:
+                bucket.abort_multipart_upload(key, upload_id)
+            except Exception:
+                self.logger.warning("OSSUploader: 中止分片上传失败: %s", key)
+            raise
+
+    def _copy(self, bucket, source_key: str, target_key: str, size: int):
+        """
+        服务端复制对象，超过 COPY_OBJECT_LIMIT 时使用分片复制
+        返回值: CopyObject 或 CompleteMultipartUpload 的结果
+        """
+        import oss2
+
+        bucket_name = self.oss_bucket.bucket_name
+        if size <= COPY_OBJECT_LIMIT:
+            return bucket.copy_object(bucket_name, source_key, target_key)
+        # 分片数不能超过 10000
+        part_size = max(self.part_size, -(-size // 10000))
+        upload_id = bucket.init_multipart_upload(target_key).upload_id
+        try:
+            parts = []
+            for number, offset in enumerate(range(0, size, part_size), start=1):
+                end = min(offset + part_size, size) - 1
+                result = bucket.upload_part_copy(bucket_name, source_key, (offset, end),
+                                                 target_key, upload_id, number)
+                parts.append(oss2.models.PartInfo(number, result.etag))
+            return bucket.complete_multipart_upload(target_key, upload_id, parts)
+        except Exception:
+            try:
+                bucket.abort_multipart_upload(target_key, upload_id)
+            except Exception:
+                self.logger.warning("OSSUploader: 中止分片复制失败: %s", target_key)
+            raise
+
+    def _commit_verified(self, bucket, key: str, upload, local_crc=None):
+        """
+        调用 upload() 直接上传到最终 key，再与 local_crc() 返回的本地 CRC64 比较，
+        校验失败时删除对象。local_crc 为 None 时 CRC64 已由 oss2 在上传时比较
+        （不一致时抛出 InconsistentError），只检查响应中带有 CRC64
+        """
+        import oss2
+
+        try:
+            result = upload()
+            self._verify_crc(result, None if local_crc is None else local_crc())
+        except (CRCMismatchError, oss2.exceptions.InconsistentError):
+            # 对象可能已经提交，删除以免留下损坏的备份
+            try:
+                bucket.delete_object(key)
+            except Exception:
+                self.logger.warning("OSSUploader: 删除校验失败的对象失败: %s", key)
+            raise
+
+    def _verify_crc(self, result, local_crc: int = None):
+        """
+        使用上传响应头中的 CRC64 校验远端对象，替代 head_object 往返
+        """
+        if result.crc is None:
+            raise IOError("OSS 响应中缺少 CRC64，无法校验上传结果")
+        if local_crc is not None and result.crc != local_crc:
+            raise CRCMismatchError("OSS 上传后 CRC64 校验失败: 本地={}, 远端={}".format(
+                local_crc, result.crc))
+        self.logger.info("OSSUploader: CRC64 校验通过: %s (ETag %s)", result.crc, result.etag)
 
     def do_upload(self, task: Task, remote_dir: str) -> bool:
         """
@@ -86,22 +451,32 @@ class OSSUploader(Uploader):
         self.logger.info("OSSUploader: 上传文件: [%s] -> [%s]", local_full_path, remote_full_path)
         bucket = self.oss_bucket.get_bucket()
         local_size = os.path.getsize(local_full_path)
+        digest = task.get_output_digest()
+        self._cleanup_stale_uploads(bucket)
 
-        if not self.use_temp_object:
-            bucket.put_object_from_file(remote_full_path, local_full_path)
+        if self.atomic_commit:
+            # PutObject 和 CompleteMultipartUpload 成功前最终 key 都不可见，无需临时对象。
+            # 本地 CRC64 由 oss2 在上传读取时计算（分片上传由各分片的 CRC64 合并），不再重读文件
+            self._commit_verified(
+                bucket, remote_full_path,
+                lambda: self._put_file(bucket, remote_full_path, local_full_path, local_size,
+                                       digest))
+        elif not self.use_temp_object:
+            self._put_file(bucket, remote_full_path, local_full_path, local_size, digest)
             final_size = bucket.head_object(remote_full_path).content_length
             if final_size != local_size:
                 raise IOError("OSS 上传后大小校验失败: 本地={}, 远端={}".format(
                     local_size, final_size))
         else:
-            temp_remote_path = "{}.part-{}".format(remote_full_path, uuid.uuid4().hex)
+            # 删除临时对象不影响未完成的分片上传，下次运行仍可按内容摘要续传
+            temp_remote_path = "{}.part".format(remote_full_path)
             try:
-                bucket.put_object_from_file(temp_remote_path, local_full_path)
+                self._put_file(bucket, temp_remote_path, local_full_path, local_size, digest)
                 uploaded_size = bucket.head_object(temp_remote_path).content_length
                 if uploaded_size != local_size:
                     raise IOError("OSS 上传后大小校验失败: 本地={}, 远端={}".format(
                         local_size, uploaded_size))
-                bucket.copy_object(self.oss_bucket.bucket_name, temp_remote_path, remote_full_path)
+                self._copy(bucket, temp_remote_path, remote_full_path, local_size)
                 final_size = bucket.head_object(remote_full_path).content_length
                 if final_size != local_size:
                     raise IOError("OSS 最终对象大小校验失败: 本地={}, 远端={}".format(
@@ -113,3 +488,88 @@ class OSSUploader(Uploader):
                     self.logger.warning("OSSUploader: 清理远端临时对象失败: %s", temp_remote_path)
         self.logger.info("OSSUploader: 上传文件完成: [%s] -> [%s]", local_full_path, remote_full_path)
         return True
+
+    def remote_size(self, remote_path: str):
+        """
+        使用 head_object 获取对象大小，对象不存在时返回 None
+        """
+        import oss2
+
+        try:
+            return self.oss_bucket.get_bucket().head_object(remote_path).content_length
+        except oss2.exceptions.NotFound:
+            return None
+
+    def make_reference(self, source_path: str, target_path: str) -> bool:
+        """
+        dedup_mode 为 copy 时服务端复制已有对象，为 symlink 时创建指向它的软链接，
+        都不需要重新发送数据。源对象不存在时抛出 NoSuchKey
+        """
+        bucket = self.oss_bucket.get_bucket()
+        source_size = bucket.head_object(source_path).content_length
+        if self.dedup_mode == "symlink":
+            bucket.put_symlink(source_path, target_path)
+            return True
+        if self.dedup_mode == "copy" and source_size <= COPY_OBJECT_LIMIT:
+            bucket.copy_object(self.oss_bucket.bucket_name, source_path, target_path)
+            return True
+        return False
+
+    def supports_stream(self) -> bool:
+        return True
+
+    def upload_stream(self, task: Task, remote_dir: str, stream, size: int) -> bool:
+        """
+        从只读流上传。流无法回退，因此总是按 atomic_commit 的方式直接上传最终 key，
+        并用读取时计算的 CRC64 校验，忽略 use_temp_object
+        """
+        remote_full_path = posixpath.join(remote_dir, task.get_output_file_name())
+        self.logger.info("OSSUploader: 流式上传: [%s]", remote_full_path)
+        bucket = self.oss_bucket.get_bucket()
+        self._cleanup_stale_uploads(bucket)
+        reader = _Crc64Reader(stream)
+        self._commit_verified(bucket, remote_full_path,
+                              lambda: self._put_stream(bucket, remote_full_path, reader, size),
+                              lambda: reader.crc)
+        self.logger.info("OSSUploader: 流式上传完成: [%s]", remote_full_path)
+        return True
+
+    def stage_stream(self, remote_dir: str, stream) -> _StagedObject:
+        """
+        把长度未知的流上传到 remote_dir 下的临时对象，并用读取时计算的 CRC64 校验
+        """
+        key = posixpath.join(remote_dir, ".easybk-stream-{}.part".format(uuid.uuid4().hex))
+        bucket = self.oss_bucket.get_bucket()
+        self._cleanup_stale_uploads(bucket)
+        reader = _Crc64Reader(stream)
+        self._commit_verified(bucket, key, lambda: self._put_stream(bucket, key, reader),
+                              lambda: reader.crc)
+        self.logger.info("OSSUploader: 直传到临时对象 [%s]，%d 字节", key, reader.bytes_read)
+        return _StagedObject(key, reader.bytes_read, reader.crc)
+
+    def commit_staged(self, staged: _StagedObject, task: Task, remote_dir: str) -> bool:
+        """
+        服务端复制临时对象为任务的最终 key，校验后删除临时对象
+        """
+        remote_full_path = posixpath.join(remote_dir, task.get_output_file_name())
+        bucket = self.oss_bucket.get_bucket()
+        try:
+            result = self._copy(bucket, staged.key, remote_full_path, staged.size)
+            if result.crc is not None:
+                self._commit_verified(bucket, remote_full_path, lambda: result,
+                                      lambda: staged.crc)
+            else:
+                final_size = bucket.head_object(remote_full_path).content_length
+                if final_size != staged.size:
+                    raise IOError("OSS 最终对象大小校验失败: 本地={}, 远端={}".format(
+                        staged.size, final_size))
+        finally:
+            self.discard_staged(staged)
+        self.logger.info("OSSUploader: 直传完成: [%s] -> [%s]", staged.key, remote_full_path)
+        return True
+
+    def discard_staged(self, staged: _StagedObject):
+        try:
+            self.oss_bucket.get_bucket().delete_object(staged.key)
+        except Exception:
+            self.logger.warning("OSSUploader: 清理远端临时对象失败: %s", staged.key)
@@ -6,8 +6,11 @@ Date: 2019-10-12
 
 import abc
 import logging
+import os
+import posixpath
 
 from ..tasks import Task
+from .dedup_index import DEDUP_MODES, DedupIndex
 
 
 class Uploader():
@@ -16,12 +19,16 @@ class Uploader():
 
     参数：
         name: 本实例名称
+        max_connections: 允许同时进行的上传数
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, max_connections: int = 1):
         self.logger = logging.getLogger("Uploader")
         self.name = name
+        self.max_connections = max_connections
+        self.dedup_mode = "off"
+        self.dedup_index = None
 
     def get_name(self) -> str:
         """
@@ -29,6 +36,102 @@ class Uploader():
         """
         return self.name
 
+    def get_max_connections(self) -> int:
+        """
+        获取允许同时进行的上传数
+        """
+        return self.max_connections
+
+    def set_dedup(self, mode: str, index_file: str = None, index_dir: str = None):
+        """
+        设置内容去重方式
+        参数:
+            mode: off 不去重；skip 已上传过相同摘要时跳过；copy / symlink 在远端
+                  创建指向已有对象的副本或软链接（需要上传器支持 make_reference）
+            index_file: 去重索引文件，默认 "<index_dir>/<上传器名称>.dedup.json"
+            index_dir: 默认索引文件所在目录，通常为状态文件所在目录，None 时使用当前目录
+        """
+        if mode not in DEDUP_MODES:
+            raise ValueError("dedup mode must be one of {}!".format(", ".join(DEDUP_MODES)))
+        if index_file is None:
+            index_file = os.path.join(index_dir or os.getcwd(), "{}.dedup.json".format(self.name))
+        self.dedup_mode = mode
+        # 使用绝对路径，之后切换工作目录也不会读写到另一个索引
+        self.dedup_index = None if mode == "off" else DedupIndex(os.path.abspath(index_file))
+
+    def find_duplicate(self, task: Task):
+        """
+        返回远端已有的相同内容的路径，未启用去重或没有记录时返回 None
+        """
+        digest = task.get_output_digest()
+        if self.dedup_index is None or not digest:
+            return None
+        return self.dedup_index.lookup(digest)
+
+    def record_upload(self, task: Task, remote_dir: str):
+        """
+        上传成功后在去重索引中记录任务输出的摘要
+        """
+        digest = task.get_output_digest()
+        if self.dedup_index is not None and digest:
+            self.dedup_index.record(digest, posixpath.join(remote_dir, task.get_output_file_name()))
+
+    def upload(self, task: Task, remote_dir: str) -> bool:
+        """
+        上传入口：按去重方式跳过或引用已有内容，否则调用 do_upload
+        """
+        existing = self.find_duplicate(task)
+        if existing is not None:
+            remote_path = posixpath.join(remote_dir, task.get_output_file_name())
+            if existing == remote_path or self.dedup_mode == "skip":
+                if self._remote_matches(existing, task):
+                    self.logger.info("%s: 远端已有相同内容 [%s]，跳过上传 [%s]",
+                                     self.name, existing, remote_path)
+                    return True
+                # 远端文件已被清理或不完整，删除记录后完整上传
+                self.logger.warning("%s: 远端 [%s] 不存在或大小不一致，完整上传", self.name, existing)
+                self.dedup_index.forget(task.get_output_digest())
+            else:
+                try:
+                    if self.make_reference(existing, remote_path):
+                        self.logger.info("%s: 远端已有相同内容，%s [%s] -> [%s]",
+                                         self.name, self.dedup_mode, existing, remote_path)
+                        return True
+                except Exception as exc:
+                    # 源对象可能已被清理，删除记录后完整上传
+                    self.logger.warning("%s: 引用已有内容失败，完整上传: %s", self.name, exc)
+                    self.dedup_index.forget(task.get_output_digest())
+        result = self.do_upload(task, remote_dir)
+        if result:
+            self.record_upload(task, remote_dir)
+        return result
+
+    def _remote_matches(self, remote_path: str, task: Task) -> bool:
+        """
+        远端文件存在且大小与任务输出一致时返回 True，无法确认时返回 False
+        """
+        try:
+            remote_size = self.remote_size(remote_path)
+            return remote_size is not None and \
+                remote_size == os.path.getsize(task.get_output_full_path())
+        except Exception as exc:
+            self.logger.warning("%s: 无法确认远端文件 [%s]: %s", self.name, remote_path, exc)
+            return False
+
+    def remote_size(self, remote_path: str):
+        """
+        返回远端文件的大小，不存在时返回 None；去重跳过上传前用于确认索引中的文件仍然存在
+        """
+        return None
+
+    def make_reference(self, source_path: str, target_path: str) -> bool:
+        """
+        按 dedup_mode 在远端创建 target_path，内容引用已存在的 source_path
+        返回值:
+            不支持时返回 False，调用方改为完整上传
+        """
+        return False
+
     @abc.abstractmethod
     def do_upload(self, task: Task, remote_dir: str) -> bool:
         """
@@ -40,3 +143,46 @@ class Uploader():
             result bool 类型，代表成功或者失败。
         """
         raise NotImplementedError("Uploader.do_upload")
+
+    def supports_stream(self) -> bool:
+        """
+        是否支持 upload_stream，读一次多路上传只对支持的上传器生效
+        """
+        return False
+
+    def upload_stream(self, task: Task, remote_dir: str, stream, size: int) -> bool:
+        """
+        从只读流上传任务的备份文件，流只能顺序读取一次，不支持续传和重试
+        参数:
+            task: 备份任务，用于确定远端文件名
+            remote_dir: 远程目录
+            stream: 提供 read(size) 的只读流
+            size: 流的总字节数
+        返回值:
+            result bool 类型，代表成功或者失败。
+        """
+        raise NotImplementedError("Uploader.upload_stream")
+
+    def stage_stream(self, remote_dir: str, stream):
+        """
+        把长度未知的只读流上传到 remote_dir 下的临时名称，用于直传
+        返回值:
+            传给 commit_staged / discard_staged 的临时文件信息
+        """
+        raise NotImplementedError("Uploader.stage_stream")
+
+    def commit_staged(self, staged, task: Task, remote_dir: str) -> bool:
+        """
+        把 stage_stream 上传的临时文件提交为任务的最终文件名
+        """
+        raise NotImplementedError("Uploader.commit_staged")
+
+    def discard_staged(self, staged):
+        """
+        删除 stage_stream 上传的临时文件
+        """
+
+    def close(self):
+        """
+        释放上传器持有的连接等资源，全部上传结束后调用
+        """
@@ -0,0 +1,170 @@
+import io
+import json
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+
+from config_parser import _validate_config
+from easybk import EncipherManager, PackTask
+from easybk.chunk_store import ChunkStore, main, restore_snapshot
+
+
+def _bundle(path):
+    """读取快照包，返回 (快照清单, {pack 名称: 内容})。"""
+    with tarfile.open(path) as bundle:
+        manifest = json.load(bundle.extractfile("snapshot.json"))
+        packs = {Path(member.name).name: bundle.extractfile(member).read()
+                 for member in bundle.getmembers() if member.name.startswith("packs/")}
+    return manifest, packs
+
+
+def _random_bytes(size, seed):
+    """固定种子的随机数据：切块位置随内容确定，断言中的大小上限不会偶然失败。"""
+    return random.Random(seed).randbytes(size)
+
+
+def _members(tar_bytes):
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as archive:
+        return {member.name: archive.extractfile(member).read()
+                for member in archive.getmembers() if member.isfile()}
+
+
+@unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+class ChunkStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(dir=".")
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.store_dir = str(Path(self.temp_dir) / "store")
+
+    def _site(self, name, vendor):
+        root = Path(self.temp_dir) / name
+        (root / "vendor").mkdir(parents=True)
+        (root / "vendor" / "lib.bin").write_bytes(vendor)
+        (root / "index.php").write_text("<?php echo '{}';\n".format(name), encoding="utf-8")
+        return root
+
+    def _task(self, name, keep=7, full_backup_interval=7):
+        task = PackTask(name, str(Path(self.temp_dir) / "output"),
+                        str(Path(self.temp_dir) / name), ["vendor", "index.php"],
+                        chunk_store=self.store_dir, chunk_store_keep=keep,
+                        full_backup_interval=full_backup_interval)
+        self.state = EncipherManager()
+        self.state.load_data_from_file(str(Path(self.temp_dir) / "state.txt"))
+        return task
+
+    def _run(self, task):
+        self.assertTrue(task.run())
+        self.state.save_data_to_file()
+        return _bundle(task.get_output_full_path())
+
+    def test_shared_content_is_stored_once_and_bundles_carry_only_new_packs(self):
+        vendor = _random_bytes(512 * 1024, 1)
+        first_root = self._site("first", vendor)
+        self._site("second", vendor)
+        first, second = self._task("first"), self._task("second")
+
+        first_manifest, first_packs = self._run(first)
+        second_manifest, second_packs = self._run(second)
+
+        self.assertTrue(first.get_output_file_name().startswith("first_backup_snap_"))
+        self.assertLess(set(first_packs), set(second_packs))
+        store = ChunkStore.open(self.store_dir)
+        stored = sum(os.path.getsize(os.path.join(store.pack_dir, name))
+                     for name in os.listdir(store.pack_dir))
+        self.assertLess(stored, len(vendor) + 64 * 1024)
+
+        pack_dir = Path(self.temp_dir) / "remote"
+        pack_dir.mkdir()
+        for name, data in second_packs.items():
+            (pack_dir / name).write_bytes(data)
+        restored = io.BytesIO()
+        restore_snapshot(second_manifest, str(pack_dir), restored)
+        self.assertEqual(_members(restored.getvalue()),
+                         {"vendor/lib.bin": vendor, "index.php": b"<?php echo 'second';\n"})
+
+        (first_root / "index.php").write_text("<?php echo 'changed';\n", encoding="utf-8")
+        _, packs = self._run(first)
+        self.assertEqual(len(packs), 1)
+        self.assertNotIn(list(packs)[0], first_packs)
+        self.assertLess(sum(len(data) for data in packs.values()), 16 * 1024)
+
+    def test_pruned_snapshots_are_garbage_collected(self):
+        root = self._site("site", _random_bytes(256 * 1024, 2))
+        task = self._task("site", keep=1)
+        self._run(task)
+        store = ChunkStore.open(self.store_dir)
+        first_snapshot = store.snapshots("site")
+
+        (root / "vendor" / "lib.bin").write_bytes(_random_bytes(256 * 1024, 3))
+        manifest, _ = self._run(task)
+
+        self.assertEqual(store.snapshots("site"), [manifest["name"]])
+        self.assertNotEqual(first_snapshot, [manifest["name"]])
+        stored = sum(os.path.getsize(os.path.join(store.pack_dir, name))
+                     for name in os.listdir(store.pack_dir))
+        self.assertLess(stored, 300 * 1024)
+        restored = io.BytesIO()
+        store.restore(manifest["name"], restored)
+        self.assertEqual(_members(restored.getvalue())["vendor/lib.bin"],
+                         (root / "vendor" / "lib.bin").read_bytes())
+
+    def test_full_bundle_is_written_every_full_backup_interval_snapshots(self):
+        self._site("site", _random_bytes(256 * 1024, 4))
+        task = self._task("site", full_backup_interval=1)
+
+        _, first_packs = self._run(task)
+        _, second_packs = self._run(task)
+        manifest, third_packs = self._run(task)
+
+        self.assertTrue(first_packs)
+        self.assertEqual(second_packs, {})
+        self.assertEqual(set(third_packs), set(manifest["packs"].values()))
+
+    def test_chunk_store_config_is_validated(self):
+        errors = _validate_config({
+            "tasks": [{"type": "pack", "task_name": "site", "output_dir": "out",
+                       "tar_run_dir": "/srv", "backup_list": ["www"], "chunk_store": "store",
+                       "incremental": True, "chunk_store_keep": 0}],
+            "uploaders": [],
+        })
+        self.assertEqual(errors, ["tasks[0].chunk_store 不能与 incremental 同时使用",
+                                  "tasks[0].chunk_store_keep 必须是正整数"])
+
+
+class ChunkStoreLockTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(dir=".")
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.store_dir = str(Path(self.temp_dir) / "store")
+
+    def test_gc_from_another_process_skips_while_a_writer_is_active(self):
+        # 单独创建的实例有自己的锁文件描述符，与另一个进程中的 easybk-chunks gc 相同
+        store = ChunkStore(self.store_dir)
+        self.addCleanup(store.close)
+        writer = store.writer()
+        writer.compress(_random_bytes(64 * 1024, 5))
+        writer.flush()
+        pack_files = os.listdir(store.pack_dir)
+        self.assertEqual(len(pack_files), 1)
+
+        with self.assertLogs("ChunkStore", "INFO") as logs:
+            self.assertEqual(main(["gc", self.store_dir]), 0)
+        self.assertIn("其他进程", "\n".join(logs.output))
+        self.assertEqual(os.listdir(store.pack_dir), pack_files)
+
+        manifest = store.commit_snapshot(writer, "site", "site_1")
+        writer.release()
+        other = ChunkStore(self.store_dir)
+        self.addCleanup(other.close)
+        self.assertEqual(other.gc()["packs_removed"], 0)
+        restored = io.BytesIO()
+        store.restore(manifest["name"], restored)
+        self.assertEqual(restored.getvalue(), _random_bytes(64 * 1024, 5))
+
+
+if __name__ == "__main__":
+    unittest.main()
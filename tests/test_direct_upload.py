@@ -0,0 +1,106 @@
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from test_ftp_uploader import FakeFTPServer
+from test_oss_uploader import FakeOSSServer
+
+from config_parser import _validate_config
+from easybk import (BackupScheduler, FTPUploader, OSSUploader, PackTask, TaskManager,
+                    UploadManager, UploadTask)
+from easybk.direct_upload import DirectUpload
+from easybk.uploaders import ftp_uploader
+
+
+@unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+class DirectUploadTests(unittest.TestCase):
+    def setUp(self):
+        self.ftp_server = FakeFTPServer()
+        patcher = mock.patch.object(ftp_uploader, "FTP", self.ftp_server.client_class())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.oss_server = FakeOSSServer()
+        self.oss_server.start()
+        self.addCleanup(self.oss_server.stop)
+
+    def _run(self, temp_dir, backup_list=("data",)):
+        run_dir = Path(temp_dir) / "source"
+        (run_dir / "data").mkdir(parents=True)
+        (run_dir / "data" / "random.bin").write_bytes(os.urandom(300 * 1024))
+        output_dir = Path(temp_dir) / "output"
+        task = PackTask("site", str(output_dir), str(run_dir), list(backup_list),
+                        compression="parallel_gzip")
+        oss = OSSUploader("oss", "id", "secret", self.oss_server.endpoint, "bucket",
+                          part_size=100 * 1024)
+        ftp = FTPUploader("ftp", "host", 21, "user", "pass")
+        upload_tasks = [UploadTask(task, oss, "daily"), UploadTask(task, ftp, "daily")]
+        task.set_direct_upload(DirectUpload(upload_tasks))
+
+        task_manager = TaskManager()
+        task_manager.set_encipher_file(str(Path(temp_dir) / "state.txt"))
+        task_manager.add_task(task)
+        upload_manager = UploadManager()
+        for upload_task in upload_tasks:
+            upload_manager.add_upload_task(upload_task)
+        result = BackupScheduler(task_manager, upload_manager).run()
+        return result, task, output_dir
+
+    def test_archive_is_uploaded_while_it_is_produced_and_committed_by_digest(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            result, task, output_dir = self._run(temp_dir)
+
+            self.assertTrue(result)
+            self.assertEqual(os.listdir(str(output_dir)), [])
+            key = "daily/" + task.get_output_file_name()
+            self.assertEqual(list(self.oss_server.objects), [key])
+            payload = self.oss_server.objects[key]
+            self.assertEqual(self.ftp_server.files, {"/" + key: payload})
+            self.assertIn(hashlib.sha256(payload).hexdigest(), key)
+            with tarfile.open(fileobj=io.BytesIO(payload), mode="r:gz") as archive:
+                self.assertEqual(archive.getnames(), ["data", "data/random.bin"])
+            self.assertGreater(self.oss_server.count("UploadPart"), 1)
+            self.assertEqual(self.oss_server.count("CopyObject"), 1)
+
+    def test_failed_destination_is_reported_without_stopping_the_others(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            self.ftp_server.fail_after = 1000
+            result, task, _ = self._run(temp_dir)
+
+            self.assertFalse(result)
+            self.assertEqual(list(self.oss_server.objects),
+                             ["daily/" + task.get_output_file_name()])
+            self.assertEqual(self.ftp_server.files, {})
+
+    def test_failed_archive_leaves_no_remote_temp_files(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            result, _, _ = self._run(temp_dir, backup_list=("data", "missing"))
+
+            self.assertFalse(result)
+            self.assertEqual(self.oss_server.objects, {})
+            self.assertEqual(self.ftp_server.files, {})
+
+    def test_direct_upload_config_is_validated(self):
+        errors = _validate_config({
+            "tasks": [
+                {"type": "mysql", "task_name": "db", "output_dir": "out", "dump_option": "x",
+                 "direct_upload": True,
+                 "uploaders": [{"uploader_name": "ftp"}, {"uploader_name": "ftp"}]},
+                {"type": "single_file", "task_name": "f", "output_dir": "out",
+                 "source_file": "f", "direct_upload": True},
+            ],
+            "uploaders": [{"type": "ftp", "name": "ftp", "host": "h", "username": "u",
+                           "password": "p"}],
+        })
+        self.assertEqual(errors, ["tasks[0].direct_upload 需要 streaming、split_by 或 delta",
+                                  "tasks[0].direct_upload 时同一上传器只能引用一次",
+                                  "tasks[1].direct_upload 只支持 pack 和 mysql 任务"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from test_ftp_uploader import FakeFTPServer
+from test_oss_uploader import FakeOSSServer
+
+from config_parser import _validate_config
+from easybk import (BackupScheduler, FTPUploader, OSSUploader, Task, TaskManager,
+                    UploadManager, UploadTask, Uploader)
+from easybk import fanout
+from easybk.uploaders import ftp_uploader
+
+
+class FileTask(Task):
+    def __init__(self, name, path):
+        super().__init__(name, str(Path(path).parent))
+        self.set_output_file_name_and_full_path(Path(path).name)
+
+    def do_task(self):
+        return True
+
+
+class StreamingUploader(Uploader):
+    """记录流式上传的数据；fail_after 字节后抛出异常，delay 模拟慢速目的地。"""
+
+    def __init__(self, name, fail_after=None, delay=0):
+        super().__init__(name)
+        self.fail_after = fail_after
+        self.delay = delay
+        self.received = b""
+        self.file_uploads = 0
+
+    def supports_stream(self):
+        return True
+
+    def upload_stream(self, task, remote_dir, stream, size):
+        for chunk in iter(lambda: stream.read(4096), b""):
+            time.sleep(self.delay)
+            self.received += chunk
+            if self.fail_after is not None and len(self.received) >= self.fail_after:
+                raise IOError("destination went away")
+        return len(self.received) == size
+
+    def do_upload(self, task, remote_dir):
+        self.file_uploads += 1
+        self.received = Path(task.get_output_full_path()).read_bytes()
+        return True
+
+
+class FanoutFileTests(unittest.TestCase):
+    def test_slow_and_failing_consumers_keep_buffering_bounded(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(64 * 1024)
+            source = Path(temp_dir) / "backup.tgz"
+            source.write_bytes(payload)
+            peak = {"depth": 0}
+            feed = fanout.FanoutStream._feed
+
+            def tracking_feed(stream, item):
+                peak["depth"] = max(peak["depth"], stream._queue.qsize())
+                return feed(stream, item)
+
+            fast, slow = StreamingUploader("fast"), StreamingUploader("slow", delay=0.002)
+            broken = StreamingUploader("broken", fail_after=8192)
+            task = FileTask("t", source)
+            consumers = {uploader.get_name(): (lambda stream, u=uploader:
+                                               u.upload_stream(task, "", stream, len(payload)))
+                         for uploader in (fast, slow, broken)}
+            with mock.patch.object(fanout.FanoutStream, "_feed", tracking_feed):
+                results = fanout.fanout_file(str(source), consumers, chunk_size=1024,
+                                             queue_size=2)
+
+            self.assertIs(results["fast"], True)
+            self.assertIs(results["slow"], True)
+            self.assertIsInstance(results["broken"], IOError)
+            self.assertEqual(fast.received, payload)
+            self.assertEqual(slow.received, payload)
+            self.assertLessEqual(peak["depth"], 2)
+
+
+class SchedulerFanoutTests(unittest.TestCase):
+    def _run(self, temp_dir, uploaders, remote_dir=""):
+        source = Path(temp_dir) / "backup.tgz"
+        task = FileTask("t", source)
+        task_manager = TaskManager()
+        task_manager.set_encipher_file(temp_dir + "/state.txt")
+        task_manager.add_task(task)
+        upload_manager = UploadManager()
+        for uploader in uploaders:
+            upload_manager.add_upload_task(UploadTask(task, uploader, remote_dir))
+        scheduler = BackupScheduler(task_manager, upload_manager, fanout_uploads=True)
+        with mock.patch.object(fanout, "open", wraps=open) as opened:
+            result = scheduler.run()
+        return result, opened.call_count
+
+    def test_failed_stream_falls_back_to_its_own_file_upload(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(40000)
+            (Path(temp_dir) / "backup.tgz").write_bytes(payload)
+            good, broken = StreamingUploader("good"), StreamingUploader("broken", fail_after=1)
+
+            result, opened = self._run(temp_dir, [good, broken])
+
+            self.assertTrue(result)
+            self.assertEqual(opened, 1)
+            self.assertEqual((good.file_uploads, broken.file_uploads), (0, 1))
+            self.assertEqual(good.received, payload)
+            self.assertEqual(broken.received, payload)
+
+    def test_ftp_and_oss_are_fed_from_a_single_read(self):
+        ftp_server = FakeFTPServer()
+        patcher = mock.patch.object(ftp_uploader, "FTP", ftp_server.client_class())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        oss_server = FakeOSSServer()
+        oss_server.start()
+        self.addCleanup(oss_server.stop)
+
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(350 * 1024)
+            (Path(temp_dir) / "backup.tgz").write_bytes(payload)
+            oss = OSSUploader("oss", "id", "secret", oss_server.endpoint, "bucket",
+                              multipart_threshold=200 * 1024, part_size=100 * 1024)
+            ftp = FTPUploader("ftp", "host", 21, "user", "pass")
+
+            result, opened = self._run(temp_dir, [oss, ftp], "daily")
+
+            self.assertTrue(result)
+            self.assertEqual(opened, 1)
+            self.assertEqual(oss_server.objects, {"daily/backup.tgz": payload})
+            self.assertEqual(oss_server.count("UploadPart"), 4)
+            self.assertEqual(ftp_server.files, {"/daily/backup.tgz": payload})
+
+    def test_fanout_option_is_validated(self):
+        errors = _validate_config({"scheduler": {"fanout_uploads": "yes"}, "tasks": [],
+                                   "uploaders": []})
+        self.assertIn("scheduler.fanout_uploads 必须是布尔值", errors)
+
+
+if __name__ == "__main__":
+    unittest.main()
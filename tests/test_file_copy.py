@@ -0,0 +1,62 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from easybk import EncipherManager, SingleFileTask
+from easybk import file_copy
+from easybk.file_copy import copy_file_fast, copy_file_with_digest
+
+
+class FileCopyTests(unittest.TestCase):
+    def test_copy_with_digest_reads_once_and_matches_content(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "source"
+            target = Path(temp_dir) / "target"
+            payload = os.urandom(3 * file_copy.COPY_BUFFER_SIZE + 17)
+            source.write_bytes(payload)
+
+            digest = copy_file_with_digest(str(source), str(target))
+
+            self.assertEqual(digest, hashlib.sha256(payload).hexdigest())
+            self.assertEqual(target.read_bytes(), payload)
+
+    def test_fast_copy_falls_back_when_kernel_paths_fail(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "source"
+            source.write_bytes(b"payload" * 1000)
+
+            self.assertIn(copy_file_fast(str(source), str(Path(temp_dir) / "auto")),
+                          ("reflink", "copy_file_range", "sendfile", "copy"))
+
+            unsupported = mock.Mock(side_effect=OSError("unsupported"))
+            with mock.patch.object(file_copy, "_reflink", unsupported), \
+                    mock.patch.object(file_copy, "_copy_file_range", unsupported), \
+                    mock.patch.object(file_copy, "_sendfile", unsupported):
+                method = copy_file_fast(str(source), str(Path(temp_dir) / "plain"))
+
+            self.assertEqual(method, "copy")
+            self.assertEqual((Path(temp_dir) / "plain").read_bytes(), source.read_bytes())
+
+    def test_unchanged_single_file_leaves_no_temp_copy(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "source.conf"
+            output_dir = Path(temp_dir) / "out"
+            source.write_text("config", encoding="utf-8")
+            task = SingleFileTask("conf", str(output_dir), str(source),
+                                  backup_on_change=True, paranoid=True)
+            manager = EncipherManager()
+            manager.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+
+            self.assertTrue(task.run())
+            self.assertEqual(Path(task.get_output_full_path()).read_text(encoding="utf-8"),
+                             "config")
+            self.assertFalse(task.run())
+            self.assertEqual([path.name for path in output_dir.iterdir()],
+                             [task.get_output_file_name()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,317 @@
+import io
+import tempfile
+import threading
+import time
+import unittest
+from ftplib import error_perm
+from pathlib import Path
+from unittest import mock
+
+from easybk import FTPUploader, Task
+from easybk.uploaders import ftp_uploader
+
+
+class FakeFTPServer():
+    """保存在内存中的 FTP 服务器状态，记录登录次数和并发连接数。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.dirs = {"/"}
+        self.logins = 0
+        self.open = 0
+        self.peak = 0
+        self.sent = 0
+        # 第一次 STOR 发送该字节数后断开连接
+        self.fail_after = None
+        # 为 True 时 STOR 读取完数据后返回 552（空间不足）
+        self.quota_exceeded = False
+        self.unsupported = set()
+        self.commands = []
+
+    def client_class(self):
+        server = self
+
+        class FakeFTP():
+            def __init__(self):
+                self.cwd_path = "/"
+                self.alive = True
+
+            def putcmd(self, line):
+                server.commands.append(line.split(" ", 1)[0])
+
+            def connect(self, host, port, timeout=None):
+                pass
+
+            def login(self, username, password):
+                self.putcmd("USER " + username)
+                self.putcmd("PASS " + password)
+                with server.lock:
+                    server.logins += 1
+                    server.open += 1
+                    server.peak = max(server.peak, server.open)
+
+            def set_pasv(self, value):
+                pass
+
+            def voidcmd(self, command):
+                self.putcmd(command)
+                if not self.alive:
+                    raise EOFError("connection closed")
+                return "200 NOOP ok"
+
+            def pwd(self):
+                self.putcmd("PWD")
+                return self.cwd_path
+
+            def _path(self, name):
+                return name if name.startswith("/") else \
+                    (self.cwd_path.rstrip("/") + "/" + name)
+
+            def cwd(self, path):
+                self.putcmd("CWD " + path)
+                target = "/" if path == "/" else self._path(path)
+                if target not in server.dirs:
+                    raise error_perm("550 no such directory")
+                self.cwd_path = target
+
+            def mkd(self, name):
+                self.putcmd("MKD " + name)
+                server.dirs.add(self._path(name))
+
+            def storbinary(self, command, source, blocksize=8192, callback=None, rest=None):
+                verb, name = command.split(" ", 1)
+                self.putcmd("TYPE I")
+                self.putcmd("PASV")
+                if rest is not None:
+                    self.putcmd("REST {}".format(rest))
+                self.putcmd(command)
+                if rest is not None and "REST" in server.unsupported or verb in server.unsupported:
+                    raise error_perm("502 command not implemented")
+                if "PATHS" in server.unsupported and "/" in name:
+                    raise error_perm("553 could not create file")
+                path = self._path(name)
+                existing = server.files.get(path, b"")
+                if rest is not None:
+                    existing = existing[:rest]
+                elif verb == "STOR":
+                    existing = b""
+                data = source.read()
+                if server.fail_after is not None:
+                    data, server.fail_after = data[:server.fail_after], None
+                    server.files[path] = existing + data
+                    server.sent += len(data)
+                    raise EOFError("connection lost")
+                if server.quota_exceeded:
+                    server.sent += len(data)
+                    raise error_perm("552 quota exceeded")
+                time.sleep(0.02)
+                server.files[path] = existing + data
+                server.sent += len(data)
+
+            def size(self, name):
+                self.putcmd("SIZE " + name)
+                if "SIZE" in server.unsupported or self._path(name) not in server.files:
+                    raise error_perm("550 not available")
+                return len(server.files[self._path(name)])
+
+            def rename(self, source, target):
+                self.putcmd("RNFR " + source)
+                self.putcmd("RNTO " + target)
+                server.files[self._path(target)] = server.files.pop(self._path(source))
+
+            def delete(self, name):
+                self.putcmd("DELE " + name)
+                server.files.pop(self._path(name), None)
+
+            def quit(self):
+                self.putcmd("QUIT")
+                with server.lock:
+                    server.open -= 1
+
+        return FakeFTP
+
+
+class FileTask(Task):
+    def __init__(self, name, path):
+        super().__init__(name, str(Path(path).parent))
+        self.set_output_file_name_and_full_path(Path(path).name)
+
+    def do_task(self):
+        return True
+
+
+class FTPConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeFTPServer()
+        patcher = mock.patch.object(ftp_uploader, "FTP", self.server.client_class())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _tasks(self, temp_dir, count):
+        tasks = []
+        for index in range(count):
+            path = Path(temp_dir) / "backup{}.tgz".format(index)
+            path.write_bytes(b"data" * (index + 1))
+            tasks.append(FileTask("t{}".format(index), path))
+        return tasks
+
+    def test_parallel_uploads_share_a_bounded_set_of_logins(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            uploader = FTPUploader("ftp", "host", 21, "user", "pass", max_connections=2)
+            tasks = self._tasks(temp_dir, 6)
+
+            threads = [threading.Thread(target=uploader.do_upload, args=(task, "remote/dir"))
+                       for task in tasks]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(self.server.peak, 2)
+            self.assertEqual(self.server.logins, 2)
+            self.assertEqual(sorted(self.server.files),
+                             ["/remote/dir/backup{}.tgz".format(i) for i in range(6)])
+            uploader.close()
+            self.assertEqual(self.server.open, 0)
+
+    def test_dead_or_idle_connections_are_replaced(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            uploader = FTPUploader("ftp", "host", 21, "user", "pass")
+            uploader.ftp_pool.health_check_interval = 0
+            first, second, third = self._tasks(temp_dir, 3)
+
+            uploader.do_upload(first, "")
+            client = uploader.ftp_pool._idle[-1][0]
+            client._ftp.alive = False
+            uploader.do_upload(second, "")
+            self.assertEqual(self.server.logins, 2)
+
+            uploader.ftp_pool.idle_timeout = 0
+            time.sleep(0.01)
+            uploader.do_upload(third, "")
+            self.assertEqual(self.server.logins, 3)
+            self.assertEqual(self.server.open, 1)
+
+
+class FTPResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeFTPServer()
+        patcher = mock.patch.object(ftp_uploader, "FTP", self.server.client_class())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload_after_failure(self, temp_dir):
+        payload = bytes(range(256)) * 400
+        source = Path(temp_dir) / "backup.tgz"
+        source.write_bytes(payload)
+        self.server.fail_after = 60000
+        client = ftp_uploader.FTPClient("host", 21, "user", "pass", mock.Mock())
+        client.put_file("remote/backup.tgz.part", str(source), retry=3)
+        self.assertEqual(self.server.files["/remote/backup.tgz.part"], payload)
+        return len(payload)
+
+    def test_retry_resumes_with_rest_from_remote_size(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            size = self._upload_after_failure(temp_dir)
+            self.assertEqual(self.server.sent, size)
+
+    def test_retry_falls_back_to_appe_then_full_resend(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            self.server.unsupported = {"REST"}
+            size = self._upload_after_failure(temp_dir)
+            self.assertEqual(self.server.sent, size)
+
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            self.server.sent = 0
+            self.server.unsupported = {"REST", "APPE"}
+            size = self._upload_after_failure(temp_dir)
+            self.assertEqual(self.server.sent, 60000 + size)
+
+
+class FTPRoundTripTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeFTPServer()
+        patcher = mock.patch.object(ftp_uploader, "FTP", self.server.client_class())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload_twice(self, temp_dir):
+        uploader = FTPUploader("ftp", "host", 21, "user", "pass")
+        for name in ("first.tgz", "second.tgz"):
+            path = Path(temp_dir) / name
+            path.write_bytes(b"archive")
+            uploader.do_upload(FileTask(name, path), "backups/daily")
+        client = uploader.ftp_pool._idle[-1][0]
+        self.assertEqual(sorted(self.server.files),
+                         ["/backups/daily/first.tgz", "/backups/daily/second.tgz"])
+        return client
+
+    def test_known_directories_and_path_commands_skip_cwd(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            with self.assertLogs("FTPUploader", level="INFO") as captured:
+                client = self._upload_twice(temp_dir)
+
+            second = self.server.commands[self.server.commands.index("RNTO") + 1:]
+            self.assertEqual(second, ["TYPE", "PASV", "STOR", "SIZE", "RNFR", "RNTO"])
+            self.assertNotIn("PWD", self.server.commands)
+            self.assertTrue(captured.output[-1].endswith("控制连接命令 6 次"))
+            self.assertEqual(client.command_count, len(self.server.commands))
+
+    def test_falls_back_to_cwd_when_paths_are_rejected(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            self.server.unsupported = {"PATHS"}
+            self._upload_twice(temp_dir)
+
+            second = self.server.commands[self.server.commands.index("RNTO") + 1:]
+            self.assertEqual(second, ["TYPE", "PASV", "STOR", "SIZE", "RNFR", "RNTO"])
+
+    def test_errors_unrelated_to_paths_keep_path_commands(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            path = Path(temp_dir) / "backup.tgz"
+            path.write_bytes(b"archive")
+            client = ftp_uploader.FTPClient("host", 21, "user", "pass", mock.Mock())
+            self.server.unsupported = {"STOR"}
+            with self.assertRaises(error_perm):
+                client.put_file("/backups/backup.tgz", str(path), retry=1)
+            self.assertIsNone(client.file_size("/backups/missing.tgz"))
+            self.assertTrue(client._use_paths)
+
+    def test_errors_after_the_transfer_are_not_retried_without_paths(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            path = Path(temp_dir) / "backup.tgz"
+            path.write_bytes(b"archive")
+            client = ftp_uploader.FTPClient("host", 21, "user", "pass", mock.Mock())
+            self.server.quota_exceeded = True
+
+            with self.assertRaises(error_perm):
+                client.put_file("/backups/backup.tgz", str(path), retry=1)
+            with self.assertRaises(error_perm):
+                client.put_stream("/backups/stream.tgz", io.BytesIO(b"stream"))
+
+            self.assertEqual(self.server.commands.count("STOR"), 2)
+            self.assertEqual(self.server.sent, len(b"archive") + len(b"stream"))
+            self.assertTrue(client._use_paths)
+
+    def test_skip_checks_the_remote_size_before_trusting_the_index(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            uploader = FTPUploader("ftp", "host", 21, "user", "pass")
+            uploader.set_dedup("skip", index_dir=temp_dir)
+            path = Path(temp_dir) / "file.tgz"
+            path.write_bytes(b"archive")
+            task = FileTask("file", path)
+            task.set_output_file_name_and_full_path(path.name, "abc")
+            self.assertTrue(uploader.upload(task, "daily"))
+
+            stores = self.server.commands.count("STOR")
+            self.assertTrue(uploader.upload(task, "weekly"))
+            self.assertEqual(self.server.commands.count("STOR"), stores)
+
+            self.server.files.clear()
+            self.assertTrue(uploader.upload(task, "weekly"))
+            self.assertEqual(sorted(self.server.files), ["/weekly/file.tgz"])
+            self.assertEqual(uploader.dedup_index.lookup("abc"), "weekly/file.tgz")
+
+
+if __name__ == "__main__":
+    unittest.main()
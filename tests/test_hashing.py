@@ -0,0 +1,81 @@
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from config_parser import _validate_config
+from easybk import EncipherManager, SingleFileTask
+from easybk import hashing
+from easybk.hashing import hash_file, new_hasher, parse_token
+
+
+def _age_file(path, seconds=60):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+class HashingTests(unittest.TestCase):
+    def test_tokens_keep_sha256_bare_and_prefix_other_algorithms(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            path = Path(temp_dir) / "data.bin"
+            data = os.urandom(3 * hashing.TREE_LEAF_SIZE + 12345)
+            path.write_bytes(data)
+
+            self.assertEqual(hash_file(str(path)), hashlib.sha256(data).hexdigest())
+            self.assertEqual(hash_file(str(path), "blake2b"),
+                             "blake2b:" + hashlib.blake2b(data, digest_size=32).hexdigest())
+            self.assertEqual(parse_token(hashlib.sha256(data).hexdigest())[0], "sha256")
+
+            streamed = new_hasher("blake2b-tree")
+            for offset in range(0, len(data), 1000003):
+                streamed.update(data[offset:offset + 1000003])
+            with mock.patch.object(hashing, "PARALLEL_MIN_SIZE", 0):
+                parallel = hash_file(str(path), "blake2b-tree", workers=3)
+            self.assertEqual(parallel, streamed.hexdigest())
+            self.assertEqual(parallel, hash_file(str(path), "blake2b-tree", workers=1))
+            self.assertTrue(parallel.startswith("blake2b-tree:"))
+
+    def test_switching_algorithm_does_not_trigger_backup(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "source.conf"
+            source.write_text("config", encoding="utf-8")
+            _age_file(source)
+            output_dir = str(Path(temp_dir) / "out")
+            task = SingleFileTask("conf", output_dir, str(source), backup_on_change=True,
+                                  paranoid=True)
+            manager = EncipherManager()
+            manager.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+            self.assertTrue(task.run())
+
+            task = SingleFileTask("conf", output_dir, str(source), backup_on_change=True,
+                                  paranoid=True, hash_algorithm="blake2b-tree")
+            self.assertFalse(task.run())
+            self.assertTrue(manager.get_value(str(source)).startswith("blake2b-tree:"))
+
+            source.write_text("changed", encoding="utf-8")
+            _age_file(source, 30)
+            self.assertTrue(task.run())
+            self.assertNotIn(":", task.get_output_file_name())
+            self.assertEqual(Path(task.get_output_full_path()).read_text(encoding="utf-8"),
+                             "changed")
+
+    def test_benchmark_and_config_validation(self):
+        results = hashing.benchmark([1024, 64 * 1024], ("sha256", "blake2b"), repeat=1,
+                                    directory=".")
+        self.assertEqual([(size, name) for size, name, _ in results],
+                         [(1024, "sha256"), (1024, "blake2b"),
+                          (65536, "sha256"), (65536, "blake2b")])
+        errors = _validate_config({
+            "tasks": [{"type": "single_file", "task_name": "conf", "output_dir": "out",
+                       "source_file": "a", "hash_algorithm": "md5"}],
+            "uploaders": [],
+        })
+        self.assertEqual(errors, ["tasks[0].hash_algorithm 不受支持: md5"
+                                  "（可选: sha256, blake2b, blake2b-tree）"])
+
+
+if __name__ == "__main__":
+    unittest.main()
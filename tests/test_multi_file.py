@@ -0,0 +1,115 @@
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from config_parser import _validate_config
+from easybk import EncipherManager, MultiFileTask, UploadTask, Uploader
+from easybk.tasks import multi_file_task
+
+
+def _age_file(path, seconds=60):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+class RecordingUploader(Uploader):
+    def __init__(self):
+        super().__init__("recording")
+        self.uploaded = {}
+
+    def do_upload(self, task, remote_dir):
+        self.uploaded[task.get_output_file_name()] = \
+            Path(task.get_output_full_path()).read_bytes()
+        return True
+
+
+class MultiFileTaskTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory(dir=".")
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name).resolve()
+        self.etc = self.root / "etc"
+        (self.etc / "nginx" / "sites").mkdir(parents=True)
+        self.files = {
+            self.etc / "nginx" / "nginx.conf": "worker_processes 4;\n",
+            self.etc / "nginx" / "sites" / "default": "server {}\n",
+            self.etc / "hosts": "127.0.0.1 localhost\n",
+            self.etc / "motd": "ignored\n",
+        }
+        for path, content in self.files.items():
+            path.write_text(content, encoding="utf-8")
+            _age_file(path)
+        self.output_dir = str(self.root / "out")
+        self.manager = EncipherManager()
+
+    def _task(self, **options):
+        task = MultiFileTask("configs", self.output_dir,
+                             [str(self.etc / "nginx"), str(self.etc / "host*")], **options)
+        self.manager.load_data_from_file(str(self.root / "state.txt"))
+        return task
+
+    def _relative(self, path):
+        return str(path).lstrip(os.sep)
+
+    def test_only_changed_files_are_copied_and_uploaded_per_file(self):
+        task = self._task(hash_workers=3)
+        self.assertTrue(task.run())
+        batch = Path(task.get_output_full_path())
+        self.assertEqual(sorted(str(path.relative_to(batch)) for path in batch.rglob("*")
+                                if path.is_file()),
+                         sorted(self._relative(path) for path in self.files
+                                if path.name != "motd"))
+        self.manager.commit(task.get_name())
+
+        with mock.patch.object(multi_file_task, "hash_file",
+                               wraps=multi_file_task.hash_file) as hashed:
+            self.assertFalse(task.run())
+            self.assertEqual(hashed.call_count, 0)
+
+        changed = self.etc / "nginx" / "nginx.conf"
+        changed.write_text("worker_processes 8;\n", encoding="utf-8")
+        _age_file(changed, 30)
+        self.assertTrue(task.run())
+        batch_name = task.get_output_file_name()
+        self.assertTrue(batch_name.startswith("configs."))
+
+        uploader = RecordingUploader()
+        self.assertTrue(UploadTask(task, uploader, "remote").run())
+        self.assertEqual(uploader.uploaded,
+                         {"{}/{}".format(batch_name, self._relative(changed)):
+                          b"worker_processes 8;\n"})
+
+    def test_bundle_mode_outputs_one_archive(self):
+        task = self._task(bundle=True)
+        self.assertTrue(task.run())
+        self.manager.commit(task.get_name())
+        self.assertEqual(task.get_outputs(), [task])
+        self.assertTrue(task.get_output_file_name().startswith("configs_batch_"))
+        with tarfile.open(task.get_output_full_path()) as bundle:
+            self.assertEqual(len(bundle.getnames()), 3)
+
+        added = self.etc / "hosts.allow"
+        added.write_text("ALL: LOCAL\n", encoding="utf-8")
+        _age_file(added, 30)
+        self.assertTrue(task.run())
+        with tarfile.open(task.get_output_full_path()) as bundle:
+            self.assertEqual(bundle.getnames(), [self._relative(added)])
+            self.assertEqual(bundle.extractfile(self._relative(added)).read(), b"ALL: LOCAL\n")
+
+    def test_multi_file_config_is_validated(self):
+        errors = _validate_config({
+            "tasks": [{"type": "multi_file", "task_name": "configs", "output_dir": "out",
+                       "sources": ["/etc/nginx", ""], "bundle": "yes", "hash_workers": 0}],
+            "uploaders": [],
+        })
+        self.assertEqual(errors, ["tasks[0].sources 必须是文件、目录或 glob 的列表",
+                                  "tasks[0].bundle 必须是布尔值",
+                                  "tasks[0].hash_workers 必须是正整数"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import gzip
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from easybk import EncipherManager
+from easybk.sql_delta import SqlChunker, restore
+from easybk.tasks import MysqlTask
+
+
+def _install_script(bin_dir, name, body):
+    path = Path(bin_dir) / name
+    path.write_text("#!/bin/sh\n" + body, encoding="utf-8")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+def _path_with(bin_dir):
+    return {"PATH": str(bin_dir) + os.pathsep + os.environ.get("PATH", "")}
+
+
+class MysqlTaskTests(unittest.TestCase):
+    def test_streaming_dump_writes_compressed_sql_without_temp_file(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            bin_dir = Path(temp_dir) / "bin"
+            output_dir = Path(temp_dir) / "output"
+            bin_dir.mkdir()
+            _install_script(bin_dir, "mysqldump",
+                            'echo "-- args: $*"\n'
+                            'i=0; while [ $i -lt 2000 ]; do '
+                            'echo "INSERT INTO t VALUES ($i);"; i=$((i+1)); done\n')
+            task = MysqlTask("db", str(output_dir), ["--user=root", "mydb"], streaming=True)
+
+            with mock.patch.dict(os.environ, _path_with(bin_dir)):
+                self.assertTrue(task.run())
+
+            archive = Path(task.get_output_full_path())
+            self.assertTrue(archive.name.startswith("db_backup.sql."))
+            self.assertTrue(archive.name.endswith(
+                "_{}.gz".format(hashlib.sha256(archive.read_bytes()).hexdigest())))
+            sql = gzip.decompress(archive.read_bytes()).decode()
+            self.assertTrue(sql.startswith("-- args: --user=root mydb\n"))
+            self.assertIn("INSERT INTO t VALUES (1999);", sql)
+            self.assertEqual([path.name for path in output_dir.iterdir()], [archive.name])
+
+    def test_streaming_dump_failure_is_reported_and_cleaned_up(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            bin_dir = Path(temp_dir) / "bin"
+            output_dir = Path(temp_dir) / "output"
+            bin_dir.mkdir()
+            _install_script(bin_dir, "mysqldump",
+                            'echo "partial"\necho "Access denied" >&2\nexit 2\n')
+            task = MysqlTask("db", str(output_dir), "--user=root mydb", streaming=True)
+
+            with mock.patch.dict(os.environ, _path_with(bin_dir)), \
+                    self.assertLogs("MysqlTask", level="ERROR") as captured:
+                with self.assertRaises(subprocess.CalledProcessError):
+                    task.run()
+
+            self.assertIn("Access denied", "\n".join(captured.output))
+            self.assertIsNone(task.get_output_full_path())
+            self.assertEqual(list(output_dir.iterdir()), [])
+
+    def test_split_by_table_dumps_in_parallel_and_bundles_manifest(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            bin_dir = Path(temp_dir) / "bin"
+            output_dir = Path(temp_dir) / "output"
+            mysql_args = Path(temp_dir) / "mysql.args"
+            bin_dir.mkdir()
+            _install_script(bin_dir, "mysql",
+                            'echo "$*" >> "{}"\nprintf "orders\\nusers\\n"\n'.format(mysql_args))
+            _install_script(bin_dir, "mysqldump", 'echo "-- dump $*"\n')
+            task = MysqlTask("db", str(output_dir), ["--user=backup", "--single-transaction"],
+                             split_by="table", databases=["shop"], dump_workers=2)
+
+            with mock.patch.dict(os.environ, _path_with(bin_dir)):
+                self.assertTrue(task.run())
+
+            self.assertIn("--user=backup", mysql_args.read_text(encoding="utf-8"))
+            self.assertNotIn("--single-transaction", mysql_args.read_text(encoding="utf-8"))
+            archive = Path(task.get_output_full_path())
+            self.assertTrue(archive.name.endswith(".tar"))
+            with tarfile.open(str(archive)) as bundle:
+                manifest = json.load(bundle.extractfile("manifest.json"))
+                dumps = {entry["table"]: gzip.decompress(
+                    bundle.extractfile(entry["file"]).read()).decode()
+                    for entry in manifest["files"]}
+            self.assertEqual(manifest["split_by"], "table")
+            self.assertEqual(dumps, {
+                "orders": "-- dump --user=backup --single-transaction shop orders\n",
+                "users": "-- dump --user=backup --single-transaction shop users\n",
+            })
+            self.assertEqual([path.name for path in output_dir.iterdir()], [archive.name])
+
+    def test_delta_dump_uploads_changes_and_restores_full_sql(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            bin_dir = Path(temp_dir) / "bin"
+            output_dir = Path(temp_dir) / "output"
+            source = Path(temp_dir) / "dump.sql"
+            bin_dir.mkdir()
+            _install_script(bin_dir, "mysqldump", 'cat "{}"\n'.format(source))
+            rows = ["({},'{}')".format(i, hashlib.sha256(str(i).encode()).hexdigest())
+                    for i in range(20000)]
+
+            def write_dump(rows):
+                lines = ["INSERT INTO t VALUES " + ",".join(rows[i:i + 2000]) + ";"
+                         for i in range(0, len(rows), 2000)]
+                source.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+            task = MysqlTask("db", str(output_dir), "--user=root mydb", delta=True,
+                             full_backup_interval=1)
+            state = EncipherManager()
+            state.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+
+            def run_and_commit():
+                with mock.patch.dict(os.environ, _path_with(bin_dir)):
+                    self.assertTrue(task.run())
+                state.save_data_to_file()
+                return Path(task.get_output_full_path())
+
+            write_dump(rows)
+            full = run_and_commit()
+            self.assertTrue(full.name.endswith("_{}.gz".format(task.get_output_digest())))
+            self.assertEqual(gzip.decompress(full.read_bytes()), source.read_bytes())
+
+            rows.insert(100, "(-1,'inserted')")
+            rows[15000] = "(15000,'updated')"
+            write_dump(rows)
+            with mock.patch.object(state.store, "commit", wraps=state.store.commit) as commit:
+                delta = run_and_commit()
+            # 差异导出只更新计数，不重写基准索引
+            self.assertEqual(sorted(commit.call_args[0][1]), ["db.delta"])
+            self.assertTrue(delta.name.endswith(".delta.gz"))
+            self.assertLess(delta.stat().st_size, full.stat().st_size // 10)
+
+            restored = Path(temp_dir) / "restored.sql"
+            restore(str(full), str(delta), str(restored))
+            self.assertEqual(restored.read_bytes(), source.read_bytes())
+
+            self.assertNotIn(".delta", run_and_commit().name)
+
+    def test_oversized_base_index_is_not_saved(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            bin_dir = Path(temp_dir) / "bin"
+            bin_dir.mkdir()
+            source = Path(temp_dir) / "dump.sql"
+            source.write_bytes(b"".join(b"INSERT INTO t VALUES (%d);\n" % i for i in range(20000)))
+            _install_script(bin_dir, "mysqldump", 'cat "{}"\n'.format(source))
+            task = MysqlTask("db", str(Path(temp_dir) / "output"), "mydb", delta=True)
+            state = EncipherManager()
+            state.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+            with mock.patch("easybk.sql_delta.BASE_INDEX_MAX_CHUNKS", 10):
+                for _ in range(2):
+                    with mock.patch.dict(os.environ, _path_with(bin_dir)):
+                        self.assertTrue(task.run())
+                    state.save_data_to_file()
+                    self.assertNotIn(".delta", task.get_output_file_name())
+            self.assertEqual(state.load_manifest_entries("db"), {})
+
+    def test_sql_chunks_do_not_depend_on_feed_size(self):
+        data = b"".join(b"INSERT INTO t VALUES " + b",".join(
+            b"(%d,'%s')" % (i, b"x" * (i * 7 % 300)) for i in range(line * 50, line * 50 + 500))
+            + b";\n" + b"\0" * (line % 3 * 40000) for line in range(40))
+
+        def chunks(step):
+            chunker = SqlChunker()
+            result = []
+            for offset in range(0, len(data), step):
+                result.extend(chunker.feed(data[offset:offset + step]))
+            return result + chunker.finish()
+
+        expected = chunks(len(data))
+        self.assertEqual(b"".join(expected), data)
+        self.assertLessEqual(max(map(len, expected)), 64 * 1024)
+        for step in (4096, 65536, 100003):
+            self.assertEqual(chunks(step), expected)
+
+    def test_restore_rejects_a_different_base(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            bin_dir = Path(temp_dir) / "bin"
+            bin_dir.mkdir()
+            source = Path(temp_dir) / "dump.sql"
+            _install_script(bin_dir, "mysqldump", 'cat "{}"\n'.format(source))
+            task = MysqlTask("db", str(Path(temp_dir) / "output"), "mydb", delta=True)
+            state = EncipherManager()
+            state.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+            outputs = []
+            for content in (b"base\n" * 1000, b"changed\n" * 1000):
+                source.write_bytes(content)
+                with mock.patch.dict(os.environ, _path_with(bin_dir)):
+                    task.run()
+                state.save_data_to_file()
+                outputs.append(task.get_output_full_path())
+            other = Path(temp_dir) / "other.sql"
+            other.write_bytes(b"other\n")
+
+            with self.assertRaises(ValueError):
+                restore(str(other), outputs[1], str(Path(temp_dir) / "restored.sql"))
+            self.assertFalse((Path(temp_dir) / "restored.sql").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,529 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+
+import oss2
+
+from config_parser import _validate_config
+from easybk import OSSUploader, Task
+
+
+def _crc64(data):
+    crc = oss2.utils.Crc64(0)
+    crc.update(data)
+    return str(crc.crc)
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭保持的连接时会出现 ConnectionResetError，忽略
+        pass
+
+
+class FakeOSSServer():
+    """
+    本地 OSS API 替身，实现路径风格（IP 端点）下对象和分片上传所需的接口。
+    fail_parts 中的分片号在第一次上传时返回 500。
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.fail_parts = set()
+        self.corrupt_crc = False
+        self.lock = threading.Lock()
+        self.httpd = _QuietHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, operation):
+        return sum(1 for name, _ in self.requests if name == operation)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _key(self):
+                path = urlsplit(self.path).path
+                return unquote(path.split("/", 2)[2]) if path.count("/") >= 2 else ""
+
+            def _query(self):
+                return {name: values[0] for name, values
+                        in parse_qs(urlsplit(self.path).query, keep_blank_values=True).items()}
+
+            def _body(self):
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                        if size == 0:
+                            return b"".join(chunks)
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _send(self, status, body=b"", headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("x-oss-request-id", uuid.uuid4().hex)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _error(self, status, code):
+                body = ("<?xml version=\"1.0\"?><Error><Code>{}</Code><Message>{}</Message>"
+                        "<RequestId>x</RequestId><HostId>h</HostId></Error>").format(code, code)
+                self._send(status, body.encode(), {"Content-Type": "application/xml"})
+
+            def _xml(self, body):
+                self._send(200, body.encode(), {"Content-Type": "application/xml"})
+
+            def _object_headers(self, data):
+                return {"ETag": '"{}"'.format(hashlib.md5(data).hexdigest().upper()),
+                        "x-oss-hash-crc64ecma": _crc64(data)}
+
+            def do_HEAD(self):
+                server.requests.append(("HeadObject", self._key()))
+                data = server.objects.get(self._key())
+                if data is None:
+                    self._error(404, "NoSuchKey")
+                    return
+                headers = self._object_headers(data)
+                headers.update({"Last-Modified": formatdate(usegmt=True),
+                                "x-oss-object-type": "Normal"})
+                self.send_response(200)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+
+            def do_GET(self):
+                query = self._query()
+                if "uploads" in query:
+                    server.requests.append(("ListMultipartUploads", query.get("prefix", "")))
+                    uploads = "".join(
+                        "<Upload><Key>{}</Key><UploadId>{}</UploadId><Initiated>{}</Initiated>"
+                        "</Upload>".format(upload["key"], upload_id, time.strftime(
+                            "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(upload["initiated"])))
+                        for upload_id, upload in sorted(server.uploads.items())
+                        if upload["key"].startswith(query.get("prefix", "")))
+                    self._xml("<ListMultipartUploadsResult><IsTruncated>false</IsTruncated>"
+                              "<NextKeyMarker></NextKeyMarker><NextUploadIdMarker>"
+                              "</NextUploadIdMarker>{}</ListMultipartUploadsResult>".format(uploads))
+                    return
+                upload = server.uploads.get(query.get("uploadId"))
+                if upload is None:
+                    self._error(404, "NoSuchUpload")
+                    return
+                server.requests.append(("ListParts", self._key()))
+                parts = "".join(
+                    "<Part><PartNumber>{}</PartNumber><LastModified>2024-01-01T00:00:00.000Z"
+                    "</LastModified><ETag>\"{}\"</ETag><Size>{}</Size></Part>".format(
+                        number, hashlib.md5(data).hexdigest().upper(), len(data))
+                    for number, data in sorted(upload["parts"].items()))
+                self._xml("<ListPartsResult><IsTruncated>false</IsTruncated>"
+                          "<NextPartNumberMarker>0</NextPartNumberMarker>{}"
+                          "</ListPartsResult>".format(parts))
+
+            def do_PUT(self):
+                query = self._query()
+                body = self._body()
+                key = self._key()
+                if "partNumber" in query:
+                    number = int(query["partNumber"])
+                    source = self.headers.get("x-oss-copy-source")
+                    if source:
+                        start, end = self.headers["x-oss-copy-source-range"][6:].split("-")
+                        body = server.objects[unquote(source).split("/", 2)[2]][
+                            int(start):int(end) + 1]
+                        with server.lock:
+                            server.requests.append(("UploadPartCopy", number))
+                            server.uploads[query["uploadId"]]["parts"][number] = body
+                        self._send(200, headers=self._object_headers(body))
+                        return
+                    with server.lock:
+                        if number in server.fail_parts:
+                            server.fail_parts.discard(number)
+                            self._error(500, "InternalError")
+                            return
+                        server.requests.append(("UploadPart", number))
+                        server.uploads[query["uploadId"]]["parts"][number] = body
+                    self._send(200, headers=self._object_headers(body))
+                    return
+                if "symlink" in query:
+                    server.requests.append(("PutSymlink", key))
+                    server.objects[key] = server.objects[
+                        unquote(self.headers["x-oss-symlink-target"])]
+                    self._send(200)
+                    return
+                source = self.headers.get("x-oss-copy-source")
+                if source:
+                    server.requests.append(("CopyObject", key))
+                    data = server.objects[unquote(source).split("/", 2)[2]]
+                    server.objects[key] = data
+                    headers = self._object_headers(data)
+                    headers["Content-Type"] = "application/xml"
+                    self._send(200, "<CopyObjectResult><ETag>\"{}\"</ETag><LastModified>"
+                                    "2024-01-01T00:00:00.000Z</LastModified></CopyObjectResult>"
+                                    .format(hashlib.md5(data).hexdigest().upper()).encode(),
+                               headers)
+                    return
+                server.requests.append(("PutObject", key))
+                server.objects[key] = body
+                self._send(200, headers=self._object_headers(body))
+
+            def do_POST(self):
+                query = self._query()
+                body = self._body()
+                key = self._key()
+                if "uploads" in query:
+                    upload_id = uuid.uuid4().hex
+                    server.requests.append(("InitiateMultipartUpload", key))
+                    server.uploads[upload_id] = {"key": key, "parts": {},
+                                                 "initiated": time.time()}
+                    self._xml("<InitiateMultipartUploadResult><Key>{}</Key><UploadId>{}"
+                              "</UploadId></InitiateMultipartUploadResult>".format(key, upload_id))
+                    return
+                upload = server.uploads.pop(query["uploadId"])
+                numbers = [int(node.text) for node in
+                           ElementTree.fromstring(body).iter("PartNumber")]
+                data = b"".join(upload["parts"][number] for number in numbers)
+                server.requests.append(("CompleteMultipartUpload", key))
+                server.objects[key] = data
+                headers = self._object_headers(data)
+                headers["Content-Type"] = "application/xml"
+                if server.corrupt_crc:
+                    headers["x-oss-hash-crc64ecma"] = "1"
+                self._send(200, "<CompleteMultipartUploadResult><Key>{}</Key>"
+                                "</CompleteMultipartUploadResult>".format(key).encode(), headers)
+
+            def do_DELETE(self):
+                upload_id = self._query().get("uploadId")
+                if upload_id:
+                    server.requests.append(("AbortMultipartUpload", self._key()))
+                    server.uploads.pop(upload_id, None)
+                    self._send(204)
+                    return
+                server.requests.append(("DeleteObject", self._key()))
+                server.objects.pop(self._key(), None)
+                self._send(204)
+
+        return Handler
+
+
+class FileTask(Task):
+    def __init__(self, path, digest=None):
+        super().__init__("file", str(Path(path).parent))
+        self.set_output_file_name_and_full_path(Path(path).name, digest)
+
+    def do_task(self):
+        return True
+
+
+class OSSMultipartTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeOSSServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def _uploader(self, checkpoint_dir, **kwargs):
+        options = {"multipart_threshold": 200 * 1024, "part_size": 100 * 1024,
+                   "part_workers": 3, "checkpoint_dir": checkpoint_dir}
+        options.update(kwargs)
+        return OSSUploader("oss", "id", "secret", self.server.endpoint, "bucket", **options)
+
+    def test_large_file_is_uploaded_in_parallel_parts_and_promoted(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(550 * 1024)
+            source = Path(temp_dir) / "backup.tgz"
+            source.write_bytes(payload)
+
+            uploader = self._uploader(str(Path(temp_dir) / "checkpoints"))
+            self.assertTrue(uploader.do_upload(FileTask(source), "daily"))
+
+            self.assertEqual(self.server.objects, {"daily/backup.tgz": payload})
+            self.assertEqual(self.server.count("UploadPart"), 6)
+            self.assertEqual(self.server.count("PutObject"), 0)
+            self.assertEqual(os.listdir(str(Path(temp_dir) / "checkpoints")), [])
+
+    def test_temp_object_above_copy_limit_is_promoted_by_part_copy(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(550 * 1024)
+            source = Path(temp_dir) / "backup.tgz"
+            source.write_bytes(payload)
+
+            uploader = self._uploader(str(Path(temp_dir) / "checkpoints"))
+            with mock.patch("easybk.uploaders.oss_uploader.COPY_OBJECT_LIMIT", 300 * 1024):
+                self.assertTrue(uploader.do_upload(FileTask(source), "daily"))
+
+            self.assertEqual(self.server.objects, {"daily/backup.tgz": payload})
+            self.assertEqual(self.server.count("CopyObject"), 0)
+            self.assertEqual(self.server.count("UploadPartCopy"), 6)
+
+    def test_interrupted_upload_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(550 * 1024)
+            source = Path(temp_dir) / "backup.tgz"
+            source.write_bytes(payload)
+            checkpoints = str(Path(temp_dir) / "checkpoints")
+            self.server.fail_parts = {4}
+
+            with self.assertRaises(oss2.exceptions.ServerError):
+                self._uploader(checkpoints, retries=1, part_workers=1).do_upload(
+                    FileTask(source), "daily")
+            self.assertEqual(self.server.count("UploadPart"), 5)
+            self.assertEqual(len(os.listdir(checkpoints)), 1)
+
+            # 再次上传同一文件到同一 key 时，新的上传器实例从断点继续，只补传缺失的分片
+            self.assertTrue(self._uploader(checkpoints).do_upload(FileTask(source), "daily"))
+            self.assertEqual(self.server.count("UploadPart"), 6)
+            self.assertEqual(self.server.count("InitiateMultipartUpload"), 1)
+            self.assertEqual(self.server.objects, {"daily/backup.tgz": payload})
+            self.assertEqual(os.listdir(checkpoints), [])
+
+    def test_next_run_resumes_the_same_content_under_a_new_name(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(550 * 1024)
+            first = Path(temp_dir) / "site_backup_240101_030000_abc.tgz"
+            second = Path(temp_dir) / "site_backup_240102_030000_abc.tgz"
+            first.write_bytes(payload)
+            second.write_bytes(payload)
+            checkpoints = str(Path(temp_dir) / "checkpoints")
+            self.server.fail_parts = {3}
+
+            # 第一次运行在第 3 个分片处中断，分片上传和断点都保留
+            with self.assertRaises(oss2.exceptions.ServerError):
+                self._uploader(checkpoints, retries=1, part_workers=1).do_upload(
+                    FileTask(first, "abc"), "20240101")
+            uploaded = self.server.count("UploadPart")
+            self.assertEqual(len(self.server.uploads), 1)
+
+            # 第二天的运行：新的上传器实例、新的文件名和远端目录，内容摘要相同
+            uploader = self._uploader(checkpoints, stale_upload_age=3600,
+                                      stale_upload_prefix="2024")
+            self.assertTrue(uploader.do_upload(FileTask(second, "abc"), "20240102"))
+
+            self.assertEqual(self.server.count("UploadPart"), uploaded + 1)
+            self.assertEqual(self.server.count("InitiateMultipartUpload"), 1)
+            self.assertEqual(self.server.objects,
+                             {"20240102/site_backup_240102_030000_abc.tgz": payload})
+            self.assertEqual(self.server.uploads, {})
+            self.assertEqual(os.listdir(checkpoints), [])
+
+    def test_stale_cleanup_is_opt_in_and_limited_to_its_own_uploads(self):
+        with self.assertRaises(ValueError):
+            self._uploader(None, stale_upload_age=3600)
+        self.assertEqual(_validate_config({"tasks": [], "uploaders": [
+            {"type": "oss", "name": "oss", "access_id": "i", "access_key": "k",
+             "endpoint": "e", "bucket_name": "b", "stale_upload_age": 3600}]}),
+            ["uploaders[0].stale_upload_age 需要设置非空的 stale_upload_prefix"])
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "backup.tgz"
+            source.write_bytes(b"small archive")
+            checkpoints = Path(temp_dir) / "checkpoints"
+            checkpoints.mkdir()
+            two_days_ago = time.time() - 2 * 24 * 3600
+            stale = checkpoints / "{}.oss.checkpoint".format("0" * 32)
+            stale.write_text('{"key": "2023/a.tgz.part", "upload_id": "stale"}')
+            resumable = checkpoints / "{}.oss.checkpoint".format("1" * 32)
+            resumable.write_text('{"key": "backup/20240101/b.tgz", "upload_id": "resumable"}')
+            foreign = [checkpoints / "other-tool", checkpoints / "{}.oss-b.checkpoint".format(
+                "2" * 32)]
+            for path in foreign:
+                path.write_text("{}")
+            for path in [stale] + foreign:
+                os.utime(str(path), (two_days_ago, two_days_ago))
+            # 上次运行留在前一天目录下的分片上传也要清理；仍有断点的、前缀之外的不动
+            self.server.uploads = {
+                "stale": {"key": "2023/a.tgz.part", "parts": {}, "initiated": two_days_ago},
+                "orphan": {"key": "backup/20240101/a.tgz", "parts": {},
+                           "initiated": two_days_ago},
+                "resumable": {"key": "backup/20240101/b.tgz", "parts": {},
+                              "initiated": two_days_ago},
+                "fresh": {"key": "backup/20240102/c.tgz", "parts": {},
+                          "initiated": time.time()},
+                "other": {"key": "other/d.tgz", "parts": {}, "initiated": two_days_ago},
+            }
+
+            self.assertTrue(self._uploader(str(checkpoints)).do_upload(
+                FileTask(source), "backup/20240103"))
+            self.assertEqual(len(self.server.uploads), 5)
+
+            uploader = self._uploader(str(checkpoints), stale_upload_age=24 * 3600,
+                                      stale_upload_prefix="backup/")
+            self.assertTrue(uploader.do_upload(FileTask(source), "backup/20240103"))
+            self.assertTrue(uploader.do_upload(FileTask(source), "backup/20240103/db"))
+
+            self.assertEqual(sorted(self.server.uploads), ["fresh", "other", "resumable"])
+            self.assertEqual(sorted(os.listdir(str(checkpoints))),
+                             sorted([resumable.name] + [path.name for path in foreign]))
+            self.assertEqual(self.server.requests.count(("ListMultipartUploads", "backup/")), 1)
+            self.assertEqual(self.server.count("ListMultipartUploads"), 1)
+
+    def test_transient_part_failure_is_retried_within_the_same_upload(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            payload = os.urandom(300 * 1024)
+            source = Path(temp_dir) / "backup.tgz"
+            source.write_bytes(payload)
+            self.server.fail_parts = {2}
+
+            uploader = self._uploader(str(Path(temp_dir) / "checkpoints"),
+                                      use_temp_object=False)
+            self.assertTrue(uploader.do_upload(FileTask(source), ""))
+
+            self.assertEqual(self.server.objects, {"backup.tgz": payload})
+            self.assertEqual(self.server.count("InitiateMultipartUpload"), 1)
+
+    def test_atomic_commit_skips_temp_object_copy_and_head_requests(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            large = Path(temp_dir) / "large.tgz"
+            small = Path(temp_dir) / "small.tgz"
+            large.write_bytes(os.urandom(350 * 1024))
+            small.write_bytes(b"small archive")
+
+            uploader = self._uploader(str(Path(temp_dir) / "checkpoints"), atomic_commit=True)
+            self.assertTrue(uploader.do_upload(FileTask(large), "daily"))
+            self.assertTrue(uploader.do_upload(FileTask(small), "daily"))
+
+            self.assertEqual(self.server.objects, {"daily/large.tgz": large.read_bytes(),
+                                                   "daily/small.tgz": b"small archive"})
+            for operation in ("HeadObject", "CopyObject", "DeleteObject"):
+                self.assertEqual(self.server.count(operation), 0, operation)
+            self.assertEqual(self.server.count("CompleteMultipartUpload"), 1)
+            self.assertEqual(self.server.count("PutObject"), 1)
+
+    def test_atomic_commit_reads_the_file_only_while_uploading(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "small.tgz"
+            source.write_bytes(b"small archive")
+            opened = []
+            real_open = open
+
+            def tracking_open(file, *args, **kwargs):
+                if str(file) == str(source):
+                    opened.append(file)
+                return real_open(file, *args, **kwargs)
+
+            uploader = self._uploader(str(Path(temp_dir) / "checkpoints"), atomic_commit=True)
+            with mock.patch("builtins.open", tracking_open):
+                self.assertTrue(uploader.do_upload(FileTask(source), "daily"))
+            self.assertEqual(len(opened), 1)
+
+    def test_atomic_commit_rejects_crc_mismatch(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "large.tgz"
+            source.write_bytes(os.urandom(350 * 1024))
+            self.server.corrupt_crc = True
+
+            uploader = self._uploader(str(Path(temp_dir) / "checkpoints"), atomic_commit=True)
+            with self.assertRaises((IOError, oss2.exceptions.InconsistentError)):
+                uploader.do_upload(FileTask(source), "daily")
+            self.assertEqual(self.server.objects, {})
+            self.assertEqual(self.server.count("CompleteMultipartUpload"), 1)
+
+
+class OSSDedupTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeOSSServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def _upload_same_content_twice(self, temp_dir, mode):
+        first = Path(temp_dir) / "file.240101_000000_abc"
+        second = Path(temp_dir) / "file.240102_000000_abc"
+        for path in (first, second):
+            path.write_bytes(b"unchanged file")
+        uploader = OSSUploader("oss", "id", "secret", self.server.endpoint, "bucket",
+                               atomic_commit=True)
+        uploader.set_dedup(mode, str(Path(temp_dir) / "oss.dedup.json"))
+        self.assertTrue(uploader.upload(FileTask(first, "abc"), "daily"))
+        self.server.requests.clear()
+        self.assertTrue(uploader.upload(FileTask(second, "abc"), "daily"))
+        return uploader, second
+
+    def test_identical_content_is_skipped_or_referenced(self):
+        expected = {"skip": ["HeadObject"], "copy": ["HeadObject", "CopyObject"],
+                    "symlink": ["HeadObject", "PutSymlink"]}
+        for mode, operations in expected.items():
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory(dir=".") as temp_dir:
+                self.server.objects.clear()
+                self._upload_same_content_twice(temp_dir, mode)
+                self.assertEqual([name for name, _ in self.server.requests], operations)
+                self.assertEqual(
+                    self.server.objects.get("daily/file.240102_000000_abc"),
+                    None if mode == "skip" else b"unchanged file")
+
+    def test_missing_reference_source_falls_back_to_full_upload(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            uploader, second = self._upload_same_content_twice(temp_dir, "copy")
+            self.server.objects.clear()
+            self.server.requests.clear()
+
+            self.assertTrue(uploader.upload(FileTask(second, "abc"), "weekly"))
+            self.assertEqual([name for name, _ in self.server.requests],
+                             ["HeadObject", "PutObject"])
+            self.assertEqual(uploader.dedup_index.lookup("abc"),
+                             "weekly/file.240102_000000_abc")
+
+    def test_skip_uploads_again_when_the_remote_file_is_gone(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            uploader, second = self._upload_same_content_twice(temp_dir, "skip")
+            self.server.objects.clear()
+            self.server.requests.clear()
+
+            self.assertTrue(uploader.upload(FileTask(second, "abc"), "daily"))
+            self.assertEqual([name for name, _ in self.server.requests],
+                             ["HeadObject", "PutObject"])
+            self.assertEqual(self.server.objects,
+                             {"daily/file.240102_000000_abc": b"unchanged file"})
+            self.assertEqual(uploader.dedup_index.lookup("abc"),
+                             "daily/file.240102_000000_abc")
+
+    def test_default_index_is_an_absolute_path_in_the_index_dir(self):
+        uploader = OSSUploader("oss", "id", "secret", self.server.endpoint, "bucket")
+        uploader.set_dedup("skip", index_dir="state")
+        self.assertEqual(uploader.dedup_index.file_name,
+                         os.path.join(os.getcwd(), "state", "oss.dedup.json"))
+
+    def test_ftp_only_supports_skip(self):
+        errors = _validate_config({"tasks": [], "uploaders": [
+            {"type": "ftp", "name": "ftp", "host": "h", "username": "u", "password": "p",
+             "dedup": "copy"},
+            {"type": "oss", "name": "oss", "access_id": "i", "access_key": "k",
+             "endpoint": "e", "bucket_name": "b", "dedup": "symlink"},
+        ]})
+        self.assertEqual(errors, ["uploaders[0].dedup 必须是 off/skip 之一"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,276 @@
+import gzip
+import hashlib
+import importlib.util
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+
+from config_parser import _validate_config
+from easybk.archive_stream import (ArchiveStreamWriter, GzipStreamVerifier, TarStreamVerifier)
+from easybk.compression import Compression, ParallelGzipCompressor, ZstdStreamVerifier
+from easybk.encipher_manager import EncipherManager
+from easybk.tasks import PackTask
+
+
+def _make_tar_bytes(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT) as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class PackPipelineTests(unittest.TestCase):
+    def test_verifier_accepts_multi_member_gzip_tar(self):
+        tar_bytes = _make_tar_bytes({"a.txt": b"a" * 5000, "b.txt": b"b" * 10})
+        split = len(tar_bytes) // 2
+        payload = gzip.compress(tar_bytes[:split]) + gzip.compress(tar_bytes[split:])
+        verifier = GzipStreamVerifier(TarStreamVerifier())
+
+        for offset in range(0, len(payload), 7):
+            verifier.feed(payload[offset:offset + 7])
+        verifier.finish()
+
+    def test_verifier_rejects_truncated_archive(self):
+        payload = gzip.compress(_make_tar_bytes({"a.txt": b"x" * 100000}))
+        output = io.BytesIO()
+        writer = ArchiveStreamWriter(output, GzipStreamVerifier(TarStreamVerifier()))
+        writer.write(payload[:len(payload) // 2])
+
+        with self.assertRaisesRegex(ValueError, "完整性校验失败"):
+            writer.finish()
+
+    def test_tar_verifier_rejects_corrupted_header(self):
+        tar_bytes = bytearray(_make_tar_bytes({"a.txt": b"content"}))
+        tar_bytes[0] ^= 0xFF
+        verifier = TarStreamVerifier()
+
+        with self.assertRaisesRegex(ValueError, "校验和"):
+            verifier.feed(bytes(tar_bytes))
+
+    @unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+    def test_streaming_pack_writes_verified_archive_with_matching_digest(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            run_dir = Path(temp_dir) / "source"
+            output_dir = Path(temp_dir) / "output"
+            (run_dir / "data").mkdir(parents=True)
+            output_dir.mkdir()
+            (run_dir / "data" / "file.txt").write_text("backup content", encoding="utf-8")
+
+            task = PackTask("pack", str(output_dir), str(run_dir), ["data"], streaming=True)
+
+            self.assertTrue(task.run())
+            archive = Path(task.get_output_full_path())
+            digest = hashlib.sha256(archive.read_bytes()).hexdigest()
+            self.assertTrue(archive.name.endswith("_{}.tgz".format(digest)))
+            listing = subprocess.run(["tar", "tzf", str(archive)], check=True,
+                                     stdout=subprocess.PIPE).stdout.decode()
+            self.assertIn("data/file.txt", listing)
+            self.assertEqual(sorted(p.name for p in output_dir.iterdir()), [archive.name])
+
+    @unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+    def test_gzip_compress_level_is_passed_to_tar(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            run_dir = Path(temp_dir) / "source"
+            (run_dir / "data").mkdir(parents=True)
+            (run_dir / "data" / "file.txt").write_text("backup content\n" * 1000,
+                                                      encoding="utf-8")
+            # gzip 头部的 XFL 字节：级别 9 为 2，级别 1 为 4
+            for streaming in (False, True):
+                for level, xfl in ((1, 4), (9, 2)):
+                    output_dir = Path(temp_dir) / "output-{}-{}".format(streaming, level)
+                    output_dir.mkdir()
+                    task = PackTask("pack", str(output_dir), str(run_dir), ["data"],
+                                    streaming=streaming, compress_level=level)
+
+                    self.assertTrue(task.run())
+                    archive = Path(task.get_output_full_path()).read_bytes()
+                    self.assertEqual(archive[8], xfl)
+                    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+                        self.assertEqual(tar.getnames(), ["data", "data/file.txt"])
+
+    @unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+    def test_streaming_pack_failure_removes_temp_files(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            task = PackTask("pack", temp_dir, temp_dir, ["missing"], streaming=True)
+
+            with self.assertLogs("PackTask", level="ERROR"):
+                with self.assertRaises(subprocess.CalledProcessError):
+                    task.run()
+
+            self.assertEqual(list(Path(temp_dir).iterdir()), [])
+
+    @unittest.skipUnless(importlib.util.find_spec("zstandard"), "zstandard is not installed")
+    def test_zstd_verifier_bounds_output_and_rejects_truncated_frames(self):
+        import zstandard
+
+        class Recorder():
+            def __init__(self):
+                self.sizes = []
+                self.finished = False
+
+            def feed(self, data):
+                self.sizes.append(len(data))
+
+            def finish(self):
+                self.finished = True
+
+        payload = zstandard.ZstdCompressor(write_checksum=True).compress(b"\0" * (64 << 20)) + \
+            zstandard.ZstdCompressor().compress(b"second frame")
+        recorder = Recorder()
+        verifier = ZstdStreamVerifier(recorder)
+        for offset in range(0, len(payload), 1000):
+            verifier.feed(payload[offset:offset + 1000])
+        verifier.finish()
+        self.assertTrue(recorder.finished)
+        self.assertEqual(sum(recorder.sizes), (64 << 20) + len(b"second frame"))
+        self.assertLessEqual(max(recorder.sizes), 4 * 1024 * 1024)
+
+        for size in (3, len(payload) // 2, len(payload) - 1):
+            verifier = ZstdStreamVerifier()
+            verifier.feed(payload[:size])
+            with self.assertRaises(ValueError):
+                verifier.finish()
+
+    def test_parallel_gzip_output_is_ordered_and_decompressible(self):
+        data = bytes(range(256)) * 20000
+        compressor = ParallelGzipCompressor(level=1, workers=4, block_size=4096)
+        try:
+            blocks = []
+            for offset in range(0, len(data), 10000):
+                blocks.extend(compressor.compress(data[offset:offset + 10000]))
+            blocks.extend(compressor.flush())
+        finally:
+            compressor.close()
+
+        self.assertEqual(gzip.decompress(b"".join(blocks)), data)
+
+    def test_adaptive_policy_stores_incompressible_blocks(self):
+        text = (b"line of text\n" * 20000)[:128 * 1024]
+        noise = os.urandom(256 * 1024)
+        data = text + noise + text
+        compressor = ParallelGzipCompressor(level=6, workers=2, block_size=128 * 1024,
+                                            adaptive=True)
+        try:
+            members = compressor.compress(data) + compressor.flush()
+        finally:
+            compressor.close()
+
+        self.assertEqual(gzip.decompress(b"".join(members)), data)
+        self.assertEqual(compressor.stored_blocks, 2)
+        self.assertEqual(compressor.blocks, len(members))
+        self.assertLess(len(b"".join(members)), len(noise) + len(text))
+        self.assertGreaterEqual(compressor.cpu_seconds_saved, 0.0)
+        self.assertIn("未压缩 2 块", compressor.describe_savings())
+
+    @unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+    def test_parallel_gzip_pack_is_extractable_and_reports_throughput(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            run_dir = Path(temp_dir) / "source"
+            output_dir = Path(temp_dir) / "output"
+            extract_dir = Path(temp_dir) / "extract"
+            run_dir.mkdir()
+            extract_dir.mkdir()
+            content = b"line of text\n" * 300000
+            (run_dir / "big.txt").write_bytes(content)
+
+            task = PackTask("pack", str(output_dir), str(run_dir), ["big.txt"],
+                            compression="parallel_gzip", compress_workers=3)
+
+            self.assertTrue(task.run())
+            archive = Path(task.get_output_full_path())
+            self.assertTrue(archive.name.endswith(".tgz"))
+            self.assertEqual(task.archive_stats.digest,
+                             hashlib.sha256(archive.read_bytes()).hexdigest())
+            self.assertEqual(task.archive_stats.output_bytes, archive.stat().st_size)
+            self.assertGreater(task.archive_stats.raw_bytes, len(content))
+            subprocess.run(["tar", "xzf", str(archive), "-C", str(extract_dir)], check=True)
+            self.assertEqual((extract_dir / "big.txt").read_bytes(), content)
+
+    def test_config_rejects_unknown_compression(self):
+        config = {"tasks": [{"type": "pack", "task_name": "p", "output_dir": "out",
+                             "tar_run_dir": "/", "backup_list": ["etc"],
+                             "compression": "lzma", "compress_workers": 0}],
+                  "uploaders": []}
+
+        errors = _validate_config(config)
+
+        self.assertTrue(any("compression 不受支持" in error for error in errors))
+        self.assertTrue(any("compress_workers 必须是正整数" in error for error in errors))
+
+        config["tasks"][0].update(compression="gzip", compress_workers=2,
+                                  compression_policy="adaptive")
+        self.assertEqual(_validate_config(config), [
+            "tasks[0].compression_policy adaptive 需要 compression: parallel_gzip"])
+
+    def test_config_rejects_out_of_range_compress_level(self):
+        tasks = [{"type": "pack", "task_name": "p", "output_dir": "out", "tar_run_dir": "/",
+                  "backup_list": ["etc"], "compression": "parallel_gzip", "compress_level": 42},
+                 {"type": "mysql", "task_name": "db", "output_dir": "out",
+                  "dump_option": ["--all-databases"], "compress_level": -1},
+                 {"type": "pack", "task_name": "z", "output_dir": "out", "tar_run_dir": "/",
+                  "backup_list": ["etc"], "compression": "zstd", "compress_level": 19}]
+
+        self.assertEqual(_validate_config({"tasks": tasks, "uploaders": []}), [
+            "tasks[0].compress_level 必须在 0～9 之间（parallel_gzip）",
+            "tasks[1].compress_level 必须在 1～9 之间（gzip）"])
+        with self.assertRaises(ValueError):
+            Compression("parallel_gzip", 42)
+
+    @unittest.skipUnless(shutil.which("tar"), "tar is not installed")
+    def test_incremental_pack_archives_only_changes_and_deletions(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            run_dir = Path(temp_dir) / "source"
+            output_dir = Path(temp_dir) / "output"
+            pages = run_dir / "wiki" / "pages"
+            pages.mkdir(parents=True)
+            (pages / "a.txt").write_text("a", encoding="utf-8")
+            (pages / "b.txt").write_text("b", encoding="utf-8")
+            (pages / "c.txt").write_text("c", encoding="utf-8")
+            task = PackTask("wiki", str(output_dir), str(run_dir), ["wiki"],
+                            incremental=True, full_backup_interval=2)
+            state = EncipherManager()
+            state.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+
+            def run_and_commit():
+                result = task.run()
+                state.save_data_to_file()
+                return result
+
+            def members(path):
+                listing = subprocess.run(["tar", "tzf", path], check=True,
+                                         stdout=subprocess.PIPE).stdout.decode()
+                return sorted(listing.split())
+
+            self.assertTrue(run_and_commit())
+            self.assertNotIn("_inc_", task.get_output_file_name())
+            self.assertFalse(run_and_commit())
+
+            (pages / "b.txt").write_text("changed", encoding="utf-8")
+            (pages / "c.txt").unlink()
+            (pages / "d.txt").write_text("new", encoding="utf-8")
+            self.assertTrue(run_and_commit())
+            self.assertIn("_backup_inc_", task.get_output_file_name())
+            self.assertEqual(members(task.get_output_full_path()),
+                             [".easybk-deleted", "wiki/pages/b.txt", "wiki/pages/d.txt"])
+            with tarfile.open(task.get_output_full_path()) as archive:
+                deleted = archive.extractfile(".easybk-deleted").read()
+            self.assertEqual(deleted, b"wiki/pages/c.txt\0")
+
+            (pages / "a.txt").write_text("again", encoding="utf-8")
+            self.assertTrue(run_and_commit())
+            self.assertIn("_backup_inc_", task.get_output_file_name())
+            (pages / "a.txt").write_text("third", encoding="utf-8")
+            self.assertTrue(run_and_commit())
+            self.assertNotIn("_inc_", task.get_output_file_name())
+
+
+if __name__ == "__main__":
+    unittest.main()
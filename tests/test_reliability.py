@@ -48,6 +48,9 @@ class ReliabilityTests(unittest.TestCase):
         self.assertTrue(args.config.endswith("custom.yaml"))
         self.assertTrue(args.env_file.endswith("secrets.env"))
         self.assertTrue(args.validate_config)
+        # sqlite 需要显式指定，默认仍读写文本状态文件
+        self.assertEqual(args.state_backend, TaskManager().state_backend)
+        self.assertEqual(args.state_backend, "text")
 
     def test_config_rejects_duplicate_names_and_missing_reference(self):
         config = {
@@ -0,0 +1,202 @@
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from backup import parse_args
+from config_parser import _validate_config
+from easybk import (BackupScheduler, MysqlTask, PackTask, SingleFileTask, Task, TaskManager,
+                    UploadManager, UploadTask, Uploader)
+from easybk.scheduler import ResourcePools
+
+
+class EventTask(Task):
+    def __init__(self, name, output_dir, wait_for=None, error=None):
+        super().__init__(name, output_dir)
+        self.wait_for = wait_for
+        self.error = error
+
+    def do_task(self):
+        if self.error:
+            raise self.error
+        if self.wait_for is not None and not self.wait_for.wait(5):
+            raise TimeoutError("upload of the fast task never started")
+        return True
+
+
+class RecordingUploader(Uploader):
+    def __init__(self, result=True, started=None, failing=()):
+        super().__init__("recording")
+        self.result = result
+        self.started = started
+        self.failing = set(failing)
+        self.uploaded = []
+
+    def do_upload(self, task, remote_dir):
+        self.uploaded.append(task.get_name())
+        if self.started is not None:
+            self.started.set()
+        return self.result and task.get_name() not in self.failing
+
+
+def _managers(tasks, uploader):
+    task_manager = TaskManager()
+    upload_manager = UploadManager()
+    for task in tasks:
+        task_manager.add_task(task)
+        upload_manager.add_upload_task(UploadTask(task, uploader))
+    return task_manager, upload_manager
+
+
+class SchedulerTests(unittest.TestCase):
+    def test_upload_starts_while_slower_task_is_still_running(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            fast_uploaded = threading.Event()
+            uploader = RecordingUploader(started=fast_uploaded)
+            slow = EventTask("slow", temp_dir, wait_for=fast_uploaded)
+            fast = EventTask("fast", temp_dir)
+            task_manager, upload_manager = _managers([slow, fast], uploader)
+            task_manager.set_encipher_file(temp_dir + "/state.txt")
+
+            scheduler = BackupScheduler(task_manager, upload_manager, pools={"cpu": 2, "disk": 2})
+            self.assertTrue(scheduler.run())
+
+            self.assertEqual(uploader.uploaded, ["fast", "slow"])
+
+    def test_any_task_or_upload_failure_fails_the_run(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            task_manager, upload_manager = _managers(
+                [EventTask("ok", temp_dir)], RecordingUploader(result=False))
+            task_manager.set_encipher_file(temp_dir + "/state.txt")
+            self.assertFalse(BackupScheduler(task_manager, upload_manager).run())
+
+            uploader = RecordingUploader()
+            task_manager, upload_manager = _managers(
+                [EventTask("broken", temp_dir, error=RuntimeError("boom")),
+                 EventTask("ok", temp_dir)], uploader)
+            task_manager.set_encipher_file(temp_dir + "/state.txt")
+            self.assertFalse(BackupScheduler(task_manager, upload_manager).run())
+            self.assertEqual(uploader.uploaded, ["ok"])
+
+    def test_state_is_committed_per_task_when_another_upload_fails(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            state_file = str(Path(temp_dir) / "state.txt")
+            tasks = []
+            for name in ("good", "flaky"):
+                source = Path(temp_dir) / "{}.conf".format(name)
+                source.write_text(name, encoding="utf-8")
+                tasks.append(SingleFileTask(name, str(Path(temp_dir) / "out"), str(source),
+                                            backup_on_change=True))
+
+            uploader = RecordingUploader(failing=["flaky"])
+            task_manager, upload_manager = _managers(tasks, uploader)
+            task_manager.set_encipher_file(state_file)
+            self.assertFalse(BackupScheduler(task_manager, upload_manager).run())
+            state = Path(state_file).read_text(encoding="utf-8")
+            self.assertIn("good.conf", state)
+            self.assertNotIn("flaky.conf", state)
+            self.assertNotIn(tasks[1].backup_file, task_manager.encipher_manager.file_dict)
+
+            uploader = RecordingUploader()
+            task_manager, upload_manager = _managers(tasks, uploader)
+            task_manager.set_encipher_file(state_file)
+            self.assertTrue(BackupScheduler(task_manager, upload_manager).run())
+            self.assertFalse(tasks[0].run())
+            self.assertIn("flaky.conf", Path(state_file).read_text(encoding="utf-8"))
+
+    def test_uploaders_are_closed_when_the_run_raises(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            uploader = RecordingUploader()
+            task_manager, upload_manager = _managers([EventTask("ok", temp_dir)], uploader)
+            task_manager.set_encipher_file(temp_dir + "/state.txt")
+
+            with mock.patch.object(task_manager, "finish_task_state",
+                                   side_effect=OSError("disk full")), \
+                    mock.patch.object(uploader, "close") as close:
+                with self.assertRaises(OSError):
+                    BackupScheduler(task_manager, upload_manager).run()
+            close.assert_called_once_with()
+
+    def test_tasks_sharing_a_pool_never_overlap(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            lock = threading.Lock()
+            running = {"now": 0, "peak": 0}
+
+            class CountingTask(Task):
+                def do_task(self):
+                    with lock:
+                        running["now"] += 1
+                        running["peak"] = max(running["peak"], running["now"])
+                    time.sleep(0.05)
+                    with lock:
+                        running["now"] -= 1
+                    return True
+
+            task_manager = TaskManager()
+            task_manager.set_encipher_file(temp_dir + "/state.txt")
+            for index in range(3):
+                task = CountingTask("t{}".format(index), temp_dir)
+                task.set_pools(["nas"])
+                task_manager.add_task(task)
+            scheduler = BackupScheduler(task_manager, UploadManager(),
+                                        task_workers=3, pools={"nas": 1})
+
+            self.assertTrue(scheduler.run())
+            self.assertEqual(running["peak"], 1)
+
+    def test_pool_limits_resolve_by_name_then_category(self):
+        pools = ResourcePools({"disk": 2, "disk:7": 1})
+        self.assertEqual(pools.limit("disk:7"), 1)
+        self.assertEqual(pools.limit("disk:8"), 2)
+        self.assertEqual(pools.limit("net:oss", default=4), 4)
+        with pools.acquire(["net:oss", "cpu"], {"net:oss": 4}):
+            pass
+
+    def test_default_pools_serialize_tasks_on_the_same_disk(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            lock = threading.Lock()
+            running = {"now": 0, "peak": 0}
+
+            class CountingTask(Task):
+                def do_task(self):
+                    with lock:
+                        running["now"] += 1
+                        running["peak"] = max(running["peak"], running["now"])
+                    time.sleep(0.05)
+                    with lock:
+                        running["now"] -= 1
+                    return True
+
+            task_manager = TaskManager()
+            task_manager.set_encipher_file(temp_dir + "/state.txt")
+            for index in range(2):
+                task_manager.add_task(CountingTask("pack{}".format(index), temp_dir))
+            scheduler = BackupScheduler(task_manager, UploadManager(), task_workers=3)
+
+            self.assertEqual(PackTask.DEFAULT_POOLS, Task.DEFAULT_POOLS)
+            self.assertTrue(scheduler.run())
+            self.assertEqual(running["peak"], 1)
+            self.assertEqual(MysqlTask("db", "out", "--all-databases").get_pools(), ["cpu"])
+            self.assertEqual(SingleFileTask("file", "out", "/etc/hosts").get_pools(), [])
+
+    def test_scheduler_config_and_cli_options(self):
+        errors = _validate_config({
+            "scheduler": {"task_workers": 0, "pools": {"nas": 1}},
+            "tasks": [{"type": "single_file", "task_name": "a", "output_dir": "out",
+                       "source_file": "a", "pools": ["cpu", "nas", "unknown"]}],
+            "uploaders": [{"type": "ftp", "name": "ftp", "host": "h", "username": "u",
+                           "password": "p", "max_connections": 0}],
+        })
+        self.assertIn("scheduler.task_workers 必须是正整数", errors)
+        self.assertIn("tasks[0].pools 引用了未声明的资源池: unknown", errors)
+        self.assertIn("uploaders[0].max_connections 必须是正整数", errors)
+        self.assertEqual(len(errors), 3)
+
+        args = parse_args(["--task-workers", "5", "--upload-workers", "2"])
+        self.assertEqual((args.task_workers, args.upload_workers), (5, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from easybk import EncipherManager, SingleFileTask
+from easybk.state_store import SqliteStateStore
+from easybk.tasks import single_file_task
+
+
+def _age_file(path, seconds=60):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+class StateTests(unittest.TestCase):
+    def test_state_file_reads_legacy_lines_and_writes_stat_signature(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            state_file = Path(temp_dir) / "state.txt"
+            state_file.write_text("abc legacy path\ndef@1,2,3,4 new path\n", encoding="utf-8")
+            manager = EncipherManager()
+            manager.load_data_from_file(str(state_file))
+
+            self.assertEqual(manager.file_dict, {"legacy path": "abc", "new path": "def"})
+            self.assertIsNone(manager.get_cached_digest("legacy path", (1, 2, 3, 4)))
+            self.assertEqual(manager.get_cached_digest("new path", (1, 2, 3, 4)), "def")
+            self.assertIsNone(manager.get_cached_digest("new path", (1, 2, 3, 5)))
+
+            manager.save_data_to_file(force=True)
+            self.assertIn("def@1,2,3,4 new path", state_file.read_text(encoding="utf-8"))
+
+    def test_single_file_task_skips_rehash_when_stat_unchanged(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "source.conf"
+            source.write_text("config", encoding="utf-8")
+            _age_file(source)
+            task = SingleFileTask("conf", str(Path(temp_dir) / "out"), str(source),
+                                  backup_on_change=True)
+            manager = EncipherManager()
+            manager.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+
+            with mock.patch.object(single_file_task, "hash_file",
+                                   wraps=single_file_task.hash_file) as digest:
+                self.assertTrue(task.run())
+                self.assertFalse(task.run())
+                self.assertEqual(digest.call_count, 1)
+
+                task.paranoid = True
+                self.assertFalse(task.run())
+                self.assertEqual(digest.call_count, 2)
+
+    def test_touched_file_refreshes_stat_without_backup(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            source = Path(temp_dir) / "source.conf"
+            source.write_text("config", encoding="utf-8")
+            _age_file(source, 120)
+            task = SingleFileTask("conf", str(Path(temp_dir) / "out"), str(source),
+                                  backup_on_change=True)
+            manager = EncipherManager()
+            manager.load_data_from_file(str(Path(temp_dir) / "state.txt"))
+            self.assertTrue(task.run())
+
+            _age_file(source, 60)
+            with mock.patch.object(single_file_task, "copy_file_fast") as copy_fast, \
+                    mock.patch.object(single_file_task, "copy_file_with_digest") as copy_digest:
+                self.assertFalse(task.run())
+            copy_fast.assert_not_called()
+            copy_digest.assert_not_called()
+            self.assertEqual(manager.stat_dict[str(source)],
+                             EncipherManager.stat_signature(str(source)))
+            self.assertEqual(os.listdir(str(Path(temp_dir) / "out")),
+                             [task.get_output_file_name()])
+
+    def test_sqlite_backend_migrates_text_state_once(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            state_file = Path(temp_dir) / "state.txt"
+            state_file.write_text("abc legacy path\ndef@1,2,3,4 new path\n", encoding="utf-8")
+            Path(str(state_file) + ".site.manifest").write_text(json.dumps({"version": 1}),
+                                                                encoding="utf-8")
+            manager = EncipherManager()
+            manager.load_data_from_file(str(state_file), "sqlite")
+
+            self.assertEqual(manager.file_dict, {})
+            self.assertEqual(manager.get_cached_digest("new path", (1, 2, 3, 4)), "def")
+            self.assertFalse(manager.check_if_has_changed("legacy path", "abc"))
+            self.assertEqual(manager.load_manifest("site"), {"version": 1})
+
+            state_file.write_text("zzz legacy path\n", encoding="utf-8")
+            manager.load_data_from_file(str(state_file), "sqlite")
+            self.assertFalse(manager.check_if_has_changed("legacy path", "abc"))
+            manager.store.close()
+
+            with self.assertLogs("StateStore", "WARNING"):
+                manager.load_data_from_file(str(state_file), "text")
+
+    def test_sqlite_backend_commits_only_changed_entries(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            state_file = str(Path(temp_dir) / "state.txt")
+            manager = EncipherManager()
+            manager.load_data_from_file(state_file, "sqlite")
+            manager.set_value("a", "1", (1, 2, 3, 4))
+            manager.set_value("b", "2")
+            manager.set_manifest("site", {"files": ["a"]})
+            manager.save_data_to_file()
+
+            manager.load_data_from_file(state_file, "sqlite")
+            manager.set_value("b", "3")
+            with mock.patch.object(SqliteStateStore, "commit",
+                                   wraps=manager.store.commit) as commit:
+                manager.save_data_to_file()
+            self.assertEqual(commit.call_args[0][0], {"b": ("3", None)})
+            manager.store.close()
+
+            with sqlite3.connect(state_file + ".sqlite") as db:
+                rows = db.execute("SELECT path, digest, stat FROM digests ORDER BY path").fetchall()
+            self.assertEqual(rows, [("a", "1", "1,2,3,4"), ("b", "3", None)])
+            self.assertFalse(os.path.exists(state_file))
+
+            manager.load_data_from_file(state_file, "sqlite")
+            self.assertEqual(manager.load_manifest("site"), {"files": ["a"]})
+            manager.store.close()
+
+    def test_manifest_entries_are_committed_as_diffs(self):
+        for backend in ("text", "sqlite"):
+            with self.subTest(backend=backend), tempfile.TemporaryDirectory(dir=".") as temp_dir:
+                state_file = str(Path(temp_dir) / "state.txt")
+                manager = EncipherManager()
+                manager.load_data_from_file(state_file, backend)
+                manager.set_manifest("site", {"version": 2}, entries={"a": [1], "b": [2]})
+                manager.save_data_to_file()
+
+                manager.load_data_from_file(state_file, backend)
+                manager.set_manifest("site", {"version": 2, "count": 1}, entries={"c": [3]},
+                                     removed=["a"])
+                self.assertEqual(manager.load_manifest_entries("site"), {"b": [2], "c": [3]})
+                with mock.patch.object(type(manager.store), "commit",
+                                       wraps=manager.store.commit) as commit:
+                    manager.save_data_to_file()
+                change = commit.call_args[0][1]["site"]
+                self.assertEqual((change.entries, change.removed), ({"c": [3]}, {"a"}))
+
+                manager.load_data_from_file(state_file, backend)
+                self.assertEqual(manager.load_manifest("site"), {"version": 2, "count": 1})
+                self.assertEqual(manager.load_manifest_entries("site"), {"b": [2], "c": [3]})
+                manager.store.close()
+                if backend == "sqlite":
+                    with sqlite3.connect(state_file + ".sqlite") as db:
+                        rows = db.execute("SELECT key, data FROM manifest_entries "
+                                          "WHERE name = 'site' ORDER BY key").fetchall()
+                    self.assertEqual(rows, [("b", "[2]"), ("c", "[3]")])
+
+    def test_constructing_manager_again_keeps_loaded_state(self):
+        with tempfile.TemporaryDirectory(dir=".") as temp_dir:
+            state_file = str(Path(temp_dir) / "state.txt")
+            manager = EncipherManager()
+            manager.load_data_from_file(state_file)
+            manager.set_value("a", "1", owner="task")
+
+            self.assertIs(EncipherManager(), manager)
+            self.assertEqual(manager.file_name, state_file)
+            self.assertFalse(manager.check_if_has_changed("a", "1"))
+
+    def test_concurrent_namespaces_do_not_lose_updates(self):
+        for backend in ("text", "sqlite"):
+            with self.subTest(backend=backend), \
+                    tempfile.TemporaryDirectory(dir=".") as temp_dir:
+                state_file = str(Path(temp_dir) / "state.txt")
+                manager = EncipherManager()
+                manager.load_data_from_file(state_file, backend)
+                threads, rounds, paths = 24, 20, 10
+                barrier = threading.Barrier(threads)
+                errors = []
+
+                def worker(index):
+                    state = manager.namespace("task{}".format(index))
+                    try:
+                        barrier.wait()
+                        for round_ in range(rounds):
+                            for path in range(paths):
+                                name = "t{}/f{}".format(index, path)
+                                value = "{}-{}".format(round_, path)
+                                state.get_cached_digest(name, (1, 2, 3, 4))
+                                if state.check_if_has_changed(name, value):
+                                    state.set_value(name, value, (round_, path, index, 0))
+                            state.set_manifest({"round": round_})
+                            # 奇数任务的最后一轮失败，其修改应被丢弃
+                            if index % 2 and round_ == rounds - 1:
+                                manager.discard(state.owner)
+                            else:
+                                manager.commit(state.owner)
+                    except Exception as exc:
+                        errors.append(exc)
+
+                workers = [threading.Thread(target=worker, args=(index,))
+                           for index in range(threads)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                self.assertEqual(errors, [])
+                self.assertFalse(manager.changed)
+
+                manager.load_data_from_file(state_file, backend)
+                for index in range(threads):
+                    last = rounds - 1 - index % 2
+                    for path in range(paths):
+                        self.assertEqual(
+                            manager.get_cached_digest("t{}/f{}".format(index, path),
+                                                      (last, path, index, 0)),
+                            "{}-{}".format(last, path))
+                    self.assertEqual(manager.load_manifest("task{}".format(index)),
+                                     {"round": last})
+                manager.store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()